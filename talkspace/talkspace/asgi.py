@@ -2,12 +2,13 @@ import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 import user.routing
+from user.outbox import OutboxRelayApp
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'talkspace.settings')
 
-application = ProtocolTypeRouter({
+application = OutboxRelayApp(ProtocolTypeRouter({
     "http": get_asgi_application(),
     "websocket": URLRouter(
         user.routing.websocket_urlpatterns
     ),
-})
+}))
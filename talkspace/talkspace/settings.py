@@ -11,8 +11,10 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
 from datetime import timedelta
+import copy
+from django.conf import global_settings
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -52,6 +54,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'user.middleware.MetricsMiddleware',
+    'user.middleware.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -94,9 +98,67 @@ DATABASES = {
         'PASSWORD': config('DB_PASSWORD'),
         'HOST': config('DB_HOST'),
         'PORT': config('DB_PORT'),
+        # Persistent connections; the async ORM reuses them across frames.
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# PostgreSQL connection pooling (psycopg 3 with psycopg[pool], as pinned in
+# requirements.txt). A pooled connection goes back to the pool when a request
+# or database_sync_to_async call finishes, so it replaces persistent
+# connections.
+DB_POOL = config('DB_POOL', default=False, cast=bool)
+if DB_POOL:
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': config('DB_POOL_MIN_SIZE', default=2, cast=int),
+            'max_size': config('DB_POOL_MAX_SIZE', default=20, cast=int),
+            'timeout': config('DB_POOL_TIMEOUT', default=10, cast=float),
+        },
+    }
+
+# Read replicas (see user/routers.py): a comma-separated list of host[:port]
+# entries that share the primary's name and credentials, or of database files
+# for SQLite stand-ins. They become the aliases replica1, replica2, ...; tests
+# mirror them to the primary.
+DATABASE_REPLICAS = []
+for _number, _entry in enumerate(config('DB_REPLICAS', default='', cast=Csv()), 1):
+    _replica = copy.deepcopy(DATABASES['default'])
+    if _replica['ENGINE'].endswith('sqlite3'):
+        _replica['NAME'] = _entry
+    else:
+        _host, _, _port = _entry.partition(':')
+        _replica.update(HOST=_host, PORT=_port or _replica['PORT'])
+    _replica['TEST'] = {'MIRROR': 'default'}
+    DATABASES[f'replica{_number}'] = _replica
+    DATABASE_REPLICAS.append(f'replica{_number}')
+
+# Message shards (see user/sharding.py): entries in the DB_REPLICAS format
+# that become the aliases shard1, shard2, ... . ChatMessage and AttachedFile
+# rows are spread by room over `default` and these shards; migrate each one
+# with `migrate --database shardN`.
+MESSAGE_SHARDS = ['default']
+for _number, _entry in enumerate(config('DB_SHARDS', default='', cast=Csv()), 1):
+    _shard = copy.deepcopy(DATABASES['default'])
+    if _shard['ENGINE'].endswith('sqlite3'):
+        _shard['NAME'] = _entry
+    else:
+        _host, _, _port = _entry.partition(':')
+        _shard.update(HOST=_host, PORT=_port or _shard['PORT'])
+    DATABASES[f'shard{_number}'] = _shard
+    MESSAGE_SHARDS.append(f'shard{_number}')
+
+DATABASE_ROUTERS = ['user.sharding.ShardRouter', 'user.routers.ReplicaRouter']
+
+
+# Password hashing: PASSWORD_HASHER picks the hasher new and upgraded hashes
+# use (e.g. a subclass with tuned iterations); the rest still verify old hashes.
+_password_hasher = config('PASSWORD_HASHER', default=global_settings.PASSWORD_HASHERS[0])
+PASSWORD_HASHERS = [_password_hasher] + [
+    hasher for hasher in global_settings.PASSWORD_HASHERS if hasher != _password_hasher
+]
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -142,11 +204,15 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'user.authentication.JWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'user.metrics.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
 } 
 
 
@@ -169,7 +235,7 @@ CORS_ALLOW_CREDENTIALS = True
 
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "BACKEND": "user.layers.InMemoryChannelLayer",
     },
 }
 
@@ -190,4 +256,128 @@ EMAIL_HOST = config('EMAIL_HOST')
 EMAIL_PORT = config('EMAIL_PORT', cast=int)
 EMAIL_USE_TLS = config('EMAIL_USE_TLS', cast=bool)
 EMAIL_HOST_USER = config('EMAIL_HOST_USER')
-EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
\ No newline at end of file
+EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
+
+# In-process background worker pool (see user/tasks.py)
+BACKGROUND_TASK_WORKERS = config('BACKGROUND_TASK_WORKERS', default=2, cast=int)
+BACKGROUND_TASKS_EAGER = config('BACKGROUND_TASKS_EAGER', default=False, cast=bool)
+
+# Attachment delivery (see user/sendfile.py). Set to "nginx" (X-Accel-Redirect)
+# or "xsendfile" (Apache/lighttpd) to let the front-end server stream files.
+SENDFILE_BACKEND = config('SENDFILE_BACKEND', default='')
+SENDFILE_URL_PREFIX = config('SENDFILE_URL_PREFIX', default='/protected-media/')
+
+# Outbound mail queue (see user/mailer.py). For local debugging point
+# EMAIL_HOST/EMAIL_PORT at a stand-in such as `python -m aiosmtpd -n -l localhost:1025`.
+# Queued mail gets up to EMAIL_SHUTDOWN_TIMEOUT seconds to go out at exit.
+EMAIL_POOL_SIZE = config('EMAIL_POOL_SIZE', default=1, cast=int)
+EMAIL_BATCH_SIZE = config('EMAIL_BATCH_SIZE', default=50, cast=int)
+EMAIL_BATCH_WINDOW = config('EMAIL_BATCH_WINDOW', default=0.2, cast=float)
+EMAIL_MAX_RETRIES = config('EMAIL_MAX_RETRIES', default=5, cast=int)
+EMAIL_RETRY_BACKOFF = config('EMAIL_RETRY_BACKOFF', default=1.0, cast=float)
+EMAIL_IDLE_TIMEOUT = config('EMAIL_IDLE_TIMEOUT', default=30.0, cast=float)
+EMAIL_SHUTDOWN_TIMEOUT = config('EMAIL_SHUTDOWN_TIMEOUT', default=10.0, cast=float)
+
+# Rate limiting (see user/ratelimit.py). Use 'user.ratelimit.CacheStore' with a
+# shared cache (Redis/Memcached) to enforce limits across workers.
+RATE_LIMIT_STORE = config('RATE_LIMIT_STORE', default='user.ratelimit.MemoryStore')
+RATE_LIMITS = {
+    'login': {'rate': '10/min', 'burst': 5},
+    'password_reset': {'rate': '5/hour', 'burst': 3},
+    'search': {'rate': '60/min', 'burst': 20},
+    'contact_match': {'rate': '20/hour', 'burst': 5},
+    'chat_user': {'rate': '5/s', 'burst': 20},
+    'chat_room': {'rate': '100/s', 'algorithm': 'sliding_window'},
+}
+
+# Read receipts are written and broadcast at most once per window per socket.
+READ_RECEIPT_WINDOW = config('READ_RECEIPT_WINDOW', default=1.0, cast=float)
+
+# Hot-room message ring buffers (see user/cache.py). Per process; set
+# MESSAGE_CACHE_ROOMS=0 to disable when several processes write to a room.
+MESSAGE_CACHE_ROOMS = config('MESSAGE_CACHE_ROOMS', default=1000, cast=int)
+MESSAGE_CACHE_PER_ROOM = config('MESSAGE_CACHE_PER_ROOM', default=50, cast=int)
+MESSAGE_CACHE_MAX_BYTES = config('MESSAGE_CACHE_MAX_BYTES', default=64 * 1024 * 1024, cast=int)
+
+# Maximum number of messages a single bulk edit/delete request may touch.
+BULK_MESSAGE_LIMIT = config('BULK_MESSAGE_LIMIT', default=1000, cast=int)
+# Longest text a message may be edited to.
+MESSAGE_MAX_LENGTH = config('MESSAGE_MAX_LENGTH', default=10000, cast=int)
+
+# Messages older than this are moved to the archive tier by `manage.py archive_messages`.
+ARCHIVE_AFTER_DAYS = config('ARCHIVE_AFTER_DAYS', default=180, cast=int)
+
+# Compressed cold-history segments (see user/segments.py and `manage.py export_segments`).
+SEGMENT_ROOT = config('SEGMENT_ROOT', default=os.path.join(BASE_DIR, 'segments'))
+SEGMENT_BLOCK_SIZE = config('SEGMENT_BLOCK_SIZE', default=256, cast=int)
+
+# Request/frame instrumentation (see user/metrics.py). Every request and frame
+# is counted; the db/serialize/channel/pool breakdown is collected for a
+# METRICS_SAMPLE_RATE fraction of them. METRICS_TOKEN, when set, is required as
+# a Bearer token on /users/metrics/; without it only staff users can read them.
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+METRICS_SAMPLE_RATE = config('METRICS_SAMPLE_RATE', default=1.0, cast=float)
+METRICS_SERVER_TIMING = config('METRICS_SERVER_TIMING', default=DEBUG, cast=bool)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+# ASGI saturation monitoring (see user/monitor.py). database_sync_to_async runs
+# on a pool of SYNC_THREAD_POOL_SIZE threads (0 = asgiref's single shared
+# thread); each thread holds its own database connection. The loop thread's
+# stack is logged when a callback blocks the event loop for longer than
+# SLOW_CALLBACK_THRESHOLD seconds. LOOP_MONITOR_INTERVAL=0 disables the monitor.
+SYNC_THREAD_POOL_SIZE = config('SYNC_THREAD_POOL_SIZE', default=8, cast=int)
+LOOP_MONITOR_INTERVAL = config('LOOP_MONITOR_INTERVAL', default=0.5, cast=float)
+SLOW_CALLBACK_THRESHOLD = config('SLOW_CALLBACK_THRESHOLD', default=0.25, cast=float)
+MONITOR_TOP_GROUPS = config('MONITOR_TOP_GROUPS', default=20, cast=int)
+
+# Transactional outbox for broadcasts from REST views (see user/outbox.py).
+# Events are published after commit by a relay task on the ASGI event loop,
+# which waits OUTBOX_BATCH_WINDOW seconds to coalesce a burst and sends up to
+# OUTBOX_BATCH_SIZE events per pass. Relays in several processes take turns
+# on the outbox; OUTBOX_RELAY=False keeps a process from running one.
+OUTBOX_RELAY = config('OUTBOX_RELAY', default=True, cast=bool)
+OUTBOX_BATCH_SIZE = config('OUTBOX_BATCH_SIZE', default=500, cast=int)
+OUTBOX_BATCH_WINDOW = config('OUTBOX_BATCH_WINDOW', default=0.005, cast=float)
+OUTBOX_POLL_INTERVAL = config('OUTBOX_POLL_INTERVAL', default=1.0, cast=float)
+
+# Seconds a user's replica reads go to the primary after one of their writes,
+# i.e. the replication lag tolerated for read-your-writes.
+REPLICA_PIN_SECONDS = config('REPLICA_PIN_SECONDS', default=5, cast=int)
+
+# Message id generation and shard directory caching (see user/sharding.py).
+# Every process writing messages needs its own MESSAGE_ID_NODE (0-31);
+# directory entries are cached for SHARD_DIRECTORY_TTL seconds, which is
+# also how long `move_room_shard` waits for workers to see a change.
+MESSAGE_ID_NODE = config('MESSAGE_ID_NODE', default=os.getpid() % 32, cast=int)
+SHARD_DIRECTORY_TTL = config('SHARD_DIRECTORY_TTL', default=5, cast=float)
+
+# Password hashing for logins runs on a pool of PASSWORD_HASH_WORKERS
+# processes (0: one thread, for development) with at most PASSWORD_HASH_QUEUE
+# jobs in flight; see user/hashing.py. Outdated hashes are upgraded to
+# PASSWORD_HASHER on a successful login unless PASSWORD_REHASH_ON_LOGIN=False.
+PASSWORD_HASH_WORKERS = config('PASSWORD_HASH_WORKERS', default=min(4, os.cpu_count() or 1), cast=int)
+PASSWORD_HASH_QUEUE = config('PASSWORD_HASH_QUEUE', default=64, cast=int)
+PASSWORD_REHASH_ON_LOGIN = config('PASSWORD_REHASH_ON_LOGIN', default=True, cast=bool)
+# Work factor of user.hashers.TunedPBKDF2PasswordHasher.
+PASSWORD_PBKDF2_ITERATIONS = config('PASSWORD_PBKDF2_ITERATIONS', default=870000, cast=int)
+
+# Access-token revocation (see user/revocation.py). Workers see each other's
+# revocations within REVOCATION_SYNC_INTERVAL seconds; the in-memory filter
+# is sized for REVOCATION_FILTER_CAPACITY live revocations at the given false
+# positive rate. Expired revocations and simplejwt outstanding tokens are
+# purged every REVOCATION_COMPACT_INTERVAL seconds (0 disables; the
+# `compact_revocations` command does the same on demand).
+REVOCATION_SYNC_INTERVAL = config('REVOCATION_SYNC_INTERVAL', default=2.0, cast=float)
+REVOCATION_FILTER_CAPACITY = config('REVOCATION_FILTER_CAPACITY', default=100000, cast=int)
+REVOCATION_FILTER_ERROR_RATE = config('REVOCATION_FILTER_ERROR_RATE', default=0.001, cast=float)
+REVOCATION_COMPACT_INTERVAL = config('REVOCATION_COMPACT_INTERVAL', default=3600, cast=int)
+
+# Contact-book matching (see user/contacts.py): at most CONTACT_MATCH_MAX
+# contacts per request, looked up CONTACT_MATCH_BATCH_SIZE per query. The bulk
+# friend-request endpoint takes at most FRIEND_REQUEST_BULK_MAX users.
+CONTACT_MATCH_MAX = config('CONTACT_MATCH_MAX', default=5000, cast=int)
+CONTACT_MATCH_BATCH_SIZE = config('CONTACT_MATCH_BATCH_SIZE', default=500, cast=int)
+FRIEND_REQUEST_BULK_MAX = config('FRIEND_REQUEST_BULK_MAX', default=500, cast=int)
+
+# Friend-of-friend suggestions kept per user (see user/suggestions.py).
+FRIEND_SUGGESTION_LIMIT = config('FRIEND_SUGGESTION_LIMIT', default=50, cast=int)
@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class UserConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'user'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_delete
+        from . import sharding
+        from .metrics import install_query_timer
+        from .models import ChatRoom, User
+        connection_created.connect(install_query_timer)
+        # Hard deletes cascade to messages on default only; see sharding.room_deleted.
+        post_delete.connect(sharding.room_deleted, sender=ChatRoom)
+        post_delete.connect(sharding.user_deleted, sender=User)
@@ -0,0 +1,139 @@
+from django.db import transaction
+from django.db.models import Q
+from . import sharding
+from .cache import load_recent_messages, message_cache, recent_messages
+from .models import ArchivedChatMessage, ChatMessage, ChatRoom
+from .segments import all_segment_records, read_segment_records, serialize_records
+from .serializers import ChatMessageSerializer
+from .metrics import database_sync_to_async
+
+
+def archivable_messages(older_than):
+    """
+    Hot messages eligible for archiving: older than `older_than`, soft
+    deleted, or in a deleted room. Messages with attachments stay hot because
+    downloads and share links resolve them through the hot table.
+    """
+    if sharding.enabled():
+        # Shards have no room rows to join against.
+        in_deleted_room = Q(room_id__in=list(ChatRoom.objects.filter(is_deleted=True).values_list('id', flat=True)))
+    else:
+        in_deleted_room = Q(room__is_deleted=True)
+    return ChatMessage.objects.filter(
+        Q(timestamp__lt=older_than) | Q(is_deleted=True) | in_deleted_room,
+        files__isnull=True,
+    )
+
+
+def archive_messages(older_than, batch_size=1000):
+    """
+    Move eligible messages into ArchivedChatMessage in batches, each batch in
+    its own transaction so the hot table is never locked for long. With
+    sharding each shard is drained in turn; the archive rows commit before
+    the shard's deletes, so a failure leaves a message in both tiers rather
+    than in neither.
+    Returns the number of messages moved.
+    """
+    moved = 0
+    for hot in sharding.all_shards(archivable_messages(older_than)):
+        shard = hot.db
+        while True:
+            with transaction.atomic(using=shard), transaction.atomic():
+                batch = list(
+                    hot.order_by('id')
+                    .select_for_update(skip_locked=True, of=('self',))[:batch_size]
+                )
+                if not batch:
+                    break
+                ArchivedChatMessage.objects.bulk_create(
+                    [
+                        ArchivedChatMessage(
+                            id=message.id,
+                            room_id=message.room_id,
+                            user_id=message.user_id,
+                            message=message.message,
+                            timestamp=message.timestamp,
+                            month=message.timestamp.date().replace(day=1),
+                            is_read=message.is_read,
+                            is_deleted=message.is_deleted,
+                            share_token=message.share_token,
+                        )
+                        for message in batch
+                    ],
+                    ignore_conflicts=True,
+                )
+                ChatMessage.objects.filter(id__in=[message.id for message in batch]).using(shard).delete()
+                moved += len(batch)
+    return moved
+
+
+def message_page(room_id, limit, before=None, recent=None):
+    """
+    Up to `limit` non-deleted messages of a room with id < `before` (or the
+    newest ones), oldest first, reading the hot table first and continuing
+    into the archive table and then the compressed segments when it runs out.
+    `recent` is the newest messages when the caller already has them.
+    """
+    if before is None:
+        messages = list(recent if recent is not None else recent_messages(room_id, limit))
+    else:
+        hot = list(
+            ChatMessage.objects.filter(room_id=room_id, is_deleted=False, id__lt=before)
+            .prefetch_related('user')
+            .order_by('-id')[:limit]
+        )
+        hot.reverse()
+        messages = list(ChatMessageSerializer(hot, many=True).data)
+
+    if len(messages) < limit:
+        oldest = messages[0]['id'] if messages else before
+        archived = ArchivedChatMessage.objects.filter(room_id=room_id, is_deleted=False)
+        if oldest is not None:
+            archived = archived.filter(id__lt=oldest)
+        needed = limit - len(messages)
+        archived = list(archived.select_related('user').order_by('-id')[:needed])
+        archived.reverse()
+        older = list(ChatMessageSerializer(archived, many=True).data)
+
+        if len(older) < needed:
+            # The tiers can overlap by id, so merge with the segments and
+            # keep the newest `needed` of the combined set.
+            records = read_segment_records(room_id, needed, oldest)
+            older = sorted(older + serialize_records(room_id, records), key=lambda m: m['id'])[-needed:]
+        messages = older + messages
+    return messages
+
+
+async def amessage_page(room_id, limit, before=None):
+    """
+    message_page() for async views. A page the ring buffer holds in full is
+    returned without leaving the event loop; anything else is read in the
+    sync thread.
+    """
+    if before is not None or not message_cache.enabled:
+        return await database_sync_to_async(message_page)(room_id, limit, before)
+    recent = message_cache.get_recent(room_id, limit)
+    if recent is not None and len(recent) >= limit:
+        return recent
+    return await database_sync_to_async(_recent_page)(room_id, limit, recent)
+
+
+def _recent_page(room_id, limit, recent):
+    if recent is None:
+        recent = load_recent_messages(room_id, limit)
+    return message_page(room_id, limit, recent=recent)
+
+
+def full_history(room_id, include_deleted=False):
+    """Every message of a room across all storage tiers, oldest first."""
+    hot = ChatMessage.objects.filter(room_id=room_id)
+    archived = ArchivedChatMessage.objects.filter(room_id=room_id)
+    if not include_deleted:
+        hot = hot.filter(is_deleted=False)
+        archived = archived.filter(is_deleted=False)
+    cold = (
+        serialize_records(room_id, all_segment_records(room_id, include_deleted))
+        + list(ChatMessageSerializer(archived.select_related('user'), many=True).data)
+    )
+    cold.sort(key=lambda m: m['id'])
+    return cold + list(ChatMessageSerializer(hot.prefetch_related('user').order_by('timestamp'), many=True).data)
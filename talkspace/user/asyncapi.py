@@ -0,0 +1,119 @@
+"""
+Async DRF views for the chat hot path.
+
+DRF's APIView is sync only, so under Daphne every request to it occupies the
+thread-sensitive sync thread for its whole duration. AsyncAPIView runs the
+same request cycle (negotiation, authentication, permissions, throttles,
+exception handling) on the event loop: authenticators with an
+`aauthenticate()` are awaited, handlers are coroutines that use the async
+ORM, and JSON responses are rendered before they are returned so Django does
+not hand rendering back to the sync thread. Work that has no async form yet
+(transactions, file storage, the archive tiers) is wrapped in
+database_sync_to_async by the views themselves, so it runs on the monitored
+pool from user/monitor.py.
+"""
+import asyncio
+from django.core.handlers.asgi import ASGIRequest
+from rest_framework import exceptions
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from .metrics import database_sync_to_async
+
+
+def _rendered(response):
+    """An async `render` for a response that is already rendered."""
+    async def render():
+        return response
+    return render
+
+
+class AsyncAPIView(APIView):
+    """APIView whose handlers (get, post, ...) are all `async def`."""
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        under_asgi = isinstance(request._request, ASGIRequest)
+
+        try:
+            await self.ainitial(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        if (
+            under_asgi
+            and isinstance(self.response, Response)
+            and isinstance(self.response.accepted_renderer, JSONRenderer)
+        ):
+            self.response.render()
+            self.response.render = _rendered(self.response)
+        return self.response
+
+    async def ainitial(self, request, *args, **kwargs):
+        """initial() with authentication and throttles awaited."""
+        self.format_kwarg = self.get_format_suffix(**kwargs)
+
+        neg = self.perform_content_negotiation(request)
+        request.accepted_renderer, request.accepted_media_type = neg
+
+        version, scheme = self.determine_version(request, *args, **kwargs)
+        request.version, request.versioning_scheme = version, scheme
+
+        await self.aperform_authentication(request)
+        self.check_permissions(request)
+        await self.acheck_throttles(request)
+
+    async def aperform_authentication(self, request):
+        """
+        Request._authenticate() for async views. Authenticators without an
+        `aauthenticate()` run in the sync thread.
+        """
+        for authenticator in request.authenticators:
+            try:
+                if hasattr(authenticator, 'aauthenticate'):
+                    user_auth_tuple = await authenticator.aauthenticate(request)
+                else:
+                    user_auth_tuple = await database_sync_to_async(authenticator.authenticate)(request)
+            except exceptions.APIException:
+                request._not_authenticated()
+                raise
+
+            if user_auth_tuple is not None:
+                request._authenticator = authenticator
+                request.user, request.auth = user_auth_tuple
+                return
+
+        request._not_authenticated()
+
+    async def acheck_throttles(self, request):
+        """
+        check_throttles() for async views. Throttles with an
+        `aallow_request()` are awaited; the rest run in the sync thread.
+        """
+        throttle_durations = []
+        for throttle in self.get_throttles():
+            if hasattr(throttle, 'aallow_request'):
+                allowed = await throttle.aallow_request(request, self)
+            else:
+                allowed = await database_sync_to_async(throttle.allow_request)(request, self)
+            if not allowed:
+                throttle_durations.append(throttle.wait())
+
+        if throttle_durations:
+            durations = [duration for duration in throttle_durations if duration is not None]
+            self.throttled(request, max(durations, default=None))
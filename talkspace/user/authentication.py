@@ -0,0 +1,55 @@
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication as BaseJWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+from . import revocation
+
+
+class JWTAuthentication(BaseJWTAuthentication):
+    """
+    simplejwt's JWTAuthentication plus `aauthenticate()`, which async views
+    (user/asyncapi.py) await so the user lookup runs on the async ORM, and
+    a check that the access token has not been revoked (user/revocation.py).
+    """
+
+    def get_validated_token(self, raw_token):
+        validated_token = super().get_validated_token(raw_token)
+        if revocation.is_revoked(validated_token):
+            raise InvalidToken(_("Token has been revoked"))
+        return validated_token
+
+    async def aauthenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = super().get_validated_token(raw_token)
+        if await revocation.ais_revoked(validated_token):
+            raise InvalidToken(_("Token has been revoked"))
+        return await self.aget_user(validated_token), validated_token
+
+    async def aget_user(self, validated_token):
+        """Async variant of get_user()."""
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        try:
+            user = await self.user_model.objects.aget(**{api_settings.USER_ID_FIELD: user_id})
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
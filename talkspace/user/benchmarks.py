@@ -0,0 +1,379 @@
+"""
+Per-endpoint query-count and latency benchmarks.
+
+`seed(scale)` builds a fixture in which every list read by the endpoints in
+user/urls.py grows with `scale`: friends, pending requests, search hits,
+rooms and messages. ENDPOINTS describes one request per (URL name, method)
+against that fixture. `run_benchmarks` measures every endpoint at every
+scale and `check` turns the measurements into failures: query counts that
+grow with the data, and query counts or latency that regressed against a
+stored baseline.
+"""
+import time
+from contextlib import ExitStack, contextmanager
+from types import SimpleNamespace
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.tokens import default_token_generator
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connections, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from . import sharding
+from .cache import message_cache
+from .loadtest import percentiles
+from .models import AttachedFile, ChatMessage, ChatRoom, FriendRequest, RoomReadMarker, User
+
+PASSWORD = 'Bench#12345'
+ROOM_MEMBERS = 5
+# Latency differences below this are noise at the repeat counts used here.
+LATENCY_FLOOR_MS = 2.0
+
+
+def seed(scale, max_rooms=1000):
+    """
+    Create the benchmark fixture for `scale` and return it as a namespace.
+    The subject user has `scale` friends, `scale` pending requests, up to
+    `max_rooms` direct rooms and a group room holding `scale` messages.
+    """
+    password = make_password(PASSWORD)
+    subject = User.objects.create(
+        email='bench@bench.local', username='bench', first_name='Bench',
+        last_name='Subject', gender='OTHER', password=password,
+    )
+    stranger = User.objects.create(
+        email='stranger@bench.local', username='bench_stranger', first_name='Bench',
+        last_name='Stranger', gender='OTHER', password=password,
+    )
+
+    def make_users(kind):
+        users = [
+            User(
+                email=f"{kind}{i}@bench.local",
+                username=f"bench_{kind}{i}",
+                first_name=f"Bench{i}",
+                last_name=kind.title(),
+                gender='OTHER',
+                password=password,
+            )
+            for i in range(scale)
+        ]
+        for user in users:
+            user.set_contact_hashes()
+        User.objects.bulk_create(users, batch_size=5000)
+        return list(User.objects.filter(username__startswith=f"bench_{kind}").order_by('id'))
+
+    friends = make_users('friend')
+    requesters = make_users('requester')
+    FriendRequest.objects.bulk_create(
+        [
+            FriendRequest(sender=subject, receiver=friend, status='accepted') if i % 2
+            else FriendRequest(sender=friend, receiver=subject, status='accepted')
+            for i, friend in enumerate(friends)
+        ]
+        + [FriendRequest(sender=requester, receiver=subject, status='pending') for requester in requesters],
+        batch_size=5000,
+    )
+
+    Membership = ChatRoom.users.through
+    dm_rooms = ChatRoom.objects.bulk_create(
+        [ChatRoom(name=f"bench_dm_{i}") for i in range(min(scale, max_rooms))],
+        batch_size=5000,
+    )
+    room = ChatRoom.objects.create(name='bench_room', is_group_chat=True)
+    members = [subject] + friends[:ROOM_MEMBERS - 1]
+    Membership.objects.bulk_create(
+        [Membership(chatroom_id=dm.id, user_id=user_id) for dm, friend in zip(dm_rooms, friends)
+         for user_id in (subject.id, friend.id)]
+        + [Membership(chatroom_id=room.id, user_id=member.id) for member in members],
+        batch_size=5000,
+    )
+
+    for start in range(0, scale, 5000):
+        ChatMessage.objects.bulk_create([
+            ChatMessage(room=room, user=members[i % len(members)], message=f"bench message {i}")
+            for i in range(start, min(scale, start + 5000))
+        ])
+    own_messages = list(
+        ChatMessage.objects.filter(room=room, user=subject).order_by('-id').values_list('id', flat=True)[:10]
+    )
+    message = ChatMessage.objects.get(room=room, id=own_messages[0])
+    attached = AttachedFile(chat_message=message, name='bench.txt', size=1024, content_type='text/plain')
+    attached.file.save('bench.txt', ContentFile(b'x' * 1024), save=True)
+    RoomReadMarker.objects.bulk_create([
+        RoomReadMarker(user=member, room=room, last_read_message_id=message.id) for member in members
+    ])
+
+    return SimpleNamespace(
+        scale=scale,
+        subject=subject,
+        stranger=stranger,
+        friends=friends[:ROOM_MEMBERS],
+        pending=FriendRequest.objects.filter(receiver=subject, status='pending').order_by('id').first(),
+        room=room,
+        message=message,
+        own_messages=own_messages,
+        attached=attached,
+    )
+
+
+def _json(method, path, data=None):
+    return {'method': method, 'path': path, 'data': data, 'format': 'json'}
+
+
+def _reset_payload(f):
+    return {
+        'uid': urlsafe_base64_encode(force_bytes(f.subject.pk)),
+        'token': default_token_generator.make_token(f.subject),
+        'new_password': PASSWORD,
+        'confirm_password': PASSWORD,
+    }
+
+
+def _upload(f):
+    return {
+        'method': 'post',
+        'path': '/users/share-files-in-room/',
+        'data': {
+            'room_id': f.room.id,
+            'files': SimpleUploadedFile('bench.txt', b'x' * 1024, content_type='text/plain'),
+        },
+        'format': 'multipart',
+    }
+
+
+def _provision_upload(f):
+    return {
+        'method': 'post',
+        'path': '/users/provision/',
+        'data': {
+            'file': SimpleUploadedFile(
+                'users.csv',
+                b'email,first_name,last_name,gender\nprovisioned@bench.local,New,User,OTHER\n',
+                content_type='text/csv',
+            ),
+        },
+        'format': 'multipart',
+    }
+
+
+# (URL name, method) -> builder(fixture) returning one request. Builders run
+# outside the measured window, so any setup they do is not counted.
+ENDPOINTS = {
+    ('user_register', 'POST'): lambda f: _json('post', '/users/register/', {
+        'email': 'new@bench.local', 'username': 'bench_new', 'first_name': 'New',
+        'last_name': 'User', 'gender': 'OTHER', 'password': PASSWORD, 'confirm_password': PASSWORD,
+    }),
+    ('user_provision', 'POST'): _provision_upload,
+    ('user_login', 'POST'): lambda f: _json('post', '/users/login/', {'username': 'bench', 'password': PASSWORD}),
+    ('user_list', 'GET'): lambda f: _json('get', '/users/users-list/'),
+    ('user-detail', 'GET'): lambda f: _json('get', '/users/user-detail/'),
+    ('user-detail', 'PUT'): lambda f: _json('put', '/users/user-detail/', {'first_name': 'Benched'}),
+    ('user-detail', 'DELETE'): lambda f: _json('delete', '/users/user-detail/'),
+    ('user-search', 'GET'): lambda f: _json('get', '/users/user-search/Bench/?mutual_friends=1'),
+    ('contacts-match', 'POST'): lambda f: _json('post', '/users/contacts/match/', {
+        'emails': [f"requester{i}@bench.local" for i in range(10)] + [f"nobody{i}@bench.local" for i in range(10)],
+        'phone_numbers': ['+15550000000'],
+    }),
+    ('send-friend-requests-bulk', 'POST'): lambda f: _json(
+        'post', '/users/send-friend-requests/bulk/', {'user_ids': [f.stranger.id, f.friends[0].id, f.subject.id]}
+    ),
+    ('friend-suggestions', 'GET'): lambda f: _json('get', '/users/friend-suggestions/'),
+    ('send-friend-request', 'POST'): lambda f: _json(
+        'post', '/users/send-friend-request/', {'receiver': f.stranger.username}
+    ),
+    ('respond-to-friend-request', 'POST'): lambda f: _json(
+        'post', f'/users/respond-to-friend-request/{f.pending.id}/', {'action': 'accept'}
+    ),
+    ('pending_requests', 'GET'): lambda f: _json('get', '/users/pending-requests/'),
+    ('friend-list', 'GET'): lambda f: _json('get', '/users/friend-list/'),
+    ('user-logout', 'POST'): lambda f: _json(
+        'post', '/users/logout/', {'refresh': str(RefreshToken.for_user(f.subject))}
+    ),
+    ('chatroom-list-create', 'GET'): lambda f: _json('get', '/users/chatrooms/'),
+    ('chatroom-list-create', 'POST'): lambda f: _json(
+        'post', '/users/chatrooms/', {'user_ids': [f.friends[1].id, f.friends[2].id], 'name': 'bench_group'}
+    ),
+    ('chatroom-detail', 'GET'): lambda f: _json('get', f'/users/chatrooms/{f.room.id}/?limit=50'),
+    ('chatroom-detail', 'PUT'): lambda f: _json('put', f'/users/chatrooms/{f.room.id}/', {'name': 'bench_renamed'}),
+    ('chatroom-detail', 'DELETE'): lambda f: _json('delete', f'/users/chatrooms/{f.room.id}/'),
+    ('chatroom-receipts', 'GET'): lambda f: _json('get', f'/users/chatrooms/{f.room.id}/receipts/'),
+    ('chatmessage-list-create', 'GET'): lambda f: _json(
+        'get', f'/users/messages/?room_id={f.room.id}&limit=50'
+    ),
+    ('chatmessage-list-create', 'POST'): lambda f: _json(
+        'post', '/users/messages/', {'room_id': f.room.id, 'message': 'benchmark'}
+    ),
+    ('chatmessage-list-create', 'PUT'): lambda f: _json(
+        'put', '/users/messages/', {'message_id': f.message.id, 'message': 'edited'}
+    ),
+    ('chatmessage-list-create', 'DELETE'): lambda f: _json(
+        'delete', '/users/messages/', {'message_id': f.message.id}
+    ),
+    ('chatmessage-read', 'POST'): lambda f: _json(
+        'post', '/users/messages/read/', {'room_id': f.room.id, 'message_id': f.message.id}
+    ),
+    ('chatmessage-bulk-delete', 'POST'): lambda f: _json(
+        'post', '/users/messages/bulk-delete/', {'message_ids': f.own_messages}
+    ),
+    ('chatmessage-search', 'GET'): lambda f: _json('get', '/users/messages/search/?q=bench&limit=20'),
+    ('chatmessage-bulk-edit', 'POST'): lambda f: _json(
+        'post', '/users/messages/bulk-edit/',
+        {'edits': [{'id': message_id, 'message': 'edited'} for message_id in f.own_messages]},
+    ),
+    ('chatmessage-purge', 'POST'): lambda f: _json(
+        'post', '/users/messages/purge/', {'room_id': f.room.id, 'user_id': f.subject.id}
+    ),
+    ('offer', 'POST'): lambda f: _json(
+        'post', '/users/offer/', {'sdp': 'v=0', 'peer_id': 'bench_a', 'remote_peer_id': 'bench_b'}
+    ),
+    ('set_offer', 'POST'): lambda f: _json('post', '/users/offer/bench_b/set/', {'sdp': 'v=0', 'caller': 'bench_a'}),
+    ('get_offer', 'GET'): lambda f: _json('get', '/users/offer/bench_b/'),
+    ('answer', 'POST'): lambda f: _json('post', '/users/answer/', {'sdp': 'v=0', 'caller_peer_id': 'bench_b'}),
+    ('set_answer', 'POST'): lambda f: _json('post', '/users/answer/bench_b/set/', {'sdp': 'v=0'}),
+    ('get_answer', 'GET'): lambda f: _json('get', '/users/answer/bench_b/'),
+    ('ice_candidate', 'POST'): lambda f: _json(
+        'post', '/users/ice_candidate/', {'peer_id': 'bench_b', 'candidate': 'candidate:0'}
+    ),
+    ('get_ice_candidates', 'GET'): lambda f: _json('get', '/users/ice_candidate/bench_b/'),
+    ('share-files-in-room', 'POST'): _upload,
+    ('view_chat_message', 'GET'): lambda f: _json('get', f'/users/chat/{f.message.share_token}/'),
+    ('attachment-download', 'GET'): lambda f: _json('get', f'/users/files/{f.attached.id}/download/'),
+    ('forgot-password', 'POST'): lambda f: _json('post', '/users/forgot-password/', {'email': f.subject.email}),
+    ('reset-password', 'POST'): lambda f: _json('post', '/users/reset-password/', _reset_payload(f)),
+    ('metrics', 'GET'): lambda f: _json('get', '/users/metrics/'),
+}
+
+
+def url_names(patterns):
+    """Every named route in a urlpatterns list, including nested includes."""
+    names = set()
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            names |= url_names(pattern.url_patterns)
+        elif isinstance(pattern, URLPattern) and pattern.name:
+            names.add(pattern.name)
+    return names
+
+
+def uncovered(patterns):
+    """URL names in `patterns` that have no entry in ENDPOINTS."""
+    return sorted(url_names(patterns) - {name for name, _ in ENDPOINTS})
+
+
+@contextmanager
+def _rolled_back():
+    """A transaction on default and every message shard, rolled back on exit."""
+    with ExitStack() as stack:
+        for alias in settings.MESSAGE_SHARDS:
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+        for alias in settings.MESSAGE_SHARDS:
+            transaction.set_rollback(True, using=alias)
+    # Rolled-back rooms may leave directory entries for ids that get reused.
+    sharding.directory.forget()
+
+
+def _call(client, request):
+    """Issue one request; returns (status, queries, seconds, response_bytes)."""
+    kwargs = {'format': request['format']}
+    if request['data'] is not None:
+        kwargs['data'] = request['data']
+    with ExitStack() as stack:
+        captured = [
+            stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in settings.MESSAGE_SHARDS
+        ]
+        started = time.perf_counter()
+        response = getattr(client, request['method'])(request['path'], **kwargs)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        elapsed = time.perf_counter() - started
+    response.close()
+    return response.status_code, sum(len(queries) for queries in captured), elapsed, len(body)
+
+
+def measure(client, fixture, builder, method, repeat):
+    """
+    Run one endpoint `repeat` times (after a warm-up call), each call in
+    savepoints (on every message shard) that are rolled back so every call
+    sees the same data.
+    """
+    samples = []
+    for _ in range(repeat + 1):
+        request = builder(fixture)
+        with _rolled_back():
+            samples.append(_call(client, request))
+        if method != 'GET':
+            # The cache may hold rows the rollback just discarded.
+            message_cache.clear()
+    samples = samples[1:]
+    status, queries, _, size = samples[-1]
+    return {
+        'status': status,
+        'queries': queries,
+        'bytes': size,
+        'latency_ms': percentiles([elapsed for _, _, elapsed, _ in samples]),
+    }
+
+
+def run_benchmarks(scales, repeat=5, max_rooms=1000, only=None, progress=None):
+    """
+    Measure every ENDPOINTS entry (or those whose URL name is in `only`) at
+    each scale. Each scale is seeded inside a transaction that is rolled back
+    afterwards, so scales do not see each other's data.
+    """
+    report = {'scales': list(scales), 'repeat': repeat, 'endpoints': {}}
+    for scale in scales:
+        message_cache.clear()
+        with _rolled_back():
+            fixture = seed(scale, max_rooms)
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(fixture.subject)}")
+            for (name, method), builder in ENDPOINTS.items():
+                if only and name not in only:
+                    continue
+                result = measure(client, fixture, builder, method, repeat)
+                report['endpoints'].setdefault(f"{name} {method}", {})[str(scale)] = result
+                if progress:
+                    progress(scale, name, method, result)
+        message_cache.clear()
+    return report
+
+
+def check(report, baseline=None, tolerance=0.25, allow_growth=()):
+    """
+    Failures in `report`: server errors, query counts that grow with the
+    data size, and, against `baseline`, more queries, a different status or
+    a p50 latency more than `tolerance` (a fraction) higher at the same scale.
+    Endpoints whose URL name is in `allow_growth` are exempt from the
+    growth check.
+    """
+    failures = []
+    for endpoint, by_scale in report['endpoints'].items():
+        for scale, result in by_scale.items():
+            if result['status'] >= 500:
+                failures.append(f"{endpoint} @ {scale}: status {result['status']}")
+
+        counts = [(int(scale), result['queries']) for scale, result in by_scale.items()]
+        counts.sort()
+        if endpoint.rsplit(' ', 1)[0] not in allow_growth and any(q > counts[0][1] for _, q in counts):
+            trend = ", ".join(f"{scale}: {q}" for scale, q in counts)
+            failures.append(f"{endpoint}: query count grows with data size ({trend})")
+
+        previous = (baseline or {}).get('endpoints', {}).get(endpoint, {})
+        for scale, result in by_scale.items():
+            before = previous.get(scale)
+            if not before:
+                continue
+            if result['status'] != before['status']:
+                failures.append(f"{endpoint} @ {scale}: status {result['status']} != baseline {before['status']}")
+            if result['queries'] > before['queries']:
+                failures.append(f"{endpoint} @ {scale}: {result['queries']} queries > baseline {before['queries']}")
+            current, base = result['latency_ms']['p50'], before['latency_ms']['p50']
+            if current > base * (1 + tolerance) and current - base > LATENCY_FLOOR_MS:
+                failures.append(f"{endpoint} @ {scale}: p50 {current}ms > baseline {base}ms")
+    return failures
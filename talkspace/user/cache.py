@@ -0,0 +1,234 @@
+import json
+import threading
+from collections import OrderedDict, deque
+from django.conf import settings
+from . import metrics
+
+
+class _RoomBuffer:
+    __slots__ = ('messages', 'sizes', 'nbytes', 'exhausted')
+
+    def __init__(self, capacity, exhausted):
+        self.messages = deque(maxlen=capacity)
+        self.sizes = deque(maxlen=capacity)
+        self.nbytes = 0
+        # True when the buffer holds the room's entire (non-deleted) history.
+        self.exhausted = exhausted
+
+
+class RoomMessageCache:
+    """
+    Per-process LRU of hot rooms, each holding a ring buffer of its newest
+    serialized messages (oldest first).
+
+    A room only enters the cache when it is seeded from the database, after
+    which writes, edits and deletes keep it current. Cached messages carry
+    their author's name and avatar URL, so a profile change drops the rooms
+    holding that author's messages (forget_user()). Rooms are evicted least
+    recently used first when either `max_rooms` or `max_bytes` is exceeded.
+    With several worker processes each keeps its own copy, so only enable it
+    where one process serves a room's writes and reads.
+    """
+
+    def __init__(self, max_rooms, per_room, max_bytes):
+        self.max_rooms = max_rooms
+        self.per_room = per_room
+        self.max_bytes = max_bytes
+        self._rooms = OrderedDict()
+        self._write_seq = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_rooms > 0 and self.per_room > 0
+
+    def get_recent(self, room_id, limit):
+        """Newest `limit` messages of a room, or None on a cache miss."""
+        with self._lock:
+            buffer = self._rooms.get(room_id)
+            if buffer is None or (len(buffer.messages) < limit and not buffer.exhausted):
+                self.misses += 1
+                return None
+            self._rooms.move_to_end(room_id)
+            self.hits += 1
+            messages = list(buffer.messages)
+        return messages[-limit:] if limit < len(messages) else messages
+
+    def write_seq(self, room_id):
+        """Token to pass to seed(); a write to the room in between voids the seed."""
+        with self._lock:
+            return self._write_seq.get(room_id, 0)
+
+    def seed(self, room_id, messages, seq):
+        """Install the newest messages of a room loaded from the database."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._write_seq.get(room_id, 0) != seq:
+                return
+            self._drop(room_id)
+            buffer = _RoomBuffer(self.per_room, exhausted=len(messages) < self.per_room)
+            self._rooms[room_id] = buffer
+            for data in messages[-self.per_room:]:
+                self._push(buffer, data)
+            self._evict()
+
+    def append(self, room_id, data):
+        with self._lock:
+            self._bump(room_id)
+            buffer = self._rooms.get(room_id)
+            if buffer is None:
+                return
+            if len(buffer.messages) == buffer.messages.maxlen:
+                buffer.nbytes -= buffer.sizes[0]
+                self._nbytes -= buffer.sizes[0]
+                buffer.exhausted = False
+            self._push(buffer, data)
+            self._evict()
+
+    def update(self, room_id, message_id, data):
+        with self._lock:
+            self._bump(room_id)
+            buffer = self._rooms.get(room_id)
+            if buffer is None:
+                return
+            for index, cached in enumerate(buffer.messages):
+                if cached['id'] == message_id:
+                    size = len(json.dumps(data, default=str))
+                    delta = size - buffer.sizes[index]
+                    buffer.messages[index] = data
+                    buffer.sizes[index] = size
+                    buffer.nbytes += delta
+                    self._nbytes += delta
+                    break
+            self._evict()
+
+    def remove(self, room_id, message_ids):
+        with self._lock:
+            self._bump(room_id)
+            buffer = self._rooms.get(room_id)
+            if buffer is None:
+                return
+            message_ids = set(message_ids)
+            kept = [
+                (data, size) for data, size in zip(buffer.messages, buffer.sizes)
+                if data['id'] not in message_ids
+            ]
+            if len(kept) == len(buffer.messages):
+                return
+            removed = buffer.nbytes - sum(size for _, size in kept)
+            buffer.messages = deque((data for data, _ in kept), maxlen=self.per_room)
+            buffer.sizes = deque((size for _, size in kept), maxlen=self.per_room)
+            buffer.nbytes -= removed
+            self._nbytes -= removed
+
+    def invalidate(self, room_id):
+        with self._lock:
+            self._bump(room_id)
+            self._drop(room_id)
+
+    def forget_user(self, user_id):
+        """Drop every cached room holding a message by `user_id`, after a profile change."""
+        with self._lock:
+            for room_id, buffer in list(self._rooms.items()):
+                if any(data['user'] == user_id for data in buffer.messages):
+                    self._bump(room_id)
+                    self._drop(room_id)
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._write_seq.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'rooms': len(self._rooms),
+                'bytes': self._nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _bump(self, room_id):
+        self._write_seq[room_id] = self._write_seq.get(room_id, 0) + 1
+
+    def _push(self, buffer, data):
+        size = len(json.dumps(data, default=str))
+        buffer.messages.append(data)
+        buffer.sizes.append(size)
+        buffer.nbytes += size
+        self._nbytes += size
+
+    def _drop(self, room_id):
+        buffer = self._rooms.pop(room_id, None)
+        if buffer is not None:
+            self._nbytes -= buffer.nbytes
+
+    def _evict(self):
+        while self._rooms and (len(self._rooms) > self.max_rooms or self._nbytes > self.max_bytes):
+            _, buffer = self._rooms.popitem(last=False)
+            self._nbytes -= buffer.nbytes
+            self.evictions += 1
+
+
+message_cache = RoomMessageCache(
+    max_rooms=settings.MESSAGE_CACHE_ROOMS,
+    per_room=settings.MESSAGE_CACHE_PER_ROOM,
+    max_bytes=settings.MESSAGE_CACHE_MAX_BYTES,
+)
+
+metrics.Gauge(
+    'talkspace_message_cache_rooms', 'Rooms held in the hot-room message cache.',
+    lambda: [({}, message_cache.stats()['rooms'])],
+)
+metrics.Gauge(
+    'talkspace_message_cache_bytes', 'Approximate size of the cached messages.',
+    lambda: [({}, message_cache.stats()['bytes'])],
+)
+metrics.Gauge(
+    'talkspace_message_cache_events_total', 'Hot-room cache hits, misses and evictions.',
+    lambda: [({'event': event}, value) for event, value in message_cache.stats().items()
+             if event in ('hits', 'misses', 'evictions')],
+    metric_type='counter',
+)
+
+
+def recent_messages(room_id, limit):
+    """
+    Newest `limit` non-deleted messages of a room, serialized and oldest
+    first. Served from the ring buffer when the room is hot; otherwise the
+    newest MESSAGE_CACHE_PER_ROOM messages are loaded and cached.
+    """
+    cached = message_cache.get_recent(room_id, limit) if message_cache.enabled else None
+    if cached is not None:
+        return cached
+    return load_recent_messages(room_id, limit)
+
+
+def load_recent_messages(room_id, limit):
+    """The cache-miss half of recent_messages(): read, serialize and seed."""
+    from .models import ChatMessage
+    from .routers import reading_from_replica
+    from .serializers import ChatMessageSerializer
+
+    seq = message_cache.write_seq(room_id)
+    fetch = max(limit, message_cache.per_room)
+    messages = list(
+        ChatMessage.objects.filter(room_id=room_id, is_deleted=False)
+        .prefetch_related('user')
+        .order_by('-timestamp')[:fetch]
+    )
+    messages.reverse()
+    data = ChatMessageSerializer(messages, many=True).data
+    # A lagging replica could leave out recent writes, so only primary reads seed.
+    if limit <= message_cache.per_room and not reading_from_replica():
+        message_cache.seed(room_id, list(data), seq)
+    return data[-limit:]
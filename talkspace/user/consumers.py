@@ -1,22 +1,49 @@
+import asyncio
 import json
+from django.conf import settings
+from channels.consumer import get_handler_name
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import ChatRoom, ChatMessage
+from .models import ChatMessage, ChatRoom, RoomReadMarker
+from .media import avatar_url
+from . import metrics, monitor, ratelimit, routers
+from .sharding import RoomMoving
+from .cache import message_cache
+from .serializers import ChatMessageSerializer, MarkReadSerializer
 import datetime
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
         self.room_group_name = f'chat_{self.room_id}'
+        self.pending_read_id = 0
+        self.read_id = 0
+        self.read_flush_handle = None
+        self.joined = False
+
+        # Checked once here rather than per frame: message rows have no FK
+        # constraint on the room (see ChatMessage), so nothing else stops a
+        # frame from creating messages for a room that does not exist.
+        if not await ChatRoom.objects.filter(id=self.room_id, is_deleted=False).aexists():
+            await self.close()
+            return
 
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
         await self.accept()
+        self.joined = True
+        monitor.ensure_started()
+        monitor.socket_opened(self.room_group_name)
         # print(f"WebSocket connected for room: {self.room_id}")
 
     async def disconnect(self, close_code):
+        if not self.joined:
+            return
+        monitor.socket_closed(self.room_group_name)
+        if self.read_flush_handle is not None:
+            self.read_flush_handle.cancel()
+            await self.flush_read_receipt()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
@@ -24,14 +51,55 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # print(f"WebSocket disconnected for room: {self.room_id}, code: {close_code}")
 
     async def receive(self, text_data):
+        with metrics.track('ws', action='message') as sample:
+            await self.handle_frame(text_data, sample)
+
+    async def handle_frame(self, text_data, sample):
+        user = self.scope['user']
         text_data_json = json.loads(text_data)
+
+        if text_data_json.get('action') == 'read':
+            # Read receipts are coalesced, so they don't count against the limit.
+            sample.labels['action'] = 'read'
+            serializer = MarkReadSerializer(data={'room_id': self.room_id, 'message_id': text_data_json.get('message_id')})
+            if user.is_authenticated and serializer.is_valid():
+                self.mark_read(serializer.validated_data['message_id'])
+            return
+
+        retry_after = await self.check_rate_limit(user)
+        if retry_after:
+            sample.labels['action'] = 'rate_limited'
+            await self.send(text_data=json.dumps({
+                'message': 'Rate limit exceeded',
+                'first_name': 'System',
+                'last_name': '',
+                'user': None,
+                'profile_picture': None,
+                'timestamp': str(datetime.datetime.now()),
+                'retry_after': retry_after,
+                'action': 'error'
+            }))
+            return
+
         message = text_data_json['message']
-        user = self.scope['user']
 
-        msg = await self.create_message(user, message)
+        try:
+            msg = await self.create_message(user, message)
+        except RoomMoving as exc:
+            # The room is being moved between shards; the client may resend.
+            await self.send(text_data=json.dumps({
+                'message': str(exc.detail),
+                'first_name': 'System',
+                'last_name': '',
+                'user': None,
+                'profile_picture': None,
+                'timestamp': str(datetime.datetime.now()),
+                'action': 'error'
+            }))
+            return
 
         # Get profile picture URL if it exists
-        profile_picture_url = await self.get_profile_picture_url(user)
+        profile_picture_url = self.get_profile_picture_url(user)
 
         event = {
             'type': 'chat_message',
@@ -47,6 +115,68 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # print(f"Sending event from receive: {event}")
         await self.channel_layer.group_send(self.room_group_name, event)
 
+    async def check_rate_limit(self, user):
+        """Return seconds to wait if this frame exceeds the user or room limit, else 0."""
+        if user.is_authenticated:
+            ident = f"user:{user.id}"
+        else:
+            ident = f"ip:{(self.scope.get('client') or ['unknown'])[0]}"
+        for scope, key in (('chat_user', ident), ('chat_room', f"room:{self.room_id}")):
+            allowed, retry_after = await ratelimit.acheck(scope, key)
+            if not allowed:
+                return max(1, round(retry_after))
+        return 0
+
+    def mark_read(self, message_id):
+        """
+        Record that the client has read up to `message_id`. The marker is
+        written and broadcast at most once per READ_RECEIPT_WINDOW seconds,
+        however many read frames a fast scroller sends.
+        """
+        if message_id <= self.pending_read_id:
+            return
+        self.pending_read_id = message_id
+        if self.read_flush_handle is None:
+            self.read_flush_handle = asyncio.get_running_loop().call_later(
+                settings.READ_RECEIPT_WINDOW,
+                lambda: asyncio.ensure_future(self.flush_read_receipt()),
+            )
+
+    async def flush_read_receipt(self):
+        self.read_flush_handle = None
+        user = self.scope['user']
+        message_id = self.pending_read_id
+        if message_id <= self.read_id:
+            return
+        # As on the REST path, the message must belong to this room.
+        if not await ChatMessage.objects.filter(id=message_id, room_id=self.room_id).aexists():
+            self.pending_read_id = self.read_id
+            return
+        self.read_id = message_id
+        if await RoomReadMarker.aadvance(user.id, self.room_id, message_id):
+            await self.channel_layer.group_send(self.room_group_name, {
+                'type': 'read_receipt',
+                'user': user.id,
+                'message_id': message_id,
+            })
+
+    async def outbox_batch(self, event):
+        """Several outbox events for this room sent in one group_send, in order."""
+        for inner in event['events']:
+            await getattr(self, get_handler_name(inner))(inner)
+
+    async def chat_message_bulk(self, event):
+        """Relay a coalesced bulk edit/delete/purge as a single frame."""
+        payload = {key: value for key, value in event.items() if key != 'type'}
+        await self.send(text_data=json.dumps(payload))
+
+    async def read_receipt(self, event):
+        await self.send(text_data=json.dumps({
+            'action': 'read',
+            'user': event['user'],
+            'message_id': event['message_id'],
+        }))
+
     async def chat_message(self, event):
         # print(f"Received event in chat_message: {event}")
         try:
@@ -77,18 +207,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'action': 'error'  # Added action field for errors
             }))
 
-    @database_sync_to_async
-    def create_message(self, user, message):
-        room = ChatRoom.objects.get(id=self.room_id)
-        return ChatMessage.objects.create(
-            room=room,
-            user=user,
-            message=message
-        )
+    async def create_message(self, user, message):
+        msg = await ChatMessage.objects.acreate(room_id=self.room_id, user=user, message=message)
+        routers.pin_to_primary(user.id)
+        message_cache.append(int(self.room_id), ChatMessageSerializer(msg).data)
+        return msg
 
-    @database_sync_to_async
     def get_profile_picture_url(self, user):
         """Get the URL of the user's profile picture if it exists."""
-        if user.profile_picture:
-            return user.profile_picture.url
-        return None
\ No newline at end of file
+        return avatar_url(user)
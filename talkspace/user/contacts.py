@@ -0,0 +1,140 @@
+"""
+Contact-book matching and bulk friend requests.
+
+Clients upload phone numbers and emails from the device's address book,
+either as plain values or already hashed: SHA-256 hex of the normalized
+value (see normalize_phone / normalize_email), so the raw address book never
+has to leave the device. Each user stores the same hashes in indexed
+columns (User.phone_hash / User.email_hash, kept current by User.save), so
+both kinds are matched with `IN` lookups on those indexes, at most
+CONTACT_MATCH_BATCH_SIZE values per query and CONTACT_MATCH_MAX per request.
+
+send_friend_requests() then creates requests to many of the matched users
+with one bulk_create, relying on FriendRequest's unique (sender, receiver)
+constraint for requests created concurrently.
+"""
+import hashlib
+import re
+from django.conf import settings
+from django.db.models import Q
+
+
+def normalize_phone(value):
+    """'+1 (555) 000-1111' or '001 555 000 1111' -> '+15550001111'."""
+    value = (value or '').strip()
+    digits = re.sub(r'\D', '', value)
+    if not value.startswith('+') and digits.startswith('00'):
+        digits = digits[2:]
+    return f'+{digits}' if digits else ''
+
+
+def normalize_email(value):
+    return (value or '').strip().lower()
+
+
+def contact_hash(normalized):
+    return hashlib.sha256(normalized.encode()).hexdigest() if normalized else ''
+
+
+def _batches(values):
+    values = list(values)
+    size = settings.CONTACT_MATCH_BATCH_SIZE
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def match_contacts(user, phone_numbers=(), emails=(), phone_hashes=(), email_hashes=()):
+    """
+    Users (other than `user`) whose phone number or email is among the given
+    contacts. Returns a list of (contact, matched user) with `contact` as sent
+    by the client; a user matching several contacts is listed once.
+    """
+    from .models import User
+
+    # hash -> contact as sent
+    wanted = {'phone_hash': {}, 'email_hash': {}}
+    for value in phone_numbers:
+        wanted['phone_hash'].setdefault(contact_hash(normalize_phone(value)), value)
+    for value in emails:
+        wanted['email_hash'].setdefault(contact_hash(normalize_email(value)), value)
+    for value in phone_hashes:
+        wanted['phone_hash'].setdefault(value.lower(), value)
+    for value in email_hashes:
+        wanted['email_hash'].setdefault(value.lower(), value)
+
+    matches = {}
+    for field, contacts in wanted.items():
+        contacts.pop('', None)
+        for batch in _batches(contacts):
+            users = User.objects.filter(**{f'{field}__in': batch}, is_active=True).exclude(id=user.id)
+            for match in users:
+                matches.setdefault(match.id, (contacts[getattr(match, field)], match))
+    return list(matches.values())
+
+
+def friendship_status(user, other_ids):
+    """{user id: 'friends' | 'sent' | 'received'} for users with a pending or accepted request."""
+    from .models import FriendRequest
+
+    statuses = {}
+    requests = FriendRequest.objects.filter(
+        Q(sender=user, receiver_id__in=other_ids) | Q(receiver=user, sender_id__in=other_ids),
+        status__in=['pending', 'accepted'],
+    ).values_list('sender_id', 'receiver_id', 'status')
+    for sender_id, receiver_id, status in requests:
+        other = receiver_id if sender_id == user.id else sender_id
+        if status == 'accepted':
+            statuses[other] = 'friends'
+        else:
+            statuses.setdefault(other, 'sent' if sender_id == user.id else 'received')
+    return statuses
+
+
+def send_friend_requests(sender, user_ids):
+    """
+    Send friend requests from `sender` to each of `user_ids` in one insert.
+    Returns (created FriendRequests, [(user id, reason) skipped]).
+    """
+    from .models import FriendRequest, User
+
+    user_ids = list(dict.fromkeys(user_ids))
+    skipped = []
+    existing_users = set(User.objects.filter(id__in=user_ids, is_active=True).values_list('id', flat=True))
+    existing = {}
+    for sender_id, receiver_id, status in FriendRequest.objects.filter(
+        Q(sender=sender, receiver_id__in=user_ids) | Q(receiver=sender, sender_id__in=user_ids)
+    ).values_list('sender_id', 'receiver_id', 'status'):
+        other = receiver_id if sender_id == sender.id else sender_id
+        if status == 'accepted':
+            existing[other] = "You are already friends with this user."
+        elif sender_id == sender.id:
+            existing.setdefault(other, "Friend request already sent.")
+        elif status == 'pending':
+            existing.setdefault(other, "This user has already sent you a friend request.")
+
+    receivers = []
+    for user_id in user_ids:
+        if user_id == sender.id:
+            skipped.append((user_id, "You cannot send a friend request to yourself."))
+        elif user_id not in existing_users:
+            skipped.append((user_id, "User does not exist."))
+        elif user_id in existing:
+            skipped.append((user_id, existing[user_id]))
+        else:
+            receivers.append(user_id)
+    if not receivers:
+        return [], skipped
+
+    # A request for the same pair created since the query above (a double
+    # submit) is left to the unique constraint rather than failing the batch.
+    FriendRequest.objects.bulk_create(
+        [FriendRequest(sender=sender, receiver_id=user_id) for user_id in receivers],
+        ignore_conflicts=True,
+    )
+    created = list(
+        FriendRequest.objects.filter(sender=sender, receiver_id__in=receivers, status='pending')
+        .select_related('receiver').order_by('id')
+    )
+    created_ids = {request.receiver_id for request in created}
+    skipped.extend((user_id, "Friend request already sent.") for user_id in receivers if user_id not in created_ids)
+    return created, skipped
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+
+
+class TunedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    PBKDF2 with PASSWORD_PBKDF2_ITERATIONS rounds, for setting the work
+    factor per deployment. Select it with
+    PASSWORD_HASHER=user.hashers.TunedPBKDF2PasswordHasher; existing hashes
+    are upgraded on the next login. The algorithm name is unchanged, so
+    switching back to the stock hasher keeps every hash valid.
+    """
+
+    @property
+    def iterations(self):
+        return settings.PASSWORD_PBKDF2_ITERATIONS
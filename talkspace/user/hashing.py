@@ -0,0 +1,132 @@
+"""
+Password hashing off the request threads.
+
+PBKDF2 and friends are deliberately slow and hold the GIL, so a burst of
+logins hashed on the request thread stalls every other request in the
+process. Here hashing runs on a process pool of PASSWORD_HASH_WORKERS
+workers (0 hashes in a thread instead, for development). At most
+PASSWORD_HASH_QUEUE jobs may be in flight; beyond that callers get
+HashingBusy (503) rather than queueing without bound.
+
+`acheck_password()` also rehashes the password with the preferred hasher
+(the first of PASSWORD_HASHERS, see PASSWORD_HASHER) when the stored hash
+is outdated and PASSWORD_REHASH_ON_LOGIN is set, as Django's own
+User.check_password() does. `make_passwords()` hashes in bulk for user
+provisioning (user/provisioning.py).
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from django.contrib.auth import hashers
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class HashingBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Too many sign-ins in progress; try again shortly."
+    default_code = 'hashing_busy'
+
+
+def _setup_worker(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+
+
+def _make(raw_passwords):
+    return [hashers.make_password(raw_password) for raw_password in raw_passwords]
+
+
+def _check(raw_password, encoded, rehash):
+    """(valid, new_encoded or None), computed in a worker."""
+    new_encoded = []
+    valid = hashers.check_password(
+        raw_password, encoded, setter=new_encoded.append if rehash else None
+    )
+    if new_encoded:
+        # Django's setter receives the raw password; hash it while we are here.
+        return valid, hashers.make_password(new_encoded[0])
+    return valid, None
+
+
+class _HashPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                workers = settings.PASSWORD_HASH_WORKERS
+                if workers:
+                    # Spawn rather than fork: the server process runs threads
+                    # and an event loop that must not be copied.
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=workers,
+                        mp_context=multiprocessing.get_context('spawn'),
+                        initializer=_setup_worker,
+                        initargs=(os.environ['DJANGO_SETTINGS_MODULE'],),
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="talkspace-hash")
+                self._slots = threading.BoundedSemaphore(settings.PASSWORD_HASH_QUEUE)
+            return self._executor
+
+    def submit(self, func, *args, wait=False):
+        """Run `func(*args)` on the pool. Without `wait` a full queue raises HashingBusy."""
+        executor = self.executor()
+        if not self._slots.acquire(blocking=wait):
+            raise HashingBusy()
+        try:
+            try:
+                future = executor.submit(func, *args)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory); start a fresh pool.
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+                future = self.executor().submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+pool = _HashPool()
+
+
+async def acheck_password(user, raw_password):
+    """
+    Check `raw_password` against `user` without blocking the event loop or
+    the sync thread. Saves an upgraded hash when the stored one is outdated.
+    """
+    valid, new_encoded = await asyncio.wrap_future(
+        pool.submit(_check, raw_password, user.password, settings.PASSWORD_REHASH_ON_LOGIN)
+    )
+    if valid and new_encoded:
+        user.password = new_encoded
+        await user.asave(update_fields=['password'])
+    return valid
+
+
+def make_passwords(raw_passwords):
+    """
+    Hash many passwords (None gives an unusable password) spread over the
+    pool's workers, in order. For batch jobs: blocks, waiting for queue
+    slots rather than raising HashingBusy.
+    """
+    raw_passwords = list(raw_passwords)
+    chunk_size = max(1, -(-len(raw_passwords) // max(1, settings.PASSWORD_HASH_WORKERS)))
+    futures = [
+        pool.submit(_make, raw_passwords[start:start + chunk_size], wait=True)
+        for start in range(0, len(raw_passwords), chunk_size)
+    ]
+    return [encoded for future in futures for encoded in future.result()]
+
@@ -0,0 +1,35 @@
+import time
+from contextvars import ContextVar
+from channels.layers import InMemoryChannelLayer as BaseInMemoryChannelLayer
+from . import metrics
+
+# Set while group_send runs, so the per-member sends it makes aren't counted twice.
+_in_group_send = ContextVar('talkspace_in_group_send', default=False)
+
+
+class TimedChannelLayerMixin:
+    """Records send/group_send time in the metrics and the current request's Timing."""
+
+    async def send(self, channel, message):
+        if _in_group_send.get():
+            return await super().send(channel, message)
+        started = time.perf_counter()
+        with metrics.timed('channel'):
+            await super().send(channel, message)
+        metrics.CHANNEL_LAYER_SEND.observe(time.perf_counter() - started, operation='send')
+
+    async def group_send(self, group, message):
+        token = _in_group_send.set(True)
+        started = time.perf_counter()
+        try:
+            with metrics.timed('channel'):
+                await super().group_send(group, message)
+        finally:
+            _in_group_send.reset(token)
+        metrics.CHANNEL_LAYER_SEND.observe(time.perf_counter() - started, operation='group_send')
+
+
+class InMemoryChannelLayer(TimedChannelLayerMixin, BaseInMemoryChannelLayer):
+    def queue_depths(self):
+        """Undelivered messages per channel, for user/monitor.py."""
+        return {channel: queue.qsize() for channel, queue in list(self.channels.items())}
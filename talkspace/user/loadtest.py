@@ -0,0 +1,263 @@
+import asyncio
+import json
+import time
+from itertools import cycle
+from urllib.parse import parse_qsl, urlsplit
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import AsyncClient
+from .routing import websocket_urlpatterns
+
+
+def percentiles(samples):
+    """Summary of latency samples (seconds) in milliseconds."""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+
+class _WsClient:
+    def __init__(self, app, user, room_id, expected):
+        self.user = user
+        self.room_id = room_id
+        self.expected = expected
+        self.communicator = WebsocketCommunicator(app, f"/ws/chat/{room_id}/")
+        self.communicator.scope['user'] = user
+        self.received = 0
+
+    async def listen(self, sent_at, echo_latency, fanout_delay, timeout):
+        while self.received < self.expected:
+            try:
+                frame = json.loads(await self.communicator.receive_from(timeout=timeout))
+            except asyncio.TimeoutError:
+                return
+            now = time.perf_counter()
+            nonce = frame.get('message', '')
+            if nonce not in sent_at:
+                continue
+            self.received += 1
+            sender_id, started = sent_at[nonce]
+            (echo_latency if sender_id == self.user.id else fanout_delay).append(now - started)
+
+
+async def run_ws_scenario(room_members, messages_per_client, send_interval=0.0, timeout=30.0):
+    """
+    Connect one socket per (room, member) pair, have every socket send
+    `messages_per_client` messages, and measure how long each message takes
+    to come back to its sender (echo latency) and to reach the other members
+    of the room (fan-out delay).
+    """
+    app = URLRouter(websocket_urlpatterns)
+    clients = []
+    for room_id, users in room_members.items():
+        expected = len(users) * messages_per_client
+        clients.extend(_WsClient(app, user, room_id, expected) for user in users)
+
+    await asyncio.gather(*(client.communicator.connect() for client in clients))
+
+    sent_at, echo_latency, fanout_delay = {}, [], []
+    listeners = [
+        asyncio.create_task(client.listen(sent_at, echo_latency, fanout_delay, timeout))
+        for client in clients
+    ]
+
+    async def send(client, number):
+        for seq in range(messages_per_client):
+            nonce = f"lt:{number}:{seq}"
+            sent_at[nonce] = (client.user.id, time.perf_counter())
+            await client.communicator.send_to(text_data=json.dumps({'message': nonce}))
+            if send_interval:
+                await asyncio.sleep(send_interval)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(client, number) for number, client in enumerate(clients)))
+    await asyncio.gather(*listeners)
+    duration = time.perf_counter() - started
+
+    await asyncio.gather(*(client.communicator.disconnect() for client in clients), return_exceptions=True)
+
+    deliveries = sum(client.received for client in clients)
+    expected = sum(client.expected for client in clients)
+    return {
+        'clients': len(clients),
+        'messages_sent': len(sent_at),
+        'deliveries': deliveries,
+        'lost_deliveries': expected - deliveries,
+        'duration_s': round(duration, 3),
+        'messages_per_s': round(len(sent_at) / duration, 2) if duration else 0,
+        'deliveries_per_s': round(deliveries / duration, 2) if duration else 0,
+        'echo_latency_ms': percentiles(echo_latency),
+        'fanout_delay_ms': percentiles(fanout_delay),
+    }
+
+
+async def run_ws_ramp(room_members, steps, messages_per_client, latency_budget_ms, timeout=30.0):
+    """
+    Run the WebSocket scenario with the first `n` rooms for each `n` in
+    `steps` and report the most concurrent sockets whose p95 echo latency
+    stayed within `latency_budget_ms` without losing deliveries.
+    """
+    rooms = list(room_members.items())
+    results, ceiling = [], 0
+    for count in steps:
+        report = await run_ws_scenario(dict(rooms[:count]), messages_per_client, timeout=timeout)
+        p95 = report['echo_latency_ms'].get('p95', 0)
+        within = report['lost_deliveries'] == 0 and p95 <= latency_budget_ms
+        results.append({
+            'rooms': min(count, len(rooms)),
+            'sockets': report['clients'],
+            'echo_p95_ms': p95,
+            'lost_deliveries': report['lost_deliveries'],
+            'within_budget': within,
+        })
+        if not within:
+            break
+        ceiling = report['clients']
+    return {'latency_budget_ms': latency_budget_ms, 'max_sockets': ceiling, 'steps': results}
+
+
+def _request(client, template, context, token):
+    """
+    One request for a path template. Templates may start with a method, e.g.
+    'POST /users/messages/?room_id={room_id}&message=hi'; for anything but
+    GET the query string is sent as the JSON body instead.
+    """
+    method, _, path = template.rpartition(' ')
+    method = (method or 'GET').upper()
+    path = path.format(**context)
+    headers = {'Authorization': f'Bearer {token}'}
+    if method == 'GET':
+        return client.get(path, headers=headers)
+    url = urlsplit(path)
+    return client.generic(
+        method, url.path, json.dumps(dict(parse_qsl(url.query))),
+        content_type='application/json', headers=headers,
+    )
+
+
+async def _run_rest_path(client, template, tokens, requests, concurrency):
+    latencies, errors = [], 0
+    identities = cycle(tokens)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        token, context = next(identities)
+        async with semaphore:
+            started = time.perf_counter()
+            response = await _request(client, template, context, token)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    duration = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'errors': errors,
+        'requests_per_s': round(requests / duration, 2) if duration else 0,
+        'latency_ms': percentiles(latencies),
+    }
+
+
+async def run_rest_scenario(paths, tokens, requests_per_path, concurrency):
+    """
+    Issue `requests_per_path` authenticated requests against each path
+    template through the in-process ASGI handler with `concurrency` requests
+    in flight. `tokens` is a list of (access_token, context) pairs whose
+    context fills the path template, e.g. '/users/messages/?room_id={room_id}'.
+    """
+    client = AsyncClient()
+    return {
+        template: await _run_rest_path(client, template, tokens, requests_per_path, concurrency)
+        for template in paths
+    }
+
+
+async def run_rest_ramp(paths, tokens, steps, requests_per_path, latency_budget_ms):
+    """
+    Run each REST path at every concurrency in `steps` and report, per path,
+    the highest concurrency one worker sustained with p95 latency within
+    `latency_budget_ms` and no errors, and the requests/s it reached there.
+    """
+    client = AsyncClient()
+    report = {}
+    for template in paths:
+        results, ceiling, throughput = [], 0, 0
+        for concurrency in steps:
+            result = await _run_rest_path(client, template, tokens, max(requests_per_path, concurrency), concurrency)
+            p95 = result['latency_ms'].get('p95', 0)
+            within = result['errors'] == 0 and p95 <= latency_budget_ms
+            results.append({
+                'concurrency': concurrency,
+                'requests_per_s': result['requests_per_s'],
+                'p95_ms': p95,
+                'errors': result['errors'],
+                'within_budget': within,
+            })
+            if not within:
+                break
+            ceiling, throughput = concurrency, result['requests_per_s']
+        report[template] = {
+            'latency_budget_ms': latency_budget_ms,
+            'max_concurrency': ceiling,
+            'requests_per_s': throughput,
+            'steps': results,
+        }
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """
+    Regressions of `report` against `baseline`: throughput, socket ceiling or
+    REST concurrency ceiling that dropped, or p95/p99 latency that rose, by
+    more than `tolerance` (a fraction).
+    """
+    regressions = []
+
+    def check_lower(name, current, previous):
+        if previous and current < previous * (1 - tolerance):
+            regressions.append(f"{name}: {current} < baseline {previous}")
+
+    def check_higher(name, current, previous):
+        if previous and current > previous * (1 + tolerance):
+            regressions.append(f"{name}: {current} > baseline {previous}")
+
+    ws, base_ws = report.get('ws'), baseline.get('ws')
+    if ws and base_ws:
+        check_lower('ws.messages_per_s', ws['messages_per_s'], base_ws.get('messages_per_s'))
+        for metric in ('echo_latency_ms', 'fanout_delay_ms'):
+            for q in ('p95', 'p99'):
+                check_higher(f"ws.{metric}.{q}", ws[metric].get(q, 0), base_ws.get(metric, {}).get(q))
+
+    ramp, base_ramp = report.get('ws_ramp'), baseline.get('ws_ramp')
+    if ramp and base_ramp:
+        check_lower('ws_ramp.max_sockets', ramp['max_sockets'], base_ramp.get('max_sockets'))
+
+    for path, result in report.get('rest', {}).items():
+        previous = baseline.get('rest', {}).get(path)
+        if not previous:
+            continue
+        check_lower(f"{path} requests_per_s", result['requests_per_s'], previous.get('requests_per_s'))
+        for q in ('p95', 'p99'):
+            check_higher(f"{path} latency {q}", result['latency_ms'].get(q, 0), previous['latency_ms'].get(q))
+
+    for path, result in report.get('rest_ramp', {}).items():
+        previous = baseline.get('rest_ramp', {}).get(path)
+        if not previous:
+            continue
+        check_lower(f"{path} max_concurrency", result['max_concurrency'], previous.get('max_concurrency'))
+    return regressions
@@ -0,0 +1,111 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from django.conf import settings
+from django.core.mail import get_connection
+
+logger = logging.getLogger(__name__)
+
+_queue = queue.Queue()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+class _MailWorker(threading.Thread):
+    """
+    Drains the outbound queue over one persistent SMTP connection.
+
+    Messages are taken in batches of up to EMAIL_BATCH_SIZE and sent one at a
+    time, so after a failure only the unsent ones are retried (with
+    exponential backoff, on a fresh connection) and nothing is delivered
+    twice. The connection is closed after EMAIL_IDLE_TIMEOUT seconds without
+    mail so the server does not drop it under us.
+    """
+
+    def __init__(self, index):
+        super().__init__(name=f"talkspace-mail-{index}", daemon=True)
+        self.connection = None
+
+    def run(self):
+        while True:
+            try:
+                first = _queue.get(timeout=settings.EMAIL_IDLE_TIMEOUT)
+            except queue.Empty:
+                self._close()
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + settings.EMAIL_BATCH_WINDOW
+            while len(batch) < settings.EMAIL_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._send(batch)
+            for _ in batch:
+                _queue.task_done()
+
+    def _send(self, batch):
+        sent = attempt = 0
+        while sent < len(batch):
+            try:
+                if self.connection is None:
+                    self.connection = get_connection(fail_silently=False)
+                    self.connection.open()
+                self.connection.send_messages([batch[sent]])
+                sent += 1
+                attempt = 0
+            except Exception:
+                self._close()
+                if attempt == settings.EMAIL_MAX_RETRIES:
+                    logger.exception("Giving up on an email to %s after %d attempts", batch[sent].to, attempt + 1)
+                    sent += 1
+                    attempt = 0
+                    continue
+                delay = min(settings.EMAIL_RETRY_BACKOFF * 2 ** attempt, 60)
+                logger.warning("Email failed, retrying in %.1fs (%d of %d sent)", delay, sent, len(batch))
+                time.sleep(delay)
+                attempt += 1
+
+    def _close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+
+def _ensure_workers():
+    with _workers_lock:
+        if not _workers:
+            for index in range(settings.EMAIL_POOL_SIZE):
+                worker = _MailWorker(index)
+                worker.start()
+                _workers.append(worker)
+            # The workers are daemon threads; let queued mail go out on exit.
+            atexit.register(flush, settings.EMAIL_SHUTDOWN_TIMEOUT)
+
+
+def enqueue(message):
+    """Queue an EmailMessage for background delivery and return immediately."""
+    _ensure_workers()
+    _queue.put(message)
+
+
+def flush(timeout=None):
+    """Block until every queued message has been handed to the backend."""
+    if not _workers:
+        return
+    if timeout is None:
+        _queue.join()
+        return
+    deadline = time.monotonic() + timeout
+    while _queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
@@ -0,0 +1,24 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from user.archive import archive_messages
+
+
+class Command(BaseCommand):
+    help = (
+        "Move old, soft-deleted and deleted-room messages from the hot "
+        "ChatMessage table into the archive tier."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.ARCHIVE_AFTER_DAYS,
+            help="Archive messages older than this many days.",
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        horizon = timezone.now() - timedelta(days=options['days'])
+        moved = archive_messages(horizon, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Archived {moved} messages older than {horizon:%Y-%m-%d}."))
@@ -0,0 +1,88 @@
+import json
+import os
+import tempfile
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.test import override_settings
+from user import urls
+from user.benchmarks import check, run_benchmarks, uncovered
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark every endpoint in user/urls.py against seeded data of "
+        "growing size in a throwaway test database. Records query count, "
+        "latency and response size per scale, and fails when query counts "
+        "grow with the data or regress against a saved baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scales', default='10,1000,100000',
+            help="Comma-separated fixture sizes (rows per list).",
+        )
+        parser.add_argument('--repeat', type=int, default=5, help="Measured calls per endpoint and scale.")
+        parser.add_argument('--max-rooms', type=int, default=1000, help="Cap on direct rooms per fixture.")
+        parser.add_argument('--endpoint', action='append', dest='only', help="URL name to run (repeatable).")
+        parser.add_argument(
+            '--allow-growth', action='append', default=[],
+            help="URL name whose query count may grow with data (repeatable).",
+        )
+        parser.add_argument('--baseline', help="JSON baseline file to compare against.")
+        parser.add_argument('--save-baseline', action='store_true', help="Write this run to --baseline.")
+        parser.add_argument('--tolerance', type=float, default=0.25)
+        parser.add_argument('--output', help="Also write the report to this file.")
+
+    def handle(self, *args, **options):
+        try:
+            scales = sorted({int(scale) for scale in options['scales'].split(',')})
+        except ValueError:
+            raise CommandError("--scales must be a comma-separated list of integers.")
+        missing = uncovered(urls.urlpatterns)
+        if missing and not options['only']:
+            raise CommandError("No benchmark defined for: " + ", ".join(missing))
+
+        def progress(scale, name, method, result):
+            self.stdout.write(
+                f"{scale:>7} {name} {method}: {result['status']} "
+                f"{result['queries']}q {result['latency_ms']['p50']}ms {result['bytes']}B"
+            )
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            # Each call runs in a transaction that is rolled back afterwards;
+            # pool threads have their own connections and would not see it.
+            # The revocation filter's periodic resync would add a query to
+            # whichever call happens to cross REVOCATION_SYNC_INTERVAL.
+            with tempfile.TemporaryDirectory() as media_root, override_settings(
+                MEDIA_ROOT=media_root, RATE_LIMITS={}, SENDFILE_BACKEND=None, SYNC_THREAD_POOL_SIZE=0,
+                REVOCATION_SYNC_INTERVAL=float('inf'),
+            ):
+                report = run_benchmarks(
+                    scales, options['repeat'], options['max_rooms'], options['only'], progress,
+                )
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+
+        baseline_path, baseline = options['baseline'], None
+        if baseline_path and options['save_baseline']:
+            with open(baseline_path, 'w') as f:
+                f.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Saved baseline to {baseline_path}"))
+        elif baseline_path:
+            if not os.path.exists(baseline_path):
+                raise CommandError(f"Baseline {baseline_path} does not exist; run with --save-baseline.")
+            with open(baseline_path) as f:
+                baseline = json.load(f)
+
+        failures = check(report, baseline, options['tolerance'], options['allow_growth'])
+        if failures:
+            raise CommandError("Benchmark failures:\n  " + "\n  ".join(failures))
+        self.stdout.write(self.style.SUCCESS("No query growth or regressions."))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from user.revocation import compact
+
+
+class Command(BaseCommand):
+    help = "Delete expired access-token revocations and expired simplejwt outstanding/blacklisted tokens."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        deleted = compact(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted['revoked']} revocations, {deleted['outstanding']} outstanding "
+            f"and {deleted['blacklisted']} blacklisted tokens."
+        ))
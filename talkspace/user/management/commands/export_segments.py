@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from user.models import ArchivedChatMessage
+from user.segments import export_room
+
+
+class Command(BaseCommand):
+    help = "Pack archived messages into compressed, immutable segment files per room."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', type=int, help="Only export this room.")
+        parser.add_argument(
+            '--min-messages', type=int, default=1000,
+            help="Skip rooms with fewer archived messages than this.",
+        )
+
+    def handle(self, *args, **options):
+        rooms = ArchivedChatMessage.objects.values('room_id').annotate(count=Count('id'))
+        if options['room']:
+            rooms = rooms.filter(room_id=options['room'])
+        else:
+            rooms = rooms.filter(count__gte=options['min_messages'])
+
+        for row in rooms.order_by('room_id'):
+            segment = export_room(row['room_id'])
+            if segment is not None:
+                self.stdout.write(
+                    f"Room {segment.room_id}: {segment.message_count} messages -> "
+                    f"{segment.path} ({segment.size_bytes} bytes, {segment.codec})"
+                )
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import os
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from user.loadtest import compare, run_rest_ramp, run_rest_scenario, run_ws_ramp, run_ws_scenario
+from user.models import ChatRoom
+from .seed_data import PREFIX
+
+DEFAULT_PATHS = [
+    '/users/chatrooms/',
+    '/users/chatrooms/{room_id}/?limit=50',
+    '/users/messages/?room_id={room_id}&limit=50',
+    'POST /users/messages/?room_id={room_id}&message=loadtest',
+    '/users/friend-list/',
+    '/users/pending-requests/',
+    '/users/user-search/Load1/',
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive the WebSocket chat and REST endpoints in process with many "
+        "simulated clients against data from `seed_data`, report throughput "
+        "and latency percentiles, and compare against a saved baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=50, help="Rooms to open sockets in.")
+        parser.add_argument('--messages', type=int, default=5, help="Messages sent per socket.")
+        parser.add_argument('--send-interval', type=float, default=0.0)
+        parser.add_argument('--requests', type=int, default=200, help="Requests per REST path.")
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--path', action='append', dest='paths', help="REST path template (repeatable).")
+        parser.add_argument(
+            '--ramp', help="Comma-separated room counts; find the socket ceiling by stepping through them.",
+        )
+        parser.add_argument(
+            '--rest-ramp',
+            help="Comma-separated concurrency levels; find each REST path's concurrency ceiling per worker.",
+        )
+        parser.add_argument(
+            '--latency-budget', type=float, default=250.0,
+            help="p95 latency (ms) a --ramp or --rest-ramp step must stay within.",
+        )
+        parser.add_argument('--skip-ws', action='store_true')
+        parser.add_argument('--skip-rest', action='store_true')
+        parser.add_argument(
+            '--with-rate-limits', action='store_true',
+            help="Keep RATE_LIMITS active; by default they are disabled for the run.",
+        )
+        parser.add_argument('--baseline', help="JSON baseline file to compare against.")
+        parser.add_argument('--save-baseline', action='store_true', help="Write this run to --baseline.")
+        parser.add_argument('--tolerance', type=float, default=0.2)
+        parser.add_argument('--output', help="Also write the report to this file.")
+
+    def handle(self, *args, **options):
+        try:
+            options['ramp'] = [int(step) for step in options['ramp'].split(',')] if options['ramp'] else []
+        except ValueError:
+            raise CommandError("--ramp must be a comma-separated list of room counts.")
+        try:
+            options['rest_ramp'] = (
+                [int(step) for step in options['rest_ramp'].split(',')] if options['rest_ramp'] else []
+            )
+        except ValueError:
+            raise CommandError("--rest-ramp must be a comma-separated list of concurrency levels.")
+        rooms = list(
+            ChatRoom.objects.filter(name__startswith=PREFIX, is_deleted=False)
+            .prefetch_related('users')[:max([options['rooms']] + options['ramp'])]
+        )
+        if not rooms:
+            raise CommandError("No load-test rooms found; run `manage.py seed_data` first.")
+        room_members = {room.id: list(room.users.all()) for room in rooms}
+        tokens = [] if options['skip_rest'] else [
+            (str(RefreshToken.for_user(user).access_token), {'room_id': room_id})
+            for room_id, users in list(room_members.items())[:options['rooms']]
+            for user in users
+        ]
+
+        overrides = {} if options['with_rate_limits'] else {'RATE_LIMITS': {}}
+        with override_settings(**overrides):
+            report = asyncio.run(self.run(room_members, tokens, options))
+
+        output = json.dumps(report, indent=2)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+
+        baseline_path = options['baseline']
+        if not baseline_path:
+            return
+        if options['save_baseline']:
+            with open(baseline_path, 'w') as f:
+                f.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Saved baseline to {baseline_path}"))
+            return
+        if not os.path.exists(baseline_path):
+            raise CommandError(f"Baseline {baseline_path} does not exist; run with --save-baseline.")
+        with open(baseline_path) as f:
+            regressions = compare(report, json.load(f), options['tolerance'])
+        if regressions:
+            raise CommandError("Performance regressions:\n  " + "\n  ".join(regressions))
+        self.stdout.write(self.style.SUCCESS("No regressions against baseline."))
+
+    async def run(self, room_members, tokens, options):
+        report = {}
+        if not options['skip_ws']:
+            report['ws'] = await run_ws_scenario(
+                dict(list(room_members.items())[:options['rooms']]), options['messages'], options['send_interval']
+            )
+        if options['ramp']:
+            report['ws_ramp'] = await run_ws_ramp(
+                room_members, options['ramp'], options['messages'], options['latency_budget']
+            )
+        if not options['skip_rest']:
+            report['rest'] = await run_rest_scenario(
+                options['paths'] or DEFAULT_PATHS, tokens, options['requests'], options['concurrency']
+            )
+            if options['rest_ramp']:
+                report['rest_ramp'] = await run_rest_ramp(
+                    options['paths'] or DEFAULT_PATHS, tokens, options['rest_ramp'],
+                    options['requests'], options['latency_budget'],
+                )
+        return report
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from user.sharding import move_room
+
+
+class Command(BaseCommand):
+    help = "Move a room's messages and attachments to another shard while the room stays online."
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_id', type=int)
+        parser.add_argument('shard', help="Target alias from MESSAGE_SHARDS, e.g. shard2.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        try:
+            moved = move_room(
+                options['room_id'], options['shard'],
+                batch_size=options['batch_size'], log=self.stdout.write,
+            )
+        except ValueError as exc:
+            raise CommandError(exc)
+        self.stdout.write(self.style.SUCCESS(
+            f"Room {options['room_id']} is on {options['shard']} ({moved} messages moved)."
+        ))
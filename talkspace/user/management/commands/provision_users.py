@@ -0,0 +1,24 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from user.provisioning import FORMATS, guess_format, provision
+
+
+class Command(BaseCommand):
+    help = "Create users in bulk from a CSV or NDJSON file (columns as for registration, password optional)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS, help="Defaults to the file extension.")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        input_format = options['format'] or guess_format(options['path'])
+        if not input_format:
+            raise CommandError("Cannot tell the format from the file name; pass --format.")
+        with open(options['path'], 'rb') as stream:
+            report = provision(stream, input_format, batch_size=options['batch_size'], log=self.stdout.write)
+        for skipped in report['skipped']:
+            self.stderr.write(f"Line {skipped['line']}: {json.dumps(skipped['errors'])}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {report['created']} users, skipped {len(report['skipped'])} rows."
+        ))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from user.models import User
+from user.suggestions import rebuild
+
+
+class Command(BaseCommand):
+    help = "Recompute stored friend-of-friend suggestions (all users with friends, or --user)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users', help="User id (repeatable).")
+
+    def handle(self, *args, **options):
+        user_ids = options['users'] or (
+            User.objects.filter(
+                Q(sent_requests__status='accepted') | Q(received_requests__status='accepted')
+            ).distinct().order_by('id').values_list('id', flat=True)
+        )
+        users = stored = 0
+        for user_id in user_ids:
+            stored += rebuild(user_id)
+            users += 1
+        self.stdout.write(self.style.SUCCESS(f"Stored {stored} suggestions for {users} users."))
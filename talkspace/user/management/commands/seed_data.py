@@ -0,0 +1,103 @@
+import random
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from user.models import ChatMessage, ChatRoom, FriendRequest, User
+
+PREFIX = 'lt_'
+WORDS = (
+    "hey hello sure thanks see you soon tomorrow meeting lunch call later "
+    "what when where ok great sounds good on my way almost there"
+).split()
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate load-test data: users, accepted friendships, rooms and "
+        "messages. All generated usernames start with 'lt_'."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--friends-per-user', type=int, default=20)
+        parser.add_argument('--rooms', type=int, default=200)
+        parser.add_argument('--members', type=int, default=5, help="Users per room.")
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--password', default='LoadTest#123')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--clear', action='store_true', help="Delete previously generated data first.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+
+        if options['clear']:
+            ChatRoom.objects.filter(name__startswith=PREFIX).delete()
+            User.objects.filter(username__startswith=PREFIX).delete()
+
+        # One hash for every generated user; hashing per user would dominate.
+        password = make_password(options['password'])
+        start = User.objects.filter(username__startswith=PREFIX).count()
+        users = [
+            User(
+                email=f"{PREFIX}{i}@loadtest.local",
+                username=f"{PREFIX}{i}",
+                first_name=f"Load{i}",
+                last_name="Tester",
+                gender='OTHER',
+                password=password,
+            )
+            for i in range(start, start + options['users'])
+        ]
+        for user in users:
+            user.set_contact_hashes()
+        User.objects.bulk_create(users, batch_size=batch_size)
+        user_ids = list(User.objects.filter(username__startswith=PREFIX).values_list('id', flat=True))
+        self.stdout.write(f"Users: {len(user_ids)}")
+
+        friendships = set()
+        for sender in user_ids:
+            for receiver in rng.sample(user_ids, min(options['friends_per_user'], len(user_ids))):
+                if sender != receiver and (receiver, sender) not in friendships:
+                    friendships.add((sender, receiver))
+        FriendRequest.objects.bulk_create(
+            [FriendRequest(sender_id=s, receiver_id=r, status='accepted') for s, r in friendships],
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+        self.stdout.write(f"Friendships: {len(friendships)}")
+
+        with transaction.atomic():
+            offset = ChatRoom.objects.filter(name__startswith=PREFIX).count()
+            rooms = ChatRoom.objects.bulk_create(
+                [
+                    ChatRoom(name=f"{PREFIX}room_{offset + i}", is_group_chat=options['members'] > 2)
+                    for i in range(options['rooms'])
+                ],
+                batch_size=batch_size,
+            )
+            Membership = ChatRoom.users.through
+            members = {}
+            links = []
+            for room in rooms:
+                members[room.id] = rng.sample(user_ids, min(options['members'], len(user_ids)))
+                links.extend(Membership(chatroom_id=room.id, user_id=user_id) for user_id in members[room.id])
+            Membership.objects.bulk_create(links, batch_size=batch_size)
+        self.stdout.write(f"Rooms: {len(rooms)}")
+
+        room_ids = list(members)
+        created = 0
+        while room_ids and created < options['messages']:
+            batch = []
+            for _ in range(min(batch_size, options['messages'] - created)):
+                room_id = rng.choice(room_ids)
+                batch.append(ChatMessage(
+                    room_id=room_id,
+                    user_id=rng.choice(members[room_id]),
+                    message=" ".join(rng.choices(WORDS, k=rng.randint(2, 15))),
+                ))
+            ChatMessage.objects.bulk_create(batch)
+            created += len(batch)
+            self.stdout.write(f"Messages: {created}", ending='\r')
+        self.stdout.write(self.style.SUCCESS(f"\nSeeded {created} messages."))
@@ -0,0 +1,252 @@
+import hashlib
+import io
+import logging
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from PIL import Image, ImageOps
+from .cache import message_cache
+
+logger = logging.getLogger(__name__)
+
+# Square avatar variants, keyed by the name the serializers ask for.
+AVATAR_SIZES = {
+    'small': 48,
+    'medium': 128,
+    'large': 256,
+}
+THUMBNAIL_SIZE = 320
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+JPEG_QUALITY = 80
+VERSION_LENGTH = 12
+
+BASE83_CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+
+def _base83(value, length):
+    result = ""
+    for i in range(1, length + 1):
+        digit = (value // (83 ** (length - i))) % 83
+        result += BASE83_CHARS[digit]
+    return result
+
+
+def _srgb_to_linear(value):
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def _linear_to_srgb(value):
+    v = max(0.0, min(1.0, value))
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value, exp):
+    return math.copysign(abs(value) ** exp, value)
+
+
+def blurhash_encode(image, x_components=4, y_components=3):
+    """
+    Encode a PIL image as a BlurHash placeholder string.
+
+    The image is downscaled to 32x32 first; a placeholder never needs more
+    detail than that and it keeps the DCT below a millisecond.
+    """
+    image = image.convert('RGB')
+    image.thumbnail((32, 32))
+    width, height = image.size
+    pixels = [tuple(_srgb_to_linear(c) for c in p) for p in image.getdata()]
+
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            normalisation = 1 if i == 0 and j == 0 else 2
+            r = g = b = 0.0
+            for y in range(height):
+                basis_y = math.cos(math.pi * j * y / height)
+                row = y * width
+                for x in range(width):
+                    basis = normalisation * math.cos(math.pi * i * x / width) * basis_y
+                    pr, pg, pb = pixels[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = 1 / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+
+    if ac:
+        actual_max = max(abs(c) for factor in ac for c in factor)
+        quantised_max = max(0, min(82, int(actual_max * 166 - 0.5)))
+        max_value = (quantised_max + 1) / 166
+    else:
+        quantised_max, max_value = 0, 1
+    result += _base83(quantised_max, 1)
+
+    dc_value = (_linear_to_srgb(dc[0]) << 16) + (_linear_to_srgb(dc[1]) << 8) + _linear_to_srgb(dc[2])
+    result += _base83(dc_value, 4)
+
+    for r, g, b in ac:
+        quant = [
+            max(0, min(18, int(_sign_pow(c / max_value, 0.5) * 9 + 9.5)))
+            for c in (r, g, b)
+        ]
+        result += _base83(quant[0] * 19 * 19 + quant[1] * 19 + quant[2], 2)
+    return result
+
+
+def _save_jpeg(image, name):
+    """Write `image` to storage as a JPEG and return the stored name."""
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def _variant_name(original_name, directory, suffix):
+    stem = os.path.splitext(os.path.basename(original_name))[0]
+    return f"{directory}/{stem}_{suffix}.jpg"
+
+
+def process_profile_picture(user_id):
+    """Generate the square avatar variants and blurhash for a user."""
+    from .models import User
+
+    user = User.objects.filter(id=user_id).only('id', 'profile_picture').first()
+    if user is None or not user.profile_picture:
+        return
+
+    with user.profile_picture.open('rb') as f:
+        image = ImageOps.exif_transpose(Image.open(f))
+        image.load()
+
+    variants = {}
+    for size_name, size in AVATAR_SIZES.items():
+        resized = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        variants[size_name] = _save_jpeg(
+            resized,
+            _variant_name(user.profile_picture.name, f"profile_pictures/variants/{user.id}", size_name),
+        )
+
+    # Only commit the result if the picture was not replaced meanwhile.
+    updated = User.objects.filter(id=user.id, profile_picture=user.profile_picture.name).update(
+        avatar_variants=variants,
+        avatar_blurhash=blurhash_encode(image),
+    )
+    if updated:
+        # Cached messages still link the original picture instead of the variant.
+        message_cache.forget_user(user.id)
+
+
+def _extract_poster_frame(path):
+    """Grab a frame one second into a video with ffmpeg, if it is installed."""
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        logger.info("ffmpeg not available, skipping poster frame for %s", path)
+        return None
+
+    with tempfile.NamedTemporaryFile(suffix='.jpg') as out:
+        result = subprocess.run(
+            [ffmpeg, '-y', '-loglevel', 'error', '-ss', '1', '-i', path,
+             '-frames:v', '1', out.name],
+            capture_output=True,
+            timeout=60,
+        )
+        if result.returncode != 0 or not os.path.getsize(out.name):
+            logger.warning("ffmpeg failed for %s: %s", path, result.stderr.decode(errors='replace'))
+            return None
+        image = Image.open(out.name)
+        image.load()
+        return image
+
+
+def process_attached_file(attached_file_id):
+    """Generate a thumbnail (or video poster frame) and blurhash for an upload."""
+    from . import sharding
+    from .models import AttachedFile
+
+    attached = sharding.find(AttachedFile.objects.filter(id=attached_file_id))
+    if attached is None:
+        return
+
+    name = attached.file.name
+    content_type = attached.content_type or ''
+    if name.lower().endswith(VIDEO_EXTENSIONS) or content_type.startswith('video/'):
+        try:
+            path = attached.file.path
+        except NotImplementedError:
+            # Remote storage: ffmpeg needs a local file.
+            return
+        image = _extract_poster_frame(path)
+        if image is None:
+            return
+        variant = 'poster'
+    elif content_type.startswith('image/'):
+        with attached.file.open('rb') as f:
+            try:
+                image = ImageOps.exif_transpose(Image.open(f))
+                image.load()
+            except (OSError, Image.DecompressionBombError):
+                logger.warning("Could not decode image attachment %s", attached.id)
+                return
+        variant = 'thumbnail'
+    else:
+        return
+
+    image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.LANCZOS)
+    stored = _save_jpeg(image, _variant_name(name, "chat_files/variants", variant))
+    AttachedFile.objects.filter(id=attached.id).using(attached._state.db).update(
+        variants={variant: stored},
+        blurhash=blurhash_encode(image),
+    )
+
+
+def content_version(file):
+    """Short content hash of an uploaded file, used to version its URLs."""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()[:VERSION_LENGTH]
+
+
+def avatar_url(user, size='small'):
+    """
+    URL of the requested avatar variant, falling back to the original while
+    the variants are still being generated.
+
+    The URL carries the picture's content hash, so it only changes when the
+    picture does and can be cached as immutable.
+    """
+    if not user.profile_picture:
+        return None
+    variant = (user.avatar_variants or {}).get(size)
+    url = default_storage.url(variant) if variant else user.profile_picture.url
+    if user.avatar_version:
+        url = f"{url}?v={user.avatar_version}"
+    return url
+
+
+def attachment_data(attached):
+    """Serialized representation of an AttachedFile, including its previews."""
+    variants = attached.variants or {}
+    return {
+        "name": attached.name,
+        "size": attached.size,
+        "url": attached.file.url,
+        "download_url": reverse('attachment-download', args=[attached.id]),
+        "content_type": attached.content_type,
+        "thumbnail": default_storage.url(variants['thumbnail']) if 'thumbnail' in variants else None,
+        "poster": default_storage.url(variants['poster']) if 'poster' in variants else None,
+        "blurhash": attached.blurhash or None,
+    }
@@ -0,0 +1,304 @@
+"""
+Request and WebSocket frame instrumentation.
+
+`track()` wraps one HTTP request or WS frame. For a METRICS_SAMPLE_RATE
+fraction of them it installs a Timing in a context variable, and the hooks
+below add to it wherever the work happens, including the worker threads of
+sync_to_async (which copy the context):
+
+  * db        -- every SQL query, via a connection execute wrapper
+  * serialize -- TimedSerializerMixin.to_representation and TimedJSONRenderer
+  * channel   -- channel-layer send/group_send (see user/layers.py)
+  * pool      -- time a database_sync_to_async call waited for a thread
+
+Durations are aggregated into Prometheus histograms served by `render()`,
+and HTTP responses carry them in a Server-Timing header.
+"""
+import functools
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from rest_framework.renderers import JSONRenderer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PHASES = ('db', 'serialize', 'channel', 'pool')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_timing = ContextVar('talkspace_timing', default=None)
+_submitted = ContextVar('talkspace_pool_submitted', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items())) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(dict(key))} {value}" for key, value in values]
+
+
+class Gauge(_Metric):
+    """
+    A metric whose values come from `collect()`, a callable returning
+    [(labels, value)]. Pass metric_type='counter' for running totals kept
+    elsewhere.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help_text, collect, metric_type='gauge'):
+        super().__init__(name, help_text)
+        self.collect = collect
+        self.type = metric_type
+
+    def render(self):
+        return self.header() + [f"{self.name}{_format_labels(labels)} {value}" for labels, value in self.collect()]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        lines = self.header()
+        for key, (counts, total, count) in values:
+            labels = dict(key)
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class Timing:
+    """Per-request (or per-frame) durations and counts, keyed by phase."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = {}
+        self.counts = {}
+        self.serializing = False
+
+    def add(self, phase, seconds, count=1):
+        self.durations[phase] = self.durations.get(phase, 0.0) + seconds
+        self.counts[phase] = self.counts.get(phase, 0) + count
+
+    def server_timing(self):
+        parts = []
+        for phase in PHASES:
+            if phase in self.durations:
+                part = f"{phase};dur={self.durations[phase] * 1000:.2f}"
+                if phase == 'db':
+                    part += f';desc="{self.counts[phase]} queries"'
+                parts.append(part)
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.2f}")
+        return ', '.join(parts)
+
+
+class Sample:
+    """What `track()` yields: labels to fill in, and the Timing if sampled."""
+
+    def __init__(self, labels, timing):
+        self.labels = labels
+        self.timing = timing
+
+
+def _histograms(kind, subject):
+    return (
+        Histogram(f"talkspace_{kind}_duration_seconds", f"Wall time per {subject}."),
+        Histogram(f"talkspace_{kind}_phase_duration_seconds", f"Time per phase of a sampled {subject}."),
+        Histogram(f"talkspace_{kind}_db_queries", f"SQL queries per sampled {subject}.", COUNT_BUCKETS),
+    )
+
+
+_TRACKED = {
+    'http': _histograms('http_request', 'HTTP request'),
+    'ws': _histograms('ws_frame', 'WebSocket frame'),
+}
+CHANNEL_LAYER_SEND = Histogram(
+    'talkspace_channel_layer_send_duration_seconds', 'Time spent in channel-layer send/group_send.'
+)
+
+
+@contextmanager
+def track(kind, **labels):
+    """
+    Measure one unit of work of `kind` ('http' or 'ws'). Labels may be
+    added to the yielded Sample before the block exits.
+    """
+    if not settings.METRICS_ENABLED:
+        yield Sample(labels, None)
+        return
+    timing = Timing() if random.random() < settings.METRICS_SAMPLE_RATE else None
+    token = _timing.set(timing)
+    sample = Sample(labels, timing)
+    started = time.perf_counter()
+    try:
+        yield sample
+    finally:
+        _timing.reset(token)
+        duration, phases, queries = _TRACKED[kind]
+        duration.observe(time.perf_counter() - started, **sample.labels)
+        if timing is not None:
+            for phase, seconds in timing.durations.items():
+                phases.observe(seconds, phase=phase, **sample.labels)
+            queries.observe(timing.counts.get('db', 0), **sample.labels)
+
+
+@contextmanager
+def timed(phase):
+    """Add the duration of the block to `phase` of the current Timing, if any."""
+    timing = _timing.get()
+    if timing is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(phase, time.perf_counter() - started)
+
+
+def query_timer(execute, sql, params, many, context):
+    timing = _timing.get()
+    if timing is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timing.add('db', time.perf_counter() - started)
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """connection_created receiver that times every query on the connection."""
+    if query_timer not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_timer)
+
+
+class TimedSerializerMixin:
+    """
+    Counts to_representation() towards the 'serialize' phase. Nested
+    serializers are not counted twice; lazy queries they trigger are
+    counted under 'db' as well.
+    """
+
+    def to_representation(self, instance):
+        timing = _timing.get()
+        if timing is None or timing.serializing:
+            return super().to_representation(instance)
+        timing.serializing = True
+        started = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            timing.serializing = False
+            timing.add('serialize', time.perf_counter() - started)
+
+
+class TimedJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with timed('serialize'):
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+def _record_wait(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        timing, submitted = _timing.get(), _submitted.get()
+        if timing is not None and submitted is not None:
+            timing.add('pool', time.perf_counter() - submitted)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+class TimedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """
+    database_sync_to_async that records how long each call waited for a
+    thread. Calls run on the bounded pool from user/monitor.py unless
+    SYNC_THREAD_POOL_SIZE is 0, which keeps asgiref's single
+    thread-sensitive thread.
+    """
+
+    def __init__(self, func, thread_sensitive=None, executor=None):
+        if thread_sensitive is None:
+            from .monitor import sync_executor
+            executor = executor or sync_executor()
+            thread_sensitive = executor is None
+        super().__init__(_record_wait(func), thread_sensitive=thread_sensitive, executor=executor)
+
+    async def __call__(self, *args, **kwargs):
+        token = _submitted.set(time.perf_counter())
+        try:
+            return await super().__call__(*args, **kwargs)
+        finally:
+            _submitted.reset(token)
+
+
+database_sync_to_async = TimedDatabaseSyncToAsync
@@ -1,10 +1,13 @@
 from urllib.parse import parse_qs
 from typing import Optional
-from channels.db import database_sync_to_async
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.contrib.auth.models import AnonymousUser, User
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils.functional import SimpleLazyObject, empty
 from rest_framework.authtoken.models import Token
 import logging
+from django.conf import settings
+from . import metrics, monitor, routers
 
 logger = logging.getLogger(__name__)
 
@@ -85,8 +88,7 @@ class TokenAuthMiddleware:
 
         return token_list[0] if token_list else None
 
-    @database_sync_to_async
-    def _authenticate_user(self, token_key: str) -> User:
+    async def _authenticate_user(self, token_key: str) -> User:
         """
         Authenticate the user using the provided token key.
 
@@ -97,7 +99,7 @@ class TokenAuthMiddleware:
             User: The authenticated user or AnonymousUser if authentication fails
         """
         try:
-            token = Token.objects.select_related('user').get(key=token_key)
+            token = await Token.objects.select_related('user').aget(key=token_key)
             # Optionally check token expiration if you have a custom implementation
             # if token.expires_at and token.expires_at < timezone.now():
             #     logger.warning(f"Expired token attempted: {token_key}")
@@ -114,4 +116,81 @@ class TokenAuthMiddleware:
             return AnonymousUser()
         except Exception as e:
             logger.error(f"Error authenticating token: {str(e)}")
-            return AnonymousUser()
\ No newline at end of file
+            return AnonymousUser()
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request into the Prometheus metrics (see user/metrics.py)
+    and, for sampled requests, adds a Server-Timing header with the db,
+    serialize, channel and pool breakdown. Place it first in MIDDLEWARE.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with metrics.track('http', method=request.method) as sample:
+            response = self.get_response(request)
+            self.finish(request, response, sample)
+        return response
+
+    async def __acall__(self, request):
+        monitor.ensure_started()
+        with metrics.track('http', method=request.method) as sample:
+            response = await self.get_response(request)
+            self.finish(request, response, sample)
+        return response
+
+    def finish(self, request, response, sample):
+        match = request.resolver_match
+        sample.labels['route'] = (match.url_name or match.route) if match else 'unmatched'
+        sample.labels['status'] = response.status_code
+        if sample.timing is not None and settings.METRICS_SERVER_TIMING:
+            response['Server-Timing'] = sample.timing.server_timing()
+
+
+class ReplicaPinningMiddleware:
+    """
+    Pins the user of every unsafe (write) request to the primary database
+    for REPLICA_PIN_SECONDS, so their next reads see their own writes (see
+    user/routers.py). DRF sets request.user on the underlying request, so
+    JWT users are seen here after the view has run.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        self.pin(request)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        self.pin(request)
+        return response
+
+    def pin(self, request):
+        if not settings.DATABASE_REPLICAS or request.method in ('GET', 'HEAD', 'OPTIONS'):
+            return
+        user = getattr(request, 'user', None)
+        if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+            # The session user was never loaded, so this was no user's write.
+            return
+        if user is not None and user.is_authenticated:
+            routers.pin_to_primary(user.id)
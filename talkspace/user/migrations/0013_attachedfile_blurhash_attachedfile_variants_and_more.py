@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-19 04:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0012_chatmessage_is_deleted'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachedfile',
+            name='blurhash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='attachedfile',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='avatar_blurhash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='avatar_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
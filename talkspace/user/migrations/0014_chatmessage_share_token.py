@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0013_attachedfile_blurhash_attachedfile_variants_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='share_token',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+    ]
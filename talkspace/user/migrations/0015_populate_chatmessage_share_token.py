@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-19 09:12
+
+import uuid
+from django.db import migrations
+
+
+def gen_share_tokens(apps, schema_editor):
+    ChatMessage = apps.get_model('user', 'ChatMessage')
+    messages = ChatMessage.objects.filter(share_token__isnull=True).only('id')
+    batch = []
+    for message in messages.iterator(chunk_size=2000):
+        message.share_token = uuid.uuid4()
+        batch.append(message)
+        if len(batch) >= 2000:
+            ChatMessage.objects.bulk_update(batch, ['share_token'])
+            batch = []
+    if batch:
+        ChatMessage.objects.bulk_update(batch, ['share_token'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0014_chatmessage_share_token'),
+    ]
+
+    operations = [
+        migrations.RunPython(gen_share_tokens, reverse_code=migrations.RunPython.noop),
+    ]
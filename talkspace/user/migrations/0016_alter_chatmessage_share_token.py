@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-19 09:12
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0015_populate_chatmessage_share_token'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='share_token',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.4 on 2026-10-19 04:20
+
+import hashlib
+from django.db import migrations, models
+
+
+def backfill_avatar_versions(apps, schema_editor):
+    User = apps.get_model('user', 'User')
+    users = User.objects.exclude(profile_picture='').exclude(profile_picture__isnull=True)
+    for user in users.only('id', 'profile_picture').iterator():
+        digest = hashlib.sha256()
+        try:
+            with user.profile_picture.open('rb') as f:
+                for chunk in f.chunks():
+                    digest.update(chunk)
+        except (FileNotFoundError, OSError):
+            continue
+        User.objects.filter(id=user.id).update(avatar_version=digest.hexdigest()[:12])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0016_alter_chatmessage_share_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='avatar_version',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.RunPython(backfill_avatar_versions, reverse_code=migrations.RunPython.noop),
+    ]
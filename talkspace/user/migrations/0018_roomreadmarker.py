@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-19 04:23
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0017_user_avatar_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomReadMarker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_markers', to='user.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_markers', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'last_read_message_id'], name='user_roomre_room_id_819b35_idx')],
+                'unique_together': {('user', 'room')},
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.4 on 2026-10-19 04:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0018_roomreadmarker'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedChatMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('message', models.TextField()),
+                ('timestamp', models.DateTimeField()),
+                ('month', models.DateField()),
+                ('is_read', models.BooleanField(default=False)),
+                ('is_deleted', models.BooleanField(default=False)),
+                ('share_token', models.UUIDField(editable=False, unique=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='user.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['timestamp'],
+                'indexes': [models.Index(fields=['room', 'id'], name='user_archiv_room_id_bdf8ab_idx'), models.Index(fields=['month'], name='user_archiv_month_5bd431_idx')],
+            },
+        ),
+    ]
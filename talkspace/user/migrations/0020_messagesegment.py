@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-19 04:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0019_archivedchatmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255, unique=True)),
+                ('first_id', models.BigIntegerField()),
+                ('last_id', models.BigIntegerField()),
+                ('first_timestamp', models.DateTimeField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('codec', models.CharField(max_length=10)),
+                ('size_bytes', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='user.chatroom')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'first_id'], name='user_messag_room_id_6fc2ad_idx')],
+            },
+        ),
+    ]
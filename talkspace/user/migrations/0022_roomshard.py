@@ -0,0 +1,34 @@
+# Generated by Django 5.1.4 on 2026-10-19 05:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0021_outboxevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomShard',
+            fields=[
+                ('room', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='shard', serialize=False, to='user.chatroom')),
+                ('shard', models.CharField(max_length=64)),
+                ('moving', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='room',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='user.chatroom'),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.4 on 2026-10-19 05:17
+
+from django.db import migrations, models
+from user.contacts import contact_hash, normalize_email, normalize_phone
+
+
+def backfill_contact_hashes(apps, schema_editor):
+    User = apps.get_model('user', 'User')
+    users = User.objects.only('id', 'email', 'phone_number')
+    batch = []
+    for user in users.iterator(chunk_size=2000):
+        user.phone_hash = contact_hash(normalize_phone(user.phone_number))
+        user.email_hash = contact_hash(normalize_email(user.email))
+        batch.append(user)
+        if len(batch) >= 2000:
+            User.objects.bulk_update(batch, ['phone_hash', 'email_hash'])
+            batch = []
+    if batch:
+        User.objects.bulk_update(batch, ['phone_hash', 'email_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0023_revokedaccesstoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='email_hash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='phone_hash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(backfill_contact_hashes, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-19 05:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0024_user_contact_hashes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FriendSuggestion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mutual_friends', models.PositiveIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('candidate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friend_suggestions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-mutual_friends'], name='user_friend_user_id_57659a_idx')],
+                'unique_together': {('user', 'candidate')},
+            },
+        ),
+    ]
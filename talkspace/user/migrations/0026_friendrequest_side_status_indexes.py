@@ -0,0 +1,21 @@
+# Generated by Django 5.1.4 on 2026-10-19 05:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0025_friendsuggestion'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['sender', 'status'], name='user_friend_sender__03992d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['receiver', 'status'], name='user_friend_receive_887ab0_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-19 05:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0026_friendrequest_side_status_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='suggestions_built_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -1,6 +1,10 @@
-from django.db import models
+import uuid
+from django.db import connections, models, router
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.core.validators import FileExtensionValidator
+from django.utils import timezone
+from . import contacts, sharding
+from .metrics import database_sync_to_async
 
 class UserManager(BaseUserManager):
     def create_user(self, email=None, phone_number=None, password=None, **extra_fields):
@@ -14,6 +18,36 @@ class UserManager(BaseUserManager):
         user.save(using=self._db)
         return user
 
+    def for_login(self, email=None, phone_number=None, username=None):
+        """
+        Users matching the first identifier given: email, then phone number,
+        then username. Each is a unique column, so this is one index lookup.
+        """
+        for field, value in (('email', email), ('phone_number', phone_number), ('username', username)):
+            if value:
+                return self.filter(**{field: value})
+        return self.none()
+
+    def taken_identifiers(self, **candidates):
+        """
+        Which of the candidate values are already used, e.g.
+        taken_identifiers(email=[...], username=[...]) -> {'email': {...},
+        'username': {...}}. One query, answered from the unique indexes.
+        """
+        candidates = {field: {value for value in values if value} for field, values in candidates.items()}
+        taken = {field: set() for field in candidates}
+        query = models.Q()
+        for field, values in candidates.items():
+            if values:
+                query |= models.Q(**{f'{field}__in': values})
+        if not query:
+            return taken
+        for row in self.filter(query).values_list(*candidates):
+            for field, value in zip(candidates, row):
+                if value in candidates[field]:
+                    taken[field].add(value)
+        return taken
+
     def create_superuser(self, email, password=None, **extra_fields):
         extra_fields.setdefault('is_staff', True)
         extra_fields.setdefault('is_superuser', True)
@@ -42,10 +76,20 @@ class User(AbstractBaseUser, PermissionsMixin):
         blank=True,
         validators=[FileExtensionValidator(allowed_extensions=['jpg', 'jpeg', 'png'])]
     )
+    avatar_variants = models.JSONField(default=dict, blank=True)
+    avatar_blurhash = models.CharField(max_length=64, blank=True, default='')
+    avatar_version = models.CharField(max_length=16, blank=True, default='')
     gender = models.CharField(max_length=10, choices=Gender.choices)
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
     date_joined = models.DateTimeField(auto_now_add=True)
+    # SHA-256 of the normalized phone number / email, for contact matching
+    # (see user/contacts.py). Maintained by save().
+    phone_hash = models.CharField(max_length=64, blank=True, default='', db_index=True, editable=False)
+    email_hash = models.CharField(max_length=64, blank=True, default='', db_index=True, editable=False)
+    # When user/suggestions.py last rebuilt this user's FriendSuggestions;
+    # null until the first rebuild, even if incremental updates added rows.
+    suggestions_built_at = models.DateTimeField(null=True, blank=True, editable=False)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
@@ -65,6 +109,17 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     class Meta:
         db_table = 'user'
+
+    def set_contact_hashes(self):
+        self.phone_hash = contacts.contact_hash(contacts.normalize_phone(self.phone_number))
+        self.email_hash = contacts.contact_hash(contacts.normalize_email(self.email))
+
+    def save(self, *args, **kwargs):
+        self.set_contact_hashes()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'phone_number', 'email'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'phone_hash', 'email_hash'}
+        super().save(*args, **kwargs)
     
     def get_friends(self):
         """Retrieve friends of the user."""
@@ -88,6 +143,11 @@ class FriendRequest(models.Model):
 
     class Meta:
         unique_together = ('sender', 'receiver')
+        # Friend lists and pending requests filter on one side plus status.
+        indexes = [
+            models.Index(fields=['sender', 'status']),
+            models.Index(fields=['receiver', 'status']),
+        ]
 
 class ChatRoom(models.Model):
     name = models.CharField(max_length=255, unique=True, blank=True)
@@ -112,6 +172,9 @@ class ChatRoom(models.Model):
                 self.name = f"room_{self.id}"
             super().save(*args, **kwargs)
 
+        if is_new:
+            sharding.place_room(self)
+
     @classmethod
     @classmethod
     def get_or_create_dm(cls, user1, user2):
@@ -148,13 +211,18 @@ class ChatRoom(models.Model):
         room.save()
         return room
 
-class ChatMessage(models.Model):
-    room = models.ForeignKey(ChatRoom, related_name='messages', on_delete=models.CASCADE)
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+class ChatMessage(sharding.ShardedModelMixin, models.Model):
+    # Messages may live on a shard without the room and user rows; hard
+    # deletes are cascaded to the other shards by sharding.room_deleted/user_deleted.
+    room = models.ForeignKey(ChatRoom, related_name='messages', on_delete=models.CASCADE, db_constraint=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     message = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
     is_deleted = models.BooleanField(default=False)
+    share_token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+
+    objects = sharding.ShardedManager()
 
     def __str__(self):
         return f"Message by {self.user} in {self.room.name}"
@@ -162,13 +230,190 @@ class ChatMessage(models.Model):
     class Meta:
         ordering = ['timestamp']
 
-class AttachedFile(models.Model):
+class AttachedFile(sharding.ShardedModelMixin, models.Model):
     chat_message = models.ForeignKey(ChatMessage, on_delete=models.CASCADE, related_name="files")
     file = models.FileField(upload_to="chat_files/%Y/%m/%d/")
     name = models.CharField(max_length=255)
     size = models.BigIntegerField()
     content_type = models.CharField(max_length=100, null=True)
-    
+    variants = models.JSONField(default=dict, blank=True)
+    blurhash = models.CharField(max_length=64, blank=True, default='')
+
+    objects = sharding.ShardedManager()
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+class RoomReadMarker(models.Model):
+    """
+    Per-(user, room) read high-water mark: every message in the room with an
+    id up to `last_read_message_id` has been read by `user`.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_markers')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_markers')
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'room')
+        indexes = [models.Index(fields=['room', 'last_read_message_id'])]
+
+    @classmethod
+    def advance(cls, user_id, room_id, message_id):
+        """
+        Move the marker forward to `message_id`; never moves it backwards.
+        Returns True if the marker was created or advanced. One statement:
+        an upsert whose update only applies when it moves the marker forward.
+        """
+        connection = connections[router.db_for_write(cls)]
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            return cls._advance_in_two_steps(user_id, room_id, message_id)
+        quote = connection.ops.quote_name
+        table = quote(cls._meta.db_table)
+        user, room, last_read, updated_at = (
+            quote(cls._meta.get_field(name).column)
+            for name in ('user', 'room', 'last_read_message_id', 'updated_at')
+        )
+        sql = (
+            f"INSERT INTO {table} ({user}, {room}, {last_read}, {updated_at}) VALUES (%s, %s, %s, %s) "
+            f"ON CONFLICT ({user}, {room}) DO UPDATE "
+            f"SET {last_read} = EXCLUDED.{last_read}, {updated_at} = EXCLUDED.{updated_at} "
+            f"WHERE {table}.{last_read} < EXCLUDED.{last_read} "
+            f"RETURNING {quote(cls._meta.pk.column)}"
+        )
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [user_id, room_id, message_id, now])
+            return cursor.fetchone() is not None
+
+    @classmethod
+    def _advance_in_two_steps(cls, user_id, room_id, message_id):
+        # For backends without INSERT ... ON CONFLICT ... WHERE.
+        updated = cls.objects.filter(
+            user_id=user_id, room_id=room_id, last_read_message_id__lt=message_id
+        ).update(last_read_message_id=message_id, updated_at=timezone.now())
+        if updated:
+            return True
+        _, created = cls.objects.get_or_create(
+            user_id=user_id, room_id=room_id,
+            defaults={'last_read_message_id': message_id},
+        )
+        return created
+
+    @classmethod
+    async def aadvance(cls, user_id, room_id, message_id):
+        """Async variant of advance()."""
+        return await database_sync_to_async(cls.advance)(user_id, room_id, message_id)
+
+
+class ArchivedChatMessage(models.Model):
+    """
+    Cold tier for ChatMessage rows moved out of the hot table by the
+    `archive_messages` command. Rows keep their original id, so history
+    pagination by id continues seamlessly from the hot table, and field names
+    match ChatMessage so ChatMessageSerializer renders both. `month` is the
+    partition key.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    room = models.ForeignKey(ChatRoom, related_name='archived_messages', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    message = models.TextField()
+    timestamp = models.DateTimeField()
+    month = models.DateField()
+    is_read = models.BooleanField(default=False)
+    is_deleted = models.BooleanField(default=False)
+    share_token = models.UUIDField(unique=True, editable=False)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['room', 'id']),
+            models.Index(fields=['month']),
+        ]
+
+    def __str__(self):
+        return f"Archived message by {self.user_id} in {self.room_id}"
+
+
+class MessageSegment(models.Model):
+    """
+    Catalog entry for an immutable, compressed segment file holding a
+    contiguous id range of a room's oldest history (see user/segments.py).
+    """
+    room = models.ForeignKey(ChatRoom, related_name='segments', on_delete=models.CASCADE)
+    path = models.CharField(max_length=255, unique=True)
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    codec = models.CharField(max_length=10)
+    size_bytes = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['room', 'first_id'])]
+
+    def __str__(self):
+        return f"Segment {self.first_id}-{self.last_id} of room {self.room_id}"
+
+
+class OutboxEvent(models.Model):
+    """
+    A channel-layer broadcast written in the same transaction as the change
+    it announces. user/outbox.py publishes it once the transaction commits,
+    so rolled-back writes are never broadcast.
+    """
+    group = models.CharField(max_length=100)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Outbox event {self.id} for {self.group}"
+
+
+class RoomShard(models.Model):
+    """
+    Directory entry placing a room's messages and attachments on a shard
+    (see user/sharding.py). Rooms without an entry live on `default`.
+    `moving` fences writes while `move_room_shard` copies the room.
+    """
+    room = models.OneToOneField(ChatRoom, on_delete=models.CASCADE, primary_key=True, related_name='shard')
+    shard = models.CharField(max_length=64)
+    moving = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Room {self.room_id} on {self.shard}"
+
+
+class RevokedAccessToken(models.Model):
+    """
+    An access token revoked before it expires (e.g. on logout). The rows
+    are the source of truth behind the in-memory filter in
+    user/revocation.py and are purged once the token would have expired.
+    """
+    jti = models.CharField(max_length=255, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', null=True)
+    expires_at = models.DateTimeField(db_index=True)
+    revoked_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Revoked access token {self.jti}"
+
+
+
+class FriendSuggestion(models.Model):
+    """
+    A precomputed friend-of-friend candidate for `user` with the number of
+    friends they have in common. Maintained by user/suggestions.py.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friend_suggestions')
+    candidate = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    mutual_friends = models.PositiveIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'candidate')
+        indexes = [models.Index(fields=['user', '-mutual_friends'])]
@@ -0,0 +1,241 @@
+"""
+Saturation monitoring for the ASGI process.
+
+* Event-loop lag: a task per loop sleeps LOOP_MONITOR_INTERVAL and records
+  how late it wakes up.
+* Slow callbacks: a watchdog thread notices when that task has not run for
+  longer than SLOW_CALLBACK_THRESHOLD and logs one stack sample of the loop
+  thread per stall, which shows the code blocking the loop.
+* Sync thread pool: database_sync_to_async runs on a bounded, instrumented
+  pool of SYNC_THREAD_POOL_SIZE threads (queue depth, active threads).
+* Sockets per room group and channel-layer queue depths.
+
+Everything is exported through user/metrics.py.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as Tally
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import SyncToAsync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG = metrics.Histogram(
+    'talkspace_event_loop_lag_seconds', 'How late the event loop ran a timer scheduled for now.',
+)
+LOOP_STALLS = metrics.Counter(
+    'talkspace_event_loop_stalls_total', 'Times a callback blocked the event loop past SLOW_CALLBACK_THRESHOLD.',
+)
+
+
+class MonitoredThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that counts queued and running work items."""
+
+    def __init__(self, max_workers, thread_name_prefix=''):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.size = max_workers
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self._stats_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._stats_lock:
+            self.queued += 1
+        return super().submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        with self._stats_lock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self.active -= 1
+                self.completed += 1
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def sync_executor():
+    """
+    The shared pool for database_sync_to_async, or None when
+    SYNC_THREAD_POOL_SIZE is 0 (asgiref's single thread-sensitive thread).
+    """
+    global _executor
+    if settings.SYNC_THREAD_POOL_SIZE <= 0:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = MonitoredThreadPoolExecutor(settings.SYNC_THREAD_POOL_SIZE, 'talkspace-sync')
+        return _executor
+
+
+def _pool_stats():
+    rows = []
+    if _executor is not None:
+        rows.append(('pool', _executor.size, _executor.active, _executor.queued, _executor.completed))
+    # Thread-sensitive sync_to_async calls outside a request share this single thread.
+    single = SyncToAsync.single_thread_executor
+    rows.append(('thread_sensitive', 1, None, single._work_queue.qsize(), None))
+    return rows
+
+
+metrics.Gauge(
+    'talkspace_sync_pool_threads', 'Maximum threads in the sync thread pool.',
+    lambda: [({'pool': name}, size) for name, size, *_ in _pool_stats()],
+)
+metrics.Gauge(
+    'talkspace_sync_pool_active', 'Sync work items currently running.',
+    lambda: [({'pool': name}, active) for name, _, active, _, _ in _pool_stats() if active is not None],
+)
+metrics.Gauge(
+    'talkspace_sync_pool_queued', 'Sync work items waiting for a thread.',
+    lambda: [({'pool': name}, queued) for name, _, _, queued, _ in _pool_stats()],
+)
+metrics.Gauge(
+    'talkspace_sync_pool_utilization', 'Fraction of sync pool threads busy.',
+    lambda: [({'pool': name}, active / size) for name, size, active, _, _ in _pool_stats() if active is not None],
+)
+metrics.Gauge(
+    'talkspace_sync_pool_completed_total', 'Sync work items finished.',
+    lambda: [({'pool': name}, done) for name, _, _, _, done in _pool_stats() if done is not None],
+    metric_type='counter',
+)
+
+
+_sockets = Tally()
+_sockets_lock = threading.Lock()
+
+
+def socket_opened(group):
+    with _sockets_lock:
+        _sockets[group] += 1
+
+
+def socket_closed(group):
+    with _sockets_lock:
+        _sockets[group] -= 1
+        if _sockets[group] <= 0:
+            del _sockets[group]
+
+
+def _top_groups():
+    with _sockets_lock:
+        return _sockets.most_common(settings.MONITOR_TOP_GROUPS)
+
+
+metrics.Gauge(
+    'talkspace_ws_connections', 'Open WebSocket connections in this process.',
+    lambda: [({}, sum(_sockets.values()))],
+)
+metrics.Gauge(
+    'talkspace_ws_group_connections', 'Open WebSocket connections of the busiest room groups.',
+    lambda: [({'group': group}, count) for group, count in _top_groups()],
+)
+
+
+def _layer_stats():
+    layer = get_channel_layer()
+    if layer is None or not hasattr(layer, 'queue_depths'):
+        return []
+    depths = layer.queue_depths()
+    return [
+        ({'stat': 'channels'}, len(depths)),
+        ({'stat': 'queued_messages'}, sum(depths.values())),
+        ({'stat': 'max_queue_depth'}, max(depths.values(), default=0)),
+        ({'stat': 'groups'}, len(layer.groups)),
+    ]
+
+
+metrics.Gauge(
+    'talkspace_channel_layer', 'Channel-layer queues of this process (in-memory layer only).', _layer_stats,
+)
+
+
+class _LoopWatch:
+    __slots__ = ('loop', 'thread_id', 'beat', 'stalled', 'task')
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.stalled = False
+        self.task = None
+
+
+_watches = {}
+_watches_lock = threading.Lock()
+_watchdog = None
+
+
+async def _measure_lag(watch, interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        scheduled = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - scheduled - interval))
+        watch.beat = time.monotonic()
+        watch.stalled = False
+
+
+def _sample_stack(watch, blocked_for):
+    frame = sys._current_frames().get(watch.thread_id)
+    if frame is None:
+        return
+    stack = ''.join(traceback.format_stack(frame))
+    logger.warning("Event loop blocked for %.3fs; loop thread stack:\n%s", blocked_for, stack)
+
+
+def _watch_loops():
+    interval = settings.LOOP_MONITOR_INTERVAL
+    threshold = settings.SLOW_CALLBACK_THRESHOLD
+    while True:
+        time.sleep(min(interval, threshold) / 2)
+        with _watches_lock:
+            watches = list(_watches.values())
+        for watch in watches:
+            if watch.loop.is_closed():
+                with _watches_lock:
+                    if _watches.get(id(watch.loop)) is watch:
+                        del _watches[id(watch.loop)]
+                continue
+            blocked_for = time.monotonic() - watch.beat - interval
+            if not watch.loop.is_running() or blocked_for < threshold:
+                continue
+            if not watch.stalled:
+                watch.stalled = True
+                LOOP_STALLS.inc()
+                # One stack per stall: it rarely changes while the loop stays blocked.
+                _sample_stack(watch, blocked_for)
+
+
+def ensure_started():
+    """
+    Start lag measurement for the running event loop, and the watchdog
+    thread, if not already running. Cheap enough to call per connection.
+    """
+    global _watchdog
+    if not settings.METRICS_ENABLED or settings.LOOP_MONITOR_INTERVAL <= 0:
+        return
+    loop = asyncio.get_running_loop()
+    existing = _watches.get(id(loop))
+    if existing is not None and existing.loop is loop:
+        return
+    watch = _LoopWatch(loop)
+    with _watches_lock:
+        _watches[id(loop)] = watch
+        if _watchdog is None:
+            _watchdog = threading.Thread(target=_watch_loops, name='talkspace-loop-watchdog', daemon=True)
+            _watchdog.start()
+    watch.task = loop.create_task(_measure_lag(watch, settings.LOOP_MONITOR_INTERVAL))
@@ -0,0 +1,136 @@
+"""
+Transactional outbox for channel-layer broadcasts.
+
+Views call `publish(group, event)` inside the transaction that makes the
+change; the event is stored as an OutboxEvent row and nothing is sent until
+that transaction commits. After commit the relay drains the outbox in id
+order and sends each group's pending events with one group_send (wrapped
+in an `outbox_batch` event when there is more than one), so per-room
+ordering is kept and request latency no longer includes broadcast time.
+
+The relay is an asyncio task on the ASGI event loop, started by
+OutboxRelayApp (talkspace/asgi.py) at lifespan startup, or on the first
+connection under servers without lifespan events (Daphne). Commits only wake
+it; nothing is sent from the request thread. Events committed in processes
+without a relay (management commands, workers) are picked up on its next
+poll, every OUTBOX_POLL_INTERVAL seconds.
+
+Each pass locks the batch it sends until its rows are deleted, so a relay in
+another process waits for it rather than sending the same events again, and
+continues after them in id order. Delivery is at-least-once: a failed send
+rolls back and leaves its rows for the next pass.
+"""
+import asyncio
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from .metrics import database_sync_to_async
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+def publish(group, event):
+    """Record `event` for `group` in the current transaction; it is sent after commit."""
+    OutboxEvent.objects.create(group=group, payload=event)
+    transaction.on_commit(relay.wake)
+
+
+def _batches(events):
+    """{group: message} for a list of OutboxEvents, preserving id order per group."""
+    grouped = {}
+    for event in events:
+        grouped.setdefault(event.group, []).append(event.payload)
+    return {
+        group: payloads[0] if len(payloads) == 1 else {'type': 'outbox_batch', 'events': payloads}
+        for group, payloads in grouped.items()
+    }
+
+
+class _Relay:
+    def __init__(self):
+        self.loop = None
+        self.wakeup = None
+        self.task = None
+
+    def ensure_started(self):
+        """Run the relay on the current event loop if it isn't already."""
+        if not settings.OUTBOX_RELAY:
+            return
+        loop = asyncio.get_running_loop()
+        if self.loop is loop and self.task is not None and not self.task.done():
+            return
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.task = loop.create_task(self._run())
+        # Events committed before the relay started.
+        self.wakeup.set()
+
+    async def stop(self):
+        task, self.task = self.task, None
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def wake(self):
+        """Have the relay drain now (called on commit, from any thread). A no-op without one."""
+        loop = self.loop
+        if loop is not None and loop.is_running() and self.task is not None and not self.task.done():
+            loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), settings.OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            # Let events committed in the same burst join this flush.
+            await asyncio.sleep(settings.OUTBOX_BATCH_WINDOW)
+            try:
+                while await database_sync_to_async(self._send_batch)():
+                    pass
+            except Exception:
+                logger.exception("Outbox relay failed; events will be retried")
+
+    def _send_batch(self):
+        """Send and delete the oldest OUTBOX_BATCH_SIZE events. Returns how many there were."""
+        layer = get_channel_layer()
+        with transaction.atomic():
+            events = list(OutboxEvent.objects.select_for_update().order_by('id')[:settings.OUTBOX_BATCH_SIZE])
+            # Deleted first so SQLite takes its write lock before the sends;
+            # a failed send rolls the delete back.
+            OutboxEvent.objects.filter(id__in=[event.id for event in events]).delete()
+            for group, message in _batches(events).items():
+                async_to_sync(layer.group_send)(group, message)
+        return len(events)
+
+
+relay = _Relay()
+
+
+class OutboxRelayApp:
+    """
+    ASGI wrapper that runs the relay on the server's event loop: started at
+    lifespan startup and stopped at shutdown, or started by the first
+    connection when the server sends no lifespan events.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            relay.ensure_started()
+            return await self.application(scope, receive, send)
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                relay.ensure_started()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await relay.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
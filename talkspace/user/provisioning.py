@@ -0,0 +1,147 @@
+"""
+Bulk user provisioning from CSV or NDJSON.
+
+Rows are streamed from the file and handled `batch_size` at a time. Each
+batch is validated with ProvisionUserSerializer, checked for taken email,
+phone number and username in one query (plus duplicates earlier in the
+file), hashed in parallel on the password pool and inserted with a single
+bulk_create. If the insert still hits a unique constraint (someone
+registered meanwhile) the batch is retried row by row, so only the
+conflicting rows are skipped.
+
+Columns are the registration fields: email, phone_number, username,
+first_name, last_name, gender and, optionally, password. Users without a
+password get an unusable one and set it through forgot-password.
+"""
+import codecs
+import csv
+import json
+import os
+from django.db import IntegrityError, transaction
+from . import hashing
+from .models import User
+from .serializers import IDENTIFIER_TAKEN, ProvisionUserSerializer, identifier_errors
+
+FORMATS = ('csv', 'ndjson')
+EXTENSIONS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+
+def guess_format(filename):
+    return EXTENSIONS.get(os.path.splitext(filename or '')[1].lower())
+
+
+def read_rows(stream, input_format):
+    """
+    Yield (line_number, row) from a binary stream, one row at a time. Empty
+    values are dropped; a line that is not a JSON object yields None.
+    """
+    lines = codecs.iterdecode(stream, 'utf-8-sig')
+    if input_format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, {
+                key.strip(): value.strip() for key, value in row.items()
+                if key and isinstance(value, str) and value.strip()
+            }
+        return
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        if not isinstance(row, dict):
+            yield number, None
+            continue
+        yield number, {key: value for key, value in row.items() if value not in ('', None)}
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(accepted, report):
+    """Insert (line, validated row) pairs; returns how many were created."""
+    passwords = hashing.make_passwords(row.get('password') for _, row in accepted)
+    users = [
+        User(password=encoded, **{key: value for key, value in row.items() if key != 'password'})
+        for (_, row), encoded in zip(accepted, passwords)
+    ]
+    for user in users:
+        # bulk_create() skips User.save().
+        user.set_contact_hashes()
+    try:
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+        return len(users)
+    except IntegrityError:
+        pass
+    created = 0
+    for (line, row), user in zip(accepted, users):
+        user.pk = None
+        try:
+            with transaction.atomic():
+                user.save(force_insert=True)
+            created += 1
+        except IntegrityError:
+            report['skipped'].append({
+                'line': line,
+                'errors': identifier_errors(row) or "Email, phone number or username is already registered.",
+            })
+    return created
+
+
+def _provision_batch(batch, seen, report):
+    valid = []
+    for line, data in batch:
+        if data is None:
+            report['skipped'].append({'line': line, 'errors': "Not a JSON object."})
+            continue
+        serializer = ProvisionUserSerializer(data=data)
+        if not serializer.is_valid():
+            report['skipped'].append({'line': line, 'errors': serializer.errors})
+            continue
+        valid.append((line, dict(serializer.validated_data)))
+
+    taken = User.objects.taken_identifiers(
+        **{field: [row.get(field) for _, row in valid] for field in IDENTIFIER_TAKEN}
+    )
+    accepted = []
+    for line, row in valid:
+        errors = {
+            field: [message] for field, message in IDENTIFIER_TAKEN.items()
+            if row.get(field) and (row[field] in taken[field] or row[field] in seen[field])
+        }
+        if errors:
+            report['skipped'].append({'line': line, 'errors': errors})
+            continue
+        for field in IDENTIFIER_TAKEN:
+            if row.get(field):
+                seen[field].add(row[field])
+        accepted.append((line, row))
+    if accepted:
+        report['created'] += _insert(accepted, report)
+
+
+def provision(stream, input_format, batch_size=500, log=None):
+    """
+    Create users from a CSV or NDJSON binary stream. Returns
+    {'created': n, 'skipped': [{'line': n, 'errors': ...}, ...]}.
+    """
+    if input_format not in FORMATS:
+        raise ValueError(f"Unknown format {input_format!r}; expected one of {', '.join(FORMATS)}.")
+    report = {'created': 0, 'skipped': []}
+    seen = {field: set() for field in IDENTIFIER_TAKEN}
+    for batch in _batches(read_rows(stream, input_format), batch_size):
+        _provision_batch(batch, seen, report)
+        if log:
+            log(f"Line {batch[-1][0]}: {report['created']} created, {len(report['skipped'])} skipped")
+    return report
@@ -0,0 +1,209 @@
+import math
+import threading
+import time
+from contextlib import nullcontext
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+from .metrics import database_sync_to_async
+
+PERIODS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600, 'd': 86400, 'day': 86400}
+
+
+def parse_rate(rate):
+    """Parse a DRF-style rate string such as '10/min' into (count, seconds)."""
+    num, period = rate.split('/')
+    return int(num), PERIODS[period]
+
+
+class MemoryStore:
+    """
+    Per-process store. Fast and exact, but every worker enforces its own
+    limits; use CacheStore behind a shared cache when running several.
+    """
+    is_local = True
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+        self._writes = 0
+
+    def atomic(self):
+        return self._lock
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None or item[1] < time.monotonic():
+            return None
+        return item[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._writes += 1
+            if self._writes % 10000 == 0:
+                self._sweep()
+
+    def incr(self, key, ttl):
+        with self._lock:
+            value = (self.get(key) or 0) + 1
+            self.set(key, value, ttl)
+            return value
+
+    def _sweep(self):
+        now = time.monotonic()
+        for key in [k for k, (_, expires) in self._data.items() if expires < now]:
+            del self._data[key]
+
+
+class CacheStore:
+    """
+    Store backed by a Django cache (Redis/Memcached) so all workers share
+    the same counters. Counter increments are atomic; token-bucket updates
+    are last-writer-wins, which is close enough for abuse protection.
+    """
+    is_local = False
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def atomic(self):
+        return nullcontext()
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, math.ceil(ttl))
+
+    def incr(self, key, ttl):
+        self.cache.add(key, 0, math.ceil(ttl))
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr().
+            self.cache.set(key, 1, math.ceil(ttl))
+            return 1
+
+
+def token_bucket(store, key, limit, period, burst):
+    """
+    Take one token from the bucket. The bucket holds `burst` tokens and
+    refills at `limit / period` tokens per second.
+    """
+    refill_rate = limit / period
+    now = time.time()
+    with store.atomic():
+        state = store.get(key)
+        tokens, last = state if state else (burst, now)
+        tokens = min(burst, tokens + (now - last) * refill_rate)
+        if tokens < 1:
+            store.set(key, (tokens, now), burst / refill_rate)
+            return False, (1 - tokens) / refill_rate
+        store.set(key, (tokens - 1, now), burst / refill_rate)
+        return True, 0
+
+
+def sliding_window(store, key, limit, period):
+    """
+    Sliding-window counter: the previous fixed window's count is weighted by
+    how much of it still overlaps the sliding window. Two keys per check.
+    """
+    now = time.time()
+    window = int(now // period)
+    elapsed = now - window * period
+    weight = 1 - elapsed / period
+    with store.atomic():
+        previous = store.get(f"{key}:{window - 1}") or 0
+        current = store.get(f"{key}:{window}") or 0
+        if previous * weight + current >= limit:
+            if previous and current < limit:
+                # Wait until enough of the previous window has slid out.
+                wait = period * (1 - (limit - current) / previous) - elapsed
+            else:
+                wait = period - elapsed
+            return False, max(wait, 0)
+        store.incr(f"{key}:{window}", period * 2)
+        return True, 0
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = import_string(settings.RATE_LIMIT_STORE)()
+    return _store
+
+
+def check(scope, ident):
+    """
+    Consume one request for `ident` under the RATE_LIMITS rule `scope`.
+
+    Returns (allowed, retry_after_seconds).
+    """
+    rule = settings.RATE_LIMITS.get(scope)
+    if rule is None:
+        return True, 0
+    limit, period = parse_rate(rule['rate'])
+    key = f"rl:{scope}:{ident}"
+    if rule.get('algorithm', 'token_bucket') == 'sliding_window':
+        return sliding_window(get_store(), key, limit, period)
+    return token_bucket(get_store(), key, limit, period, rule.get('burst', limit))
+
+
+async def acheck(scope, ident):
+    """Async variant of check() that keeps network stores off the event loop."""
+    if get_store().is_local:
+        return check(scope, ident)
+    return await database_sync_to_async(check)(scope, ident)
+
+
+class ScopedRateThrottle(BaseThrottle):
+    """
+    DRF throttle backed by `check()`. Subclasses set `scope` (a RATE_LIMITS
+    key) and `per` ("ip" or "user"; anonymous users fall back to their IP).
+    DRF turns a refusal into 429 with a Retry-After header. AsyncAPIView
+    calls `aallow_request()` instead, which uses `acheck()`.
+    """
+    scope = None
+    per = 'ip'
+
+    def get_ident_for(self, request):
+        if self.per == 'user' and request.user and request.user.is_authenticated:
+            return f"user:{request.user.pk}"
+        return f"ip:{self.get_ident(request)}"
+
+    def allow_request(self, request, view):
+        allowed, self.retry_after = check(self.scope, self.get_ident_for(request))
+        return allowed
+
+    async def aallow_request(self, request, view):
+        allowed, self.retry_after = await acheck(self.scope, self.get_ident_for(request))
+        return allowed
+
+    def wait(self):
+        return math.ceil(self.retry_after) if self.retry_after else None
+
+
+class LoginRateThrottle(ScopedRateThrottle):
+    scope = 'login'
+
+
+class PasswordResetRateThrottle(ScopedRateThrottle):
+    scope = 'password_reset'
+
+
+class SearchRateThrottle(ScopedRateThrottle):
+    scope = 'search'
+    per = 'user'
+
+
+class ContactMatchRateThrottle(ScopedRateThrottle):
+    scope = 'contact_match'
+    per = 'user'
@@ -0,0 +1,193 @@
+"""
+Access-token revocation.
+
+simplejwt only blacklists refresh tokens, so an access token stays valid
+until it expires even after logout. Revoked access tokens are stored in
+RevokedAccessToken and every worker keeps a Bloom filter of their JTIs, so
+the check on each authenticated request is a few bit lookups in memory. A
+filter hit is confirmed against the table (false positives, at
+REVOCATION_FILTER_ERROR_RATE, cost one query; misses never do).
+
+Workers pick up each other's revocations by reading rows newer than the last
+one they saw, at most every REVOCATION_SYNC_INTERVAL seconds, which bounds
+how long a revoked token keeps working on another worker. The filter is
+rebuilt from the live rows once it is full, sized for twice the live rows
+(with a warning) when they outgrow REVOCATION_FILTER_CAPACITY.
+
+Every REVOCATION_COMPACT_INTERVAL seconds a worker also queues compact(),
+which deletes expired rows here and in simplejwt's outstanding/blacklisted
+token tables. The `compact_revocations` command runs it on demand.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+from .metrics import database_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+# Each sync rereads this many ids below the newest one seen, for rows whose
+# transaction committed after a row with a higher id.
+RESCAN_IDS = 1000
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter over strings."""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        if key in self:
+            return
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class _Revocations:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filter = None
+        self._last_id = 0
+        self._synced_at = 0.0
+        self._compacted_at = time.monotonic()
+
+    def _rebuild(self):
+        from .models import RevokedAccessToken
+
+        rows = list(RevokedAccessToken.objects.filter(expires_at__gt=timezone.now()).values_list('id', 'jti'))
+        capacity = settings.REVOCATION_FILTER_CAPACITY
+        if len(rows) >= capacity:
+            # A filter sized to the setting would already be full and be
+            # rebuilt on every sync, so leave room for as many again.
+            logger.warning(
+                "%d live revocations exceed REVOCATION_FILTER_CAPACITY=%d; sizing the filter for %d",
+                len(rows), capacity, 2 * len(rows),
+            )
+            capacity = 2 * len(rows)
+        bloom = BloomFilter(capacity, settings.REVOCATION_FILTER_ERROR_RATE)
+        last_id = 0
+        for row_id, jti in rows:
+            bloom.add(jti)
+            last_id = max(last_id, row_id)
+        return bloom, last_id
+
+    def sync(self, force=False):
+        """Load revocations made by other workers since the last sync."""
+        from .models import RevokedAccessToken
+
+        now = time.monotonic()
+        if not force and self._filter is not None and now - self._synced_at < settings.REVOCATION_SYNC_INTERVAL:
+            return
+        with self._lock:
+            if self._filter is None or self._filter.count >= self._filter.capacity:
+                self._filter, self._last_id = self._rebuild()
+            else:
+                rows = RevokedAccessToken.objects.filter(id__gt=self._last_id - RESCAN_IDS).values_list('id', 'jti')
+                for row_id, jti in rows:
+                    self._filter.add(jti)
+                    self._last_id = max(self._last_id, row_id)
+            self._synced_at = now
+        self._maybe_compact(now)
+
+    def _maybe_compact(self, now):
+        interval = settings.REVOCATION_COMPACT_INTERVAL
+        if not interval or now - self._compacted_at < interval:
+            return
+        self._compacted_at = now
+        from .tasks import enqueue
+        enqueue(compact)
+
+    def is_revoked(self, jti):
+        from .models import RevokedAccessToken
+
+        self.sync()
+        if jti not in self._filter:
+            return False
+        return RevokedAccessToken.objects.filter(jti=jti).exists()
+
+    def needs_db(self, jti):
+        """True when is_revoked() would have to query (a sync or a filter hit)."""
+        return (
+            self._filter is None
+            or time.monotonic() - self._synced_at >= settings.REVOCATION_SYNC_INTERVAL
+            or jti in self._filter
+        )
+
+    def add(self, jti):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(jti)
+
+
+revocations = _Revocations()
+
+
+def revoke(token, user=None):
+    """Revoke a validated access token until it expires."""
+    from .models import RevokedAccessToken
+
+    jti = token[api_settings.JTI_CLAIM]
+    RevokedAccessToken.objects.bulk_create(
+        [RevokedAccessToken(
+            jti=jti, user=user, expires_at=datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc)
+        )],
+        ignore_conflicts=True,
+    )
+    transaction.on_commit(lambda: revocations.add(jti))
+
+
+def is_revoked(token):
+    return revocations.is_revoked(token[api_settings.JTI_CLAIM])
+
+
+async def ais_revoked(token):
+    """is_revoked() for async callers; stays on the event loop unless the table must be read."""
+    jti = token[api_settings.JTI_CLAIM]
+    if not revocations.needs_db(jti):
+        return False
+    return await database_sync_to_async(revocations.is_revoked)(jti)
+
+
+def compact(batch_size=1000):
+    """
+    Delete expired revocations and expired simplejwt outstanding tokens
+    (with their blacklist entries), in batches. Returns the number of rows
+    deleted from each table.
+    """
+    from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+    from .models import RevokedAccessToken
+
+    now = timezone.now()
+    deleted = {'revoked': 0, 'outstanding': 0, 'blacklisted': 0}
+    while True:
+        ids = list(RevokedAccessToken.objects.filter(expires_at__lte=now).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        deleted['revoked'] += RevokedAccessToken.objects.filter(id__in=ids).delete()[0]
+    while True:
+        ids = list(OutstandingToken.objects.filter(expires_at__lte=now).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        deleted['blacklisted'] += BlacklistedToken.objects.filter(token_id__in=ids).delete()[0]
+        deleted['outstanding'] += OutstandingToken.objects.filter(id__in=ids).delete()[0]
+    return deleted
@@ -0,0 +1,97 @@
+"""
+Read-replica routing.
+
+Writes always go to `default`. Reads go to a replica only inside
+`replica_reads()` (or a handler decorated with `reads_from_replica`), which
+the history, search, listing and inbox views use, and only when:
+
+  * DATABASE_REPLICAS is not empty,
+  * the user is not pinned to the primary: any write request or chat
+    message pins its user for REPLICA_PIN_SECONDS so they read their own
+    writes while replicas catch up,
+  * the primary connection is not inside a transaction.
+
+Pins live in the default cache, so several workers need a shared CACHES
+backend to honour each other's pins.
+"""
+import functools
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_replica = ContextVar('talkspace_read_replica', default=None)
+
+
+def _pin_key(user_id):
+    return f"replica-pin:{user_id}"
+
+
+def pin_to_primary(user_id):
+    """Send `user_id`'s replica reads to the primary for REPLICA_PIN_SECONDS."""
+    if settings.DATABASE_REPLICAS and user_id is not None:
+        cache.set(_pin_key(user_id), 1, settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned(user_id):
+    return user_id is not None and cache.get(_pin_key(user_id)) is not None
+
+
+def reading_from_replica():
+    """True inside replica_reads() when a replica was chosen."""
+    return _replica.get() is not None
+
+
+@contextmanager
+def replica_reads(user_id):
+    """Route reads in the block to a replica unless `user_id` is pinned."""
+    if not settings.DATABASE_REPLICAS or is_pinned(user_id):
+        yield
+        return
+    token = _replica.set(random.choice(settings.DATABASE_REPLICAS))
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+def reads_from_replica(handler):
+    """View handler decorator (sync or async) for replica_reads(request.user.id)."""
+    if iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def async_wrapper(self, request, *args, **kwargs):
+            with replica_reads(request.user.id):
+                return await handler(self, request, *args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(handler)
+    def wrapper(self, request, *args, **kwargs):
+        with replica_reads(request.user.id):
+            return handler(self, request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replica = _replica.get()
+        if replica is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema from the primary through replication.
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
@@ -0,0 +1,248 @@
+"""
+Immutable, compressed, columnar segment files for cold chat history.
+
+Layout of a segment file:
+
+    MAGIC | block 0 | block 1 | ... | index (JSON) | footer
+
+Each block holds up to SEGMENT_BLOCK_SIZE messages as a compressed JSON
+object of columns (delta-encoded ids and timestamps, user ids, texts and the
+positions of deleted/read rows). The index is a sparse list of
+[first_id, last_id, offset, length, count] per block, and the fixed-size
+footer points at it. Readers memory-map the file, bisect the index and
+decompress only the blocks a request needs.
+"""
+import bisect
+import json
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import transaction
+from rest_framework import serializers
+from .media import avatar_url
+from .models import ArchivedChatMessage, MessageSegment, User
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'TSSEG1'
+FOOTER = struct.Struct('<QI6s')
+_datetime_field = serializers.DateTimeField()
+
+
+def _compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return zlib.compress(data, 9)
+
+
+def _decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Segment is zstd-compressed but zstandard is not installed.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _micros(timestamp):
+    return round(timestamp.timestamp() * 1_000_000)
+
+
+def _encode_block(records, codec):
+    ids, users, texts, stamps, deleted, read = [], [], [], [], [], []
+    previous_id = previous_ts = 0
+    for position, (message_id, user_id, text, timestamp, is_deleted, is_read) in enumerate(records):
+        ids.append(message_id - previous_id)
+        previous_id = message_id
+        micros = _micros(timestamp)
+        stamps.append(micros - previous_ts)
+        previous_ts = micros
+        users.append(user_id)
+        texts.append(text)
+        if is_deleted:
+            deleted.append(position)
+        if is_read:
+            read.append(position)
+    columns = {'id': ids, 'user': users, 'message': texts, 'ts': stamps, 'deleted': deleted, 'read': read}
+    return _compress(json.dumps(columns, separators=(',', ':')).encode(), codec)
+
+
+def _decode_block(data, codec):
+    columns = json.loads(_decompress(data, codec))
+    deleted, read = set(columns['deleted']), set(columns['read'])
+    records = []
+    message_id = micros = 0
+    for position, (id_delta, user_id, text, ts_delta) in enumerate(
+        zip(columns['id'], columns['user'], columns['message'], columns['ts'])
+    ):
+        message_id += id_delta
+        micros += ts_delta
+        timestamp = datetime.fromtimestamp(micros / 1_000_000, tz=dt_timezone.utc)
+        records.append((message_id, user_id, text, timestamp, position in deleted, position in read))
+    return records
+
+
+def write_segment(path, records):
+    """
+    Write `records` ((id, user_id, message, timestamp, is_deleted, is_read)
+    tuples sorted by id) to `path` atomically. Returns (codec, size_bytes).
+    """
+    codec = 'zstd' if zstandard is not None else 'zlib'
+    block_size = settings.SEGMENT_BLOCK_SIZE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    index = []
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        for start in range(0, len(records), block_size):
+            block = records[start:start + block_size]
+            data = _encode_block(block, codec)
+            index.append([block[0][0], block[-1][0], f.tell(), len(data), len(block)])
+            f.write(data)
+        index_offset = f.tell()
+        index_data = json.dumps({'codec': codec, 'blocks': index}).encode()
+        f.write(index_data)
+        f.write(FOOTER.pack(index_offset, len(index_data), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return codec, os.path.getsize(path)
+
+
+class SegmentReader:
+    """Memory-mapped reader that decompresses blocks on demand."""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, index_length, magic = FOOTER.unpack(self._map[-FOOTER.size:])
+        if magic != MAGIC or self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a message segment")
+        index = json.loads(self._map[index_offset:index_offset + index_length])
+        self.codec = index['codec']
+        self.blocks = index['blocks']
+        self._last_ids = [block[1] for block in self.blocks]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def read_block(self, number):
+        _, _, offset, length, _ = self.blocks[number]
+        return _decode_block(self._map[offset:offset + length], self.codec)
+
+    def read_before(self, before, limit):
+        """Up to `limit` non-deleted records with id < `before` (newest first)."""
+        found = []
+        number = len(self.blocks) - 1 if before is None else bisect.bisect_left(self._last_ids, before)
+        number = min(number, len(self.blocks) - 1)
+        while number >= 0 and len(found) < limit:
+            for record in reversed(self.read_block(number)):
+                if (before is None or record[0] < before) and not record[4]:
+                    found.append(record)
+                    if len(found) == limit:
+                        break
+            number -= 1
+        return found
+
+    def read_all(self):
+        for number in range(len(self.blocks)):
+            yield from self.read_block(number)
+
+
+def segment_path(name):
+    return os.path.join(settings.SEGMENT_ROOT, name)
+
+
+def serialize_records(room_id, records):
+    """Render segment records in ChatMessageSerializer's shape, oldest first."""
+    records = sorted(records, key=lambda record: record[0])
+    users = User.objects.in_bulk({record[1] for record in records})
+    data = []
+    for message_id, user_id, text, timestamp, _, is_read in records:
+        user = users.get(user_id)
+        data.append({
+            'id': message_id,
+            'room': room_id,
+            'user': user_id,
+            'message': text,
+            'timestamp': _datetime_field.to_representation(timestamp),
+            'is_read': is_read,
+            'first_name': user.first_name if user else '',
+            'last_name': user.last_name if user else '',
+            'profile_picture': avatar_url(user, 'small') if user else None,
+        })
+    return data
+
+
+def read_segment_records(room_id, limit, before=None):
+    """Newest `limit` non-deleted segment records of a room with id < `before`."""
+    segments = MessageSegment.objects.filter(room_id=room_id)
+    if before is not None:
+        segments = segments.filter(first_id__lt=before)
+    found = []
+    for segment in segments.order_by('-first_id').only('path'):
+        with SegmentReader(segment_path(segment.path)) as reader:
+            found.extend(reader.read_before(before, limit - len(found)))
+        if len(found) >= limit:
+            break
+    return found
+
+
+def all_segment_records(room_id, include_deleted=False):
+    records = []
+    for segment in MessageSegment.objects.filter(room_id=room_id).order_by('first_id').only('path'):
+        with SegmentReader(segment_path(segment.path)) as reader:
+            records.extend(r for r in reader.read_all() if include_deleted or not r[4])
+    return records
+
+
+def export_room(room_id, delete_batch_size=5000):
+    """
+    Pack every archived message of a room into a new segment file and drop
+    the exported rows from the archive table. Returns the MessageSegment, or
+    None when there was nothing to export.
+    """
+    records = list(
+        ArchivedChatMessage.objects.filter(room_id=room_id)
+        .order_by('id')
+        .values_list('id', 'user_id', 'message', 'timestamp', 'is_deleted', 'is_read')
+    )
+    if not records:
+        return None
+
+    name = f"room_{room_id}/{records[0][0]}-{records[-1][0]}.seg"
+    path = segment_path(name)
+    codec, size = write_segment(path, records)
+    try:
+        with transaction.atomic():
+            segment = MessageSegment.objects.create(
+                room_id=room_id,
+                path=name,
+                first_id=records[0][0],
+                last_id=records[-1][0],
+                first_timestamp=records[0][3],
+                last_timestamp=records[-1][3],
+                message_count=len(records),
+                codec=codec,
+                size_bytes=size,
+            )
+            ids = [record[0] for record in records]
+            for start in range(0, len(ids), delete_batch_size):
+                ArchivedChatMessage.objects.filter(id__in=ids[start:start + delete_batch_size]).delete()
+    except Exception:
+        os.remove(path)
+        raise
+    return segment
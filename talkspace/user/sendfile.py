@@ -0,0 +1,144 @@
+import hashlib
+import re
+from urllib.parse import quote
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_etags, quote_etag
+from django.views.static import serve
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class _RangeFile:
+    """File-like wrapper that stops reading after `length` bytes."""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def file_etag(field_file, size):
+    """
+    Strong ETag for an uploaded file. Uploads are stored under unique names
+    and never rewritten in place, so name and size identify the content.
+    """
+    digest = hashlib.sha1(f"{field_file.name}:{size}".encode()).hexdigest()
+    return quote_etag(digest)
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range `Range` header into an inclusive (start, end) pair.
+
+    Returns None when the header should be ignored (absent, malformed or
+    multi-range, which we answer with the full body) and raises ValueError
+    when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # Suffix range: the last N bytes.
+        length = int(end)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def sendfile_response(request, field_file, filename, content_type=None, last_modified=None):
+    """
+    Serve an uploaded file with ETag/conditional GET and Range support.
+
+    With SENDFILE_BACKEND set to "nginx" or "xsendfile" only the headers are
+    produced and the front-end server streams the bytes (and handles Range
+    itself). Otherwise a FileResponse is returned; for full-body responses
+    the WSGI/ASGI server can hand the file descriptor straight to sendfile().
+    """
+    size = field_file.size
+    etag = file_etag(field_file, size)
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+
+    conditional = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if conditional is not None:
+        conditional.headers['ETag'] = etag
+        return conditional
+
+    content_type = content_type or 'application/octet-stream'
+    backend = settings.SENDFILE_BACKEND
+
+    if backend:
+        response = HttpResponse(content_type=content_type)
+        if backend == 'nginx':
+            response.headers['X-Accel-Redirect'] = settings.SENDFILE_URL_PREFIX + quote(field_file.name)
+        elif backend == 'xsendfile':
+            response.headers['X-Sendfile'] = field_file.path
+        else:
+            raise ValueError(f"Unknown SENDFILE_BACKEND {backend!r}")
+    else:
+        byte_range = None
+        if_range = request.META.get('HTTP_IF_RANGE')
+        # A stale If-Range means the client's partial copy is outdated.
+        if not if_range or etag in parse_etags(if_range):
+            try:
+                byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response.headers['Content-Range'] = f'bytes */{size}'
+                return response
+
+        if byte_range is None:
+            response = FileResponse(field_file.open('rb'), content_type=content_type)
+            response.headers['Content-Length'] = size
+        else:
+            start, end = byte_range
+            length = end - start + 1
+            response = FileResponse(
+                _RangeFile(field_file.open('rb'), start, length),
+                status=206,
+                content_type=content_type,
+            )
+            response.headers['Content-Length'] = length
+            response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'private, max-age=86400'
+    response.headers['Content-Disposition'] = content_disposition_header(False, filename)
+    if timestamp is not None:
+        response.headers['Last-Modified'] = http_date(timestamp)
+    return response
+
+
+def serve_media(request, path, document_root=None):
+    """
+    Development MEDIA_URL server. Content-versioned URLs (`?v=<hash>`, see
+    media.avatar_url) never change meaning, so they are cached as immutable;
+    configure the same header on the production front-end server.
+    """
+    response = serve(request, path, document_root=document_root)
+    if request.GET.get('v'):
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
@@ -3,6 +3,7 @@ from rest_framework import serializers
 from django.core.exceptions import ValidationError
 from .models import User, FriendRequest, ChatMessage, ChatRoom
 from rest_framework_simplejwt.tokens import RefreshToken
+from django.db import IntegrityError, transaction
 from django.db.models import Q
 from django.core.validators import validate_email
 from django.core.validators import FileExtensionValidator
@@ -11,8 +12,26 @@ from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
 from django.utils.http import urlsafe_base64_decode
 from .utils import send_password_reset_email
+from .media import avatar_url, content_version
+from .metrics import TimedSerializerMixin
+from .hashing import acheck_password
+from rest_framework.settings import api_settings
+from django.conf import settings
 
 PASSWORD_REGEX = r'^(?=.*[A-Za-z])(?=.*\d)(?=.*[!@#$%^&*()_+={}\[\]:;"\'<>,.?/\\|`~]).{8,}$'
+IDENTIFIER_TAKEN = {
+    'email': "Email is already registered.",
+    'phone_number': "Phone number is already registered.",
+    'username': "Username is already taken.",
+}
+
+
+def identifier_errors(data):
+    """Field errors for the email, phone number and username in `data` that are already taken (one query)."""
+    taken = User.objects.taken_identifiers(**{field: [data.get(field)] for field in IDENTIFIER_TAKEN})
+    return {field: IDENTIFIER_TAKEN[field] for field, values in taken.items() if values}
+
+
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
     confirm_password = serializers.CharField(write_only=True)
@@ -31,32 +50,28 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             'password',
             'confirm_password'
         ]
+        # Uniqueness is checked for all three at once in validate().
+        extra_kwargs = {field: {'validators': []} for field in IDENTIFIER_TAKEN}
 
     def validate_phone_number(self, value):
-        """Validate phone number format and uniqueness."""
+        """Validate phone number format."""
         if value:
             if not re.match(r'^\+\d{1,4}\d{7,15}$', value):
                 raise ValidationError("Phone number must start with a country code followed by 7-15 digits.")
-            if User.objects.filter(phone_number=value).exists():
-                raise ValidationError("Phone number is already registered.")
         return value
 
     def validate_email(self, value):
-        """Ensure email is valid and unique."""
+        """Ensure email is valid."""
         if value:
             try:
                 validate_email(value)
             except ValidationError:
                 raise ValidationError("Enter a valid email address.")
-            if User.objects.filter(email=value).exists():
-                raise ValidationError("Email is already registered.")
         return value
 
     def validate_username(self, value):
-        """Ensure username is unique if provided."""
+        """Ensure username is long enough if provided."""
         if value:
-            if User.objects.filter(username=value).exists():
-                raise ValidationError("Username is already taken.")
             if len(value) < 3:
                 raise ValidationError("Username must be at least 3 characters long.")
         return value
@@ -77,25 +92,57 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         # Ensure at least email or phone_number is provided (consistent with UserManager)
         if not data.get('email') and not data.get('phone_number'):
             raise ValidationError("Either an email or phone number must be provided.")
-        
+
+        errors = identifier_errors(data)
+        if errors:
+            raise ValidationError(errors)
         return data
 
     def create(self, validated_data):
         """Create and return a new user."""
         validated_data.pop('confirm_password', None)
-        user = User.objects.create_user(
-            email=validated_data.get('email'),
-            phone_number=validated_data.get('phone_number'),
-            username=validated_data.get('username'),
-            first_name=validated_data['first_name'],
-            last_name=validated_data['last_name'],
-            gender=validated_data['gender'],
-            password=validated_data['password'],
-            profile_picture=validated_data.get('profile_picture')
-        )
+        profile_picture = validated_data.get('profile_picture')
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(
+                    email=validated_data.get('email'),
+                    phone_number=validated_data.get('phone_number'),
+                    username=validated_data.get('username'),
+                    first_name=validated_data['first_name'],
+                    last_name=validated_data['last_name'],
+                    gender=validated_data['gender'],
+                    password=validated_data['password'],
+                    profile_picture=profile_picture,
+                    avatar_version=content_version(profile_picture) if profile_picture else ''
+                )
+        except IntegrityError:
+            # A concurrent registration took an identifier after validate().
+            raise serializers.ValidationError(
+                identifier_errors(validated_data) or "Email, phone number or username is already registered."
+            )
         return user
 
 
+class ProvisionUserSerializer(UserRegistrationSerializer):
+    """
+    One row of a bulk import (user/provisioning.py). The password is optional
+    and unconfirmed; uniqueness is checked for the whole batch at once.
+    """
+    password = serializers.CharField(write_only=True, required=False)
+    confirm_password = None
+    profile_picture = None
+
+    class Meta(UserRegistrationSerializer.Meta):
+        fields = ['email', 'phone_number', 'username', 'first_name', 'last_name', 'gender', 'password']
+
+    def validate(self, data):
+        if not data.get('email') and not data.get('phone_number'):
+            raise ValidationError("Either an email or phone number must be provided.")
+        if data.get('email'):
+            data['email'] = User.objects.normalize_email(data['email'])
+        return data
+
+
 class UserLoginSerializer(serializers.Serializer):
     email = serializers.EmailField(required=False)
     phone_number = serializers.CharField(max_length=15, required=False)
@@ -106,24 +153,24 @@ class UserLoginSerializer(serializers.Serializer):
         # Ensure at least one identifier is provided.
         if not data.get('email') and not data.get('phone_number') and not data.get('username'):
             raise serializers.ValidationError("Email, phone number, or username is required.")
+        return data
 
-        # Identify the user
-        user = None
-        if data.get('email'):
-            user = User.objects.filter(email=data['email']).first()
-        elif data.get('phone_number'):
-            user = User.objects.filter(phone_number=data['phone_number']).first()
-        elif data.get('username'):
-            user = User.objects.filter(username=data['username']).first()
-
+    async def aauthenticate(self):
+        """
+        The user the validated credentials belong to, resolved in one query
+        with the password checked on the hashing pool (user/hashing.py).
+        """
+        data = self.validated_data
+        user = await User.objects.for_login(
+            email=data.get('email'), phone_number=data.get('phone_number'), username=data.get('username')
+        ).afirst()
         if user is None:
-            raise serializers.ValidationError("No user found with the provided credentials.")
-
-        # Check if password is correct
-        if not user.check_password(data['password']):
-            raise serializers.ValidationError("Invalid password.")
+            raise serializers.ValidationError(
+                {api_settings.NON_FIELD_ERRORS_KEY: ["No user found with the provided credentials."]}
+            )
 
-        # Return user object if authentication is successful
+        if not await acheck_password(user, data['password']):
+            raise serializers.ValidationError({api_settings.NON_FIELD_ERRORS_KEY: ["Invalid password."]})
         return user
 
     def get_tokens_for_user(self, user):
@@ -136,7 +183,7 @@ class UserLoginSerializer(serializers.Serializer):
             'refresh': str(refresh)
         }
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     profile_picture = serializers.ImageField(
         required=False, 
         allow_null=True, 
@@ -156,11 +203,66 @@ class UserSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ["email", "gender"]
 
-class UserListSerializer(serializers.ModelSerializer):
+    def update(self, instance, validated_data):
+        if 'profile_picture' in validated_data:
+            # Old variants belong to the previous picture; they are regenerated
+            # in the background and the new content hash re-versions the URLs.
+            picture = validated_data['profile_picture']
+            validated_data['avatar_variants'] = {}
+            validated_data['avatar_blurhash'] = ''
+            validated_data['avatar_version'] = content_version(picture) if picture else ''
+        return super().update(instance, validated_data)
+
+class UserListSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    profile_picture = serializers.SerializerMethodField()
+
     class Meta:
         model = User
-        fields = ['email', 'phone_number', 'username', 'first_name', 'last_name', 'gender',"profile_picture"]
+        fields = ['email', 'phone_number', 'username', 'first_name', 'last_name', 'gender',"profile_picture", "avatar_blurhash"]
+
+    def get_profile_picture(self, obj):
+        return avatar_url(obj, 'medium')
     
+class ContactMatchSerializer(serializers.Serializer):
+    """
+    Address-book contacts to match: plain phone numbers and emails, and/or
+    SHA-256 hex digests of their normalized forms (see user/contacts.py).
+    """
+    phone_numbers = serializers.ListField(child=serializers.CharField(max_length=64), required=False, default=list)
+    emails = serializers.ListField(child=serializers.CharField(max_length=254), required=False, default=list)
+    phone_hashes = serializers.ListField(child=serializers.RegexField(r'^[0-9a-fA-F]{64}$'), required=False, default=list)
+    email_hashes = serializers.ListField(child=serializers.RegexField(r'^[0-9a-fA-F]{64}$'), required=False, default=list)
+
+    def validate(self, data):
+        total = sum(len(values) for values in data.values())
+        if not total:
+            raise ValidationError("Provide at least one phone number, email or hash.")
+        if total > settings.CONTACT_MATCH_MAX:
+            raise ValidationError(f"At most {settings.CONTACT_MATCH_MAX} contacts can be matched per request.")
+        return data
+
+
+class ContactUserSerializer(serializers.ModelSerializer):
+    """A matched user, without the contact details they were not matched on."""
+    profile_picture = serializers.SerializerMethodField()
+
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'first_name', 'last_name', 'profile_picture', 'avatar_blurhash']
+
+    def get_profile_picture(self, obj):
+        return avatar_url(obj, 'medium')
+
+
+class BulkFriendRequestSerializer(serializers.Serializer):
+    user_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+    def validate_user_ids(self, value):
+        if len(value) > settings.FRIEND_REQUEST_BULK_MAX:
+            raise ValidationError(f"At most {settings.FRIEND_REQUEST_BULK_MAX} friend requests can be sent at once.")
+        return value
+
+
 class FriendRequestSerializer(serializers.ModelSerializer):
     receiver = serializers.CharField()
 
@@ -201,13 +303,13 @@ class FriendRequestSerializer(serializers.ModelSerializer):
             receiver=validated_data['receiver']
         )
     
-class ChatRoomSerializer(serializers.ModelSerializer):
+class ChatRoomSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     users = UserListSerializer(many=True)
     class Meta:
         model = ChatRoom
         fields = ['id', 'name', 'users', 'is_group_chat', 'created_at']
 
-class ChatMessageSerializer(serializers.ModelSerializer):
+class ChatMessageSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     first_name = serializers.SerializerMethodField()
     last_name = serializers.SerializerMethodField()
     profile_picture = serializers.SerializerMethodField()
@@ -226,15 +328,57 @@ class ChatMessageSerializer(serializers.ModelSerializer):
         return obj.user.last_name
 
     def get_profile_picture(self, obj):
-        if obj.user.profile_picture:
-            return obj.user.profile_picture.url
-        return None
+        return avatar_url(obj.user, 'small')
 
     
-class FriendSerializer(serializers.ModelSerializer):
+class MarkReadSerializer(serializers.Serializer):
+    """A read receipt, from MarkMessagesReadView or a WebSocket `read` frame."""
+    room_id = serializers.IntegerField(min_value=1)
+    message_id = serializers.IntegerField(min_value=1)
+
+
+class BulkMessageIdsSerializer(serializers.Serializer):
+    message_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+
+    def validate_message_ids(self, value):
+        if len(value) > settings.BULK_MESSAGE_LIMIT:
+            raise ValidationError(f"At most {settings.BULK_MESSAGE_LIMIT} messages can be changed at once.")
+        return value
+
+
+class MessageEditSerializer(serializers.Serializer):
+    id = serializers.IntegerField(min_value=1)
+    message = serializers.CharField()
+
+    def validate_message(self, value):
+        if len(value) > settings.MESSAGE_MAX_LENGTH:
+            raise ValidationError(f"Messages can be at most {settings.MESSAGE_MAX_LENGTH} characters long.")
+        return value
+
+
+class BulkEditMessagesSerializer(serializers.Serializer):
+    edits = MessageEditSerializer(many=True, allow_empty=False)
+
+    def validate_edits(self, value):
+        if len(value) > settings.BULK_MESSAGE_LIMIT:
+            raise ValidationError(f"At most {settings.BULK_MESSAGE_LIMIT} messages can be changed at once.")
+        return value
+
+
+class PurgeUserMessagesSerializer(serializers.Serializer):
+    room_id = serializers.IntegerField(min_value=1)
+    user_id = serializers.IntegerField(min_value=1)
+
+
+class FriendSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    profile_picture = serializers.SerializerMethodField()
+
     class Meta:
         model = User
-        fields = ['id', 'username', 'first_name', 'last_name', 'email',"profile_picture"]
+        fields = ['id', 'username', 'first_name', 'last_name', 'email',"profile_picture", "avatar_blurhash"]
+
+    def get_profile_picture(self, obj):
+        return avatar_url(obj, 'medium')
 
 
 
@@ -0,0 +1,443 @@
+"""
+Room-sharded message storage.
+
+ChatMessage and AttachedFile rows live on one of MESSAGE_SHARDS, chosen per
+room. A room with a RoomShard row lives on that row's shard; every other
+room lives on `default`, so enabling sharding does not move existing
+history. New rooms are placed on a shard when they are created, and rooms
+move with the `move_room_shard` command.
+
+ShardRouter sends a query to its room's shard when it can tell the room:
+`filter(room=...)`/`filter(room_id=...)` and `create(room=...)` on
+ChatMessage, related managers (`room.messages`, `message.files`) and saves
+or deletes of an instance. Queries by message or attachment id alone, and
+queries spanning several rooms, go through `find()`/`afind()`,
+`all_shards()` and `fan_in()`.
+
+With sharding enabled message and attachment ids come from `next_id()`, a
+time-ordered 53-bit id (milliseconds, MESSAGE_ID_NODE, sequence), so they
+are unique across shards, keep increasing within a room and stay exact in
+JavaScript. Relations to users and rooms cannot be joined across
+databases, so load them with prefetch_related rather than select_related.
+
+For the same reason the message FKs carry no database constraint, and
+deleting a room or user cascades through the ORM on default only. Rooms
+and users are normally soft-deleted; on a hard delete, room_deleted() and
+user_deleted() (post_delete handlers) purge the rows on the other shards
+in the background once the delete commits.
+"""
+import threading
+import time
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+ID_EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+NODE_BITS = 5
+SEQUENCE_BITS = 8
+ROOM_LOOKUPS = ('room', 'room_id', 'room__id', 'room__pk')
+
+
+class RoomMoving(APIException):
+    """Raised on writes to a room while `move_room_shard` is copying it."""
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "This room is being moved; try again in a few seconds."
+    default_code = 'room_moving'
+
+
+def enabled():
+    return len(settings.MESSAGE_SHARDS) > 1
+
+
+class _IdAllocator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next(self):
+        node = settings.MESSAGE_ID_NODE & ((1 << NODE_BITS) - 1)
+        with self._lock:
+            now = max(int(time.time() * 1000) - ID_EPOCH_MS, self._last_ms)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond; borrow the next one.
+                    now += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (now << (NODE_BITS + SEQUENCE_BITS)) | (node << SEQUENCE_BITS) | self._sequence
+
+
+next_id = _IdAllocator().next
+
+
+class _Directory:
+    """Process-local cache of RoomShard rows, each kept SHARD_DIRECTORY_TTL seconds."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, room_ids):
+        """{room_id: (shard, moving)} for `room_ids`, reading misses in one query."""
+        from .models import RoomShard
+
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for room_id in room_ids:
+                entry = self._entries.get(room_id)
+                if entry is not None and entry[2] > now:
+                    found[room_id] = entry[:2]
+                else:
+                    missing.append(room_id)
+        if missing:
+            rows = {
+                room_id: (shard, moving)
+                for room_id, shard, moving in RoomShard.objects.filter(room_id__in=missing)
+                .values_list('room_id', 'shard', 'moving')
+            }
+            expires = now + settings.SHARD_DIRECTORY_TTL
+            with self._lock:
+                for room_id in missing:
+                    found[room_id] = rows.get(room_id, (DEFAULT_DB_ALIAS, False))
+                    self._entries[room_id] = (*found[room_id], expires)
+        return found
+
+    def forget(self, room_id=None):
+        with self._lock:
+            if room_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(room_id, None)
+
+
+directory = _Directory()
+
+
+def _room_id(value):
+    return int(value.pk if isinstance(value, models.Model) else value)
+
+
+def shard_for_room(room_id, write=False):
+    """Alias of the shard holding `room_id`. Raises RoomMoving for writes to a room being moved."""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    room_id = _room_id(room_id)
+    shard, moving = directory.lookup([room_id])[room_id]
+    if write and moving:
+        raise RoomMoving()
+    return shard
+
+
+def shards_for_rooms(room_ids, write=False):
+    """{shard: [room_id, ...]} for `room_ids`, with one directory query for cache misses."""
+    room_ids = [_room_id(room_id) for room_id in room_ids]
+    if not enabled():
+        return {DEFAULT_DB_ALIAS: room_ids} if room_ids else {}
+    grouped = {}
+    for room_id, (shard, moving) in directory.lookup(room_ids).items():
+        if write and moving:
+            raise RoomMoving()
+        grouped.setdefault(shard, []).append(room_id)
+    return grouped
+
+
+def place_room(room):
+    """Record the shard of a newly created room (rooms without a row stay on default)."""
+    from .models import RoomShard
+
+    if not enabled():
+        return
+    shard = settings.MESSAGE_SHARDS[room.pk % len(settings.MESSAGE_SHARDS)]
+    if shard != DEFAULT_DB_ALIAS:
+        RoomShard.objects.create(room=room, shard=shard)
+    directory.forget(room.pk)
+
+
+def _on_shard(queryset, shard):
+    # Without sharding leave routing to the other routers (read replicas).
+    return queryset.using(shard) if enabled() else queryset
+
+
+def all_shards(queryset):
+    """`queryset` once per shard, for lookups that do not name a room."""
+    if not enabled():
+        return [queryset]
+    return [queryset.using(shard) for shard in settings.MESSAGE_SHARDS]
+
+
+def find(queryset):
+    """The first object `queryset` matches on any shard, or None."""
+    for shard_queryset in all_shards(queryset):
+        obj = shard_queryset.first()
+        if obj is not None:
+            return obj
+    return None
+
+
+async def afind(queryset):
+    """Async variant of find()."""
+    for shard_queryset in all_shards(queryset):
+        obj = await shard_queryset.afirst()
+        if obj is not None:
+            return obj
+    return None
+
+
+def fan_in(queryset, room_ids, build=None, key=None, reverse=False, limit=None):
+    """
+    Evaluate `queryset` restricted to `room_ids` on every shard holding some
+    of them and merge the results. `build(queryset)` may refine each shard's
+    queryset (ordering, slicing); the merged rows are sorted by `key` and
+    cut to `limit` when given.
+    """
+    rows = []
+    for shard, shard_room_ids in shards_for_rooms(room_ids).items():
+        shard_queryset = _on_shard(queryset.filter(room_id__in=shard_room_ids), shard)
+        rows.extend(build(shard_queryset) if build else shard_queryset)
+    if key is not None:
+        rows.sort(key=key, reverse=reverse)
+    return rows[:limit] if limit is not None else rows
+
+
+def purge_shards(batch_size=1000, **lookup):
+    """
+    Delete messages matching `lookup` (room_id= or user_id=), with their
+    attachments, from every shard other than default. Returns the number of
+    messages deleted.
+    """
+    from .models import ChatMessage
+
+    deleted = 0
+    for shard in settings.MESSAGE_SHARDS:
+        if shard == DEFAULT_DB_ALIAS:
+            continue
+        messages = ChatMessage.objects.using(shard).filter(**lookup)
+        while True:
+            ids = list(messages.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            with transaction.atomic(using=shard):
+                deleted += ChatMessage.objects.using(shard).filter(id__in=ids).delete()[1].get('user.ChatMessage', 0)
+    return deleted
+
+
+def room_deleted(sender, instance, **kwargs):
+    """
+    post_delete for ChatRoom. The ORM cascade only reaches messages on
+    default (the FKs are unconstrained and the collector queries one
+    database), so the room's messages on other shards are purged here, after
+    the delete commits.
+    """
+    directory.forget(instance.pk)
+    if enabled():
+        from .tasks import enqueue
+        enqueue(purge_shards, room_id=instance.pk)
+
+
+def user_deleted(sender, instance, **kwargs):
+    """post_delete for User; see room_deleted()."""
+    if enabled():
+        from .tasks import enqueue
+        enqueue(purge_shards, user_id=instance.pk)
+
+
+class ShardedQuerySet(models.QuerySet):
+    """
+    Records the room a ChatMessage query is filtered or created by as a
+    router hint, so ShardRouter can send it to the room's shard when it runs.
+    """
+
+    def _with_room_hint(self, kwargs):
+        if self._db is not None or not enabled():
+            return self
+        for lookup in ROOM_LOOKUPS:
+            value = kwargs.get(lookup)
+            if value is not None and not isinstance(value, (list, tuple, set, models.QuerySet)):
+                clone = self._chain()
+                clone._hints = {**clone._hints, 'room_id': _room_id(value)}
+                return clone
+        return self
+
+    def filter(self, *args, **kwargs):
+        return super(ShardedQuerySet, self._with_room_hint(kwargs)).filter(*args, **kwargs)
+
+    def create(self, **kwargs):
+        return super(ShardedQuerySet, self._with_room_hint(kwargs)).create(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if self._db is not None or not enabled():
+            return super().bulk_create(objs, *args, **kwargs)
+        from django.db import router
+
+        objs = list(objs)
+        by_shard = {}
+        for obj in objs:
+            if obj.pk is None:
+                obj.pk = next_id()
+            by_shard.setdefault(router.db_for_write(self.model, instance=obj), []).append(obj)
+        for shard, shard_objs in by_shard.items():
+            super(ShardedQuerySet, self.using(shard)).bulk_create(shard_objs, *args, **kwargs)
+        return objs
+
+
+ShardedManager = models.Manager.from_queryset(ShardedQuerySet)
+
+
+class ShardedModelMixin:
+    """Gives new rows of a sharded model a cross-shard id from next_id()."""
+
+    def save(self, *args, **kwargs):
+        if self.pk is None and enabled():
+            self.pk = next_id()
+            kwargs.setdefault('force_insert', True)
+        return super().save(*args, **kwargs)
+
+
+class ShardRouter:
+    """Routes ChatMessage and AttachedFile to their room's shard; see the module docstring."""
+
+    sharded_models = ('chatmessage', 'attachedfile')
+
+    def _shard(self, model, hints, write):
+        if not enabled() or model._meta.app_label != 'user' or model._meta.model_name not in self.sharded_models:
+            return None
+        room_id = hints.get('room_id')
+        instance = hints.get('instance')
+        if room_id is None and instance is not None:
+            name = instance._meta.model_name
+            if name == 'chatroom':
+                room_id = instance.pk
+            elif name == 'chatmessage':
+                room_id = instance.room_id
+            elif name == 'attachedfile':
+                if not instance._meta.get_field('chat_message').is_cached(instance):
+                    return instance._state.db or DEFAULT_DB_ALIAS
+                room_id = instance.chat_message.room_id
+        if room_id is None:
+            return DEFAULT_DB_ALIAS
+        return shard_for_room(room_id, write=write)
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints, write=False)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints, write=True)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Messages reference rooms and users on the default database.
+        if obj1._meta.model_name in self.sharded_models or obj2._meta.model_name in self.sharded_models:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+def _copy_new(room_id, source, target, after_id, batch_size):
+    """Copy the room's messages with id > `after_id` (and their files) to `target`. Returns the last id copied."""
+    from .models import AttachedFile, ChatMessage
+
+    while True:
+        batch = list(
+            ChatMessage.objects.using(source).filter(room_id=room_id, id__gt=after_id).order_by('id')[:batch_size]
+        )
+        if not batch:
+            return after_id
+        ids = [message.id for message in batch]
+        with transaction.atomic(using=target):
+            ChatMessage.objects.using(target).bulk_create(batch, ignore_conflicts=True)
+            AttachedFile.objects.using(target).bulk_create(
+                list(AttachedFile.objects.using(source).filter(chat_message_id__in=ids)), ignore_conflicts=True
+            )
+        after_id = ids[-1]
+
+
+def _reconcile(room_id, source, target, batch_size):
+    """
+    Make the room on `target` match `source` once writes are fenced: copy
+    rows the first pass missed (ids are only roughly ordered across
+    processes), carry over edits and deletes, and drop rows gone from
+    `source` (archived meanwhile).
+    """
+    from .models import AttachedFile, ChatMessage
+
+    seen, after_id = set(), 0
+    with transaction.atomic(using=target):
+        while True:
+            batch = list(
+                ChatMessage.objects.using(source).filter(room_id=room_id, id__gt=after_id).order_by('id')[:batch_size]
+            )
+            if not batch:
+                break
+            ChatMessage.objects.using(target).bulk_create(batch, ignore_conflicts=True)
+            ChatMessage.objects.using(target).bulk_update(batch, ['message', 'is_read', 'is_deleted'])
+            files = list(AttachedFile.objects.using(source).filter(chat_message__in=[m.id for m in batch]))
+            AttachedFile.objects.using(target).bulk_create(files, ignore_conflicts=True)
+            if files:
+                AttachedFile.objects.using(target).bulk_update(files, ['variants', 'blurhash'])
+            seen.update(message.id for message in batch)
+            after_id = batch[-1].id
+
+        stale = sorted(set(
+            ChatMessage.objects.using(target).filter(room_id=room_id).values_list('id', flat=True)
+        ) - seen)
+        for start in range(0, len(stale), batch_size):
+            ChatMessage.objects.using(target).filter(id__in=stale[start:start + batch_size]).delete()
+
+
+def move_room(room_id, target, batch_size=1000, log=None):
+    """
+    Move a room's messages and attachments to the shard `target` while it
+    stays in use:
+
+      1. copy the history in batches while writes continue,
+      2. fence writes (RoomShard.moving; writers get RoomMoving) and wait
+         SHARD_DIRECTORY_TTL for every worker to see it,
+      3. copy what arrived meanwhile and reconcile edits and deletes,
+      4. point the directory at `target` and wait again for readers,
+      5. delete the room's rows from the old shard.
+
+    Reads keep working throughout. Returns the number of messages moved.
+    """
+    from .models import ChatMessage, ChatRoom, RoomShard
+
+    log = log or (lambda message: None)
+    if target not in settings.MESSAGE_SHARDS:
+        raise ValueError(f"Unknown shard {target!r}; MESSAGE_SHARDS is {settings.MESSAGE_SHARDS}.")
+    if not ChatRoom.objects.filter(id=room_id).exists():
+        raise ValueError(f"Room {room_id} does not exist.")
+    entry = RoomShard.objects.filter(room_id=room_id).first()
+    source = entry.shard if entry else DEFAULT_DB_ALIAS
+    if source == target:
+        return 0
+    # Wait TTL past the last directory change, not just the nominal TTL.
+    settle = settings.SHARD_DIRECTORY_TTL + 0.5
+
+    last_id = _copy_new(room_id, source, target, 0, batch_size)
+    log(f"Copied room {room_id} up to message {last_id}; fencing writes.")
+    RoomShard.objects.update_or_create(room_id=room_id, defaults={'shard': source, 'moving': True})
+    try:
+        time.sleep(settle)
+        _reconcile(room_id, source, target, batch_size)
+    except BaseException:
+        RoomShard.objects.filter(room_id=room_id).update(moving=False)
+        raise
+    moved = ChatMessage.objects.using(target).filter(room_id=room_id).count()
+    RoomShard.objects.filter(room_id=room_id).update(shard=target, moving=False)
+    directory.forget(room_id)
+    log(f"Room {room_id} now lives on {target}; waiting for readers to leave {source}.")
+
+    time.sleep(settle)
+    while True:
+        ids = list(
+            ChatMessage.objects.using(source).filter(room_id=room_id).values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return moved
+        ChatMessage.objects.using(source).filter(id__in=ids).delete()
+
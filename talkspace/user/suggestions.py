@@ -0,0 +1,238 @@
+"""
+Friend-of-friend suggestions.
+
+Each user's best FRIEND_SUGGESTION_LIMIT friend-of-friend candidates, ranked
+by mutual friends, are kept in FriendSuggestion, so serving them is one
+indexed read instead of self-joins over FriendRequest on every call.
+
+rebuild() recomputes one user from the friend graph and records when in
+User.suggestions_built_at. When a request is accepted, friendship_added()
+updates only the pairs the new edge changes: the two users stop being
+suggested to each other, and each becomes a candidate for the other's
+friends (and they for it) with an exact mutual count. That can push a list
+past the limit; serving reads only the top of it, and
+`refresh_friend_suggestions` (a full rebuild) trims it again. When a
+friendship ends, friendship_removed() lowers (or drops) the counts that
+went through it and suggests the two users to each other again if they
+still have friends in common.
+
+Candidates the user already has a pending or accepted request with are
+filtered out when serving. Serving never writes: a user who was never
+built gets suggestions computed on the fly while a rebuild is queued.
+"""
+import heapq
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Exists, F, OuterRef, Q, When
+from django.utils import timezone
+
+BATCH_SIZE = 500
+
+
+def _batches(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), BATCH_SIZE):
+        yield ids[start:start + BATCH_SIZE]
+
+
+def _edges(ids, others=None):
+    """Accepted friendships touching `ids` (and, if given, `others`), as (id, friend) pairs."""
+    from .models import FriendRequest
+
+    for batch in _batches(ids):
+        outgoing, incoming = Q(sender_id__in=batch), Q(receiver_id__in=batch)
+        if others is not None:
+            outgoing &= Q(receiver_id__in=others)
+            incoming &= Q(sender_id__in=others)
+        in_batch = set(batch)
+        rows = FriendRequest.objects.filter(outgoing | incoming, status='accepted').values_list('sender_id', 'receiver_id')
+        for sender_id, receiver_id in rows:
+            if sender_id in in_batch:
+                yield sender_id, receiver_id
+            if receiver_id in in_batch:
+                yield receiver_id, sender_id
+
+
+def friend_ids(user_id):
+    return {friend for _, friend in _edges([user_id])}
+
+
+def _common_friends(ids, friends):
+    """{id: its friends that are in `friends`} for each of `ids`."""
+    common = defaultdict(set)
+    if friends:
+        for user_id, friend in _edges(ids, list(friends)):
+            common[user_id].add(friend)
+    return common
+
+
+def _friends_subquery(user_id):
+    """Ids of `user_id`'s friends, as a subquery."""
+    from .models import FriendRequest
+
+    return FriendRequest.objects.filter(
+        Q(sender_id=user_id) | Q(receiver_id=user_id), status='accepted',
+    ).annotate(
+        friend=Case(When(sender_id=user_id, then=F('receiver_id')), default=F('sender_id')),
+    ).values('friend')
+
+
+def mutual_counts(user_id, other_ids):
+    """{other id: number of friends in common with `user_id`}, in one query."""
+    from .models import FriendRequest
+
+    other_ids = list(other_ids)
+    friends = _friends_subquery(user_id)
+    accepted = FriendRequest.objects.filter(status='accepted')
+    # One row per (other, common friend), from whichever side of the friendship `other` is on.
+    rows = accepted.filter(sender_id__in=other_ids, receiver_id__in=friends).values_list('sender_id').union(
+        accepted.filter(receiver_id__in=other_ids, sender_id__in=friends).values_list('receiver_id'),
+        all=True,
+    )
+    counts = Counter(other for other, in rows) if other_ids else Counter()
+    return {other: counts[other] for other in other_ids}
+
+
+def _top(counts, limit):
+    """The `limit` (candidate, mutual) pairs with most mutual friends; ties by id."""
+    return heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+def _compute(user_id, limit):
+    """`user_id`'s top `limit` (candidate, mutual) pairs, from the friend graph."""
+    friends = friend_ids(user_id)
+    via = defaultdict(set)
+    for friend, candidate in _edges(friends):
+        if candidate != user_id and candidate not in friends:
+            via[candidate].add(friend)
+    return _top({candidate: len(mutual) for candidate, mutual in via.items()}, limit)
+
+
+def rebuild(user_id, limit=None):
+    """Recompute and store `user_id`'s suggestions. Returns how many were stored."""
+    from .models import FriendSuggestion, User
+
+    top = _compute(user_id, limit or settings.FRIEND_SUGGESTION_LIMIT)
+    with transaction.atomic():
+        FriendSuggestion.objects.filter(user_id=user_id).delete()
+        FriendSuggestion.objects.bulk_create([
+            FriendSuggestion(user_id=user_id, candidate_id=candidate, mutual_friends=mutual)
+            for candidate, mutual in top
+        ])
+        User.objects.filter(id=user_id).update(suggestions_built_at=timezone.now())
+    return len(top)
+
+
+def friendship_added(user_id, friend_id):
+    """Update suggestions for a newly accepted friendship between the two users."""
+    from .models import FriendSuggestion
+
+    limit = settings.FRIEND_SUGGESTION_LIMIT
+    friends = {user_id: friend_ids(user_id), friend_id: friend_ids(friend_id)}
+    rows = []
+    for newcomer, other in ((friend_id, user_id), (user_id, friend_id)):
+        # `newcomer` is now a friend of a friend of each of other's friends.
+        reached = friends[other] - friends[newcomer] - {newcomer}
+        common = _common_friends(reached, friends[newcomer])
+        counts = {candidate: len(common[candidate]) for candidate in reached}
+        rows += [
+            FriendSuggestion(user_id=candidate, candidate_id=newcomer, mutual_friends=mutual)
+            for candidate, mutual in counts.items()
+        ]
+        # Candidates below the newcomer's top `limit` new ones could not
+        # make its list anyway.
+        rows += [
+            FriendSuggestion(user_id=newcomer, candidate_id=candidate, mutual_friends=mutual)
+            for candidate, mutual in _top(counts, limit)
+        ]
+    with transaction.atomic():
+        FriendSuggestion.objects.filter(
+            Q(user_id=user_id, candidate_id=friend_id) | Q(user_id=friend_id, candidate_id=user_id)
+        ).delete()
+        FriendSuggestion.objects.bulk_create(
+            rows,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['user', 'candidate'],
+            update_fields=['mutual_friends', 'updated_at'],
+        )
+
+
+def friendship_removed(user_id, friend_id):
+    """Update suggestions after the friendship between the two users ended."""
+    from .models import FriendSuggestion
+
+    friends = {user_id: friend_ids(user_id), friend_id: friend_ids(friend_id)}
+    counts = {}
+    lookup = Q()
+    for gone, other in ((friend_id, user_id), (user_id, friend_id)):
+        # `gone` is no longer a friend of a friend through `other`.
+        reached = friends[other] - friends[gone] - {gone}
+        common = _common_friends(reached, friends[gone])
+        for candidate in reached:
+            counts[candidate, gone] = counts[gone, candidate] = len(common[candidate])
+        if reached:
+            lookup |= Q(user_id__in=reached, candidate_id=gone) | Q(user_id=gone, candidate_id__in=reached)
+    mutual = len(friends[user_id] & friends[friend_id])
+
+    with transaction.atomic():
+        # Only rows already stored change; a lower count cannot earn a place.
+        stored = FriendSuggestion.objects.filter(lookup).values_list('id', 'user_id', 'candidate_id') if lookup else []
+        dropped, rows = [], []
+        for row_id, row_user, candidate in stored:
+            count = counts[row_user, candidate]
+            if count:
+                rows.append(FriendSuggestion(user_id=row_user, candidate_id=candidate, mutual_friends=count))
+            else:
+                dropped.append(row_id)
+        if mutual:
+            rows += [
+                FriendSuggestion(user_id=user_id, candidate_id=friend_id, mutual_friends=mutual),
+                FriendSuggestion(user_id=friend_id, candidate_id=user_id, mutual_friends=mutual),
+            ]
+        FriendSuggestion.objects.filter(id__in=dropped).delete()
+        FriendSuggestion.objects.bulk_create(
+            rows,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['user', 'candidate'],
+            update_fields=['mutual_friends', 'updated_at'],
+        )
+
+
+def _has_request(user, other):
+    """Whether `user` has a pending or accepted request with `other` (an OuterRef)."""
+    from .models import FriendRequest
+
+    return Exists(FriendRequest.objects.filter(
+        Q(sender=user, receiver=other) | Q(receiver=user, sender=other),
+        status__in=['pending', 'accepted'],
+    ))
+
+
+def suggestions_for(user, limit):
+    """
+    The user's top `limit` FriendSuggestions, candidates loaded. For a user
+    never built, they are computed from the friend graph (unsaved) and a
+    rebuild is queued, so this only reads.
+    """
+    from .models import FriendSuggestion, User
+    from .tasks import enqueue
+
+    if user.suggestions_built_at is not None:
+        return list(
+            FriendSuggestion.objects.filter(user=user, candidate__is_active=True)
+            .exclude(_has_request(user, OuterRef('candidate')))
+            .select_related('candidate')
+            .order_by('-mutual_friends', 'candidate_id')[:limit]
+        )
+
+    enqueue(rebuild, user.id)
+    top = _compute(user.id, settings.FRIEND_SUGGESTION_LIMIT)
+    candidates = User.objects.filter(id__in=[candidate for candidate, _ in top], is_active=True)
+    candidates = {candidate.id: candidate for candidate in candidates.exclude(_has_request(user, OuterRef('pk')))}
+    return [
+        FriendSuggestion(user=user, candidate=candidates[candidate], mutual_friends=mutual)
+        for candidate, mutual in top if candidate in candidates
+    ][:limit]
@@ -0,0 +1,34 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.BACKGROUND_TASK_WORKERS,
+    thread_name_prefix="talkspace-task",
+)
+
+
+def _run(func, args, kwargs):
+    """Run a task with a fresh DB connection and log (never raise) failures."""
+    close_old_connections()
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        logger.exception("Background task %s failed", getattr(func, "__name__", func))
+    finally:
+        close_old_connections()
+
+
+def enqueue(func, *args, **kwargs):
+    """
+    Schedule `func(*args, **kwargs)` on the in-process worker pool once the
+    current transaction commits, so the task never sees uncommitted rows.
+    With BACKGROUND_TASKS_EAGER the task runs inline, which is handy locally.
+    """
+    if settings.BACKGROUND_TASKS_EAGER:
+        transaction.on_commit(lambda: func(*args, **kwargs))
+        return
+    transaction.on_commit(lambda: _executor.submit(_run, func, args, kwargs))
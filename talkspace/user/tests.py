@@ -1,3 +1,357 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock, skipUnless
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.db import transaction
+from django.test import AsyncClient, TestCase, override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+from . import outbox, ratelimit, revocation, sharding
+from .routing import websocket_urlpatterns
+from .models import ChatMessage, ChatRoom, OutboxEvent, RevokedAccessToken, RoomShard, User
 
-# Create your tests here.
+# The sharding tests need a second database: run them with DB_SHARDS set,
+# e.g. DB_SHARDS=/tmp/shard1.sqlite3 python manage.py test user.
+SHARDED = 'shard1' in settings.DATABASES
+
+
+def make_user(name):
+    return User.objects.create(username=name, email=f'{name}@example.com', first_name=name, last_name='Test')
+
+
+@skipUnless(SHARDED, "DB_SHARDS is not set")
+class ShardingTests(TestCase):
+    databases = {'default', 'shard1'} if SHARDED else {'default'}
+
+    def setUp(self):
+        sharding.directory.forget()
+        self.addCleanup(sharding.directory.forget)
+        self.user = make_user('alice')
+
+    def make_room(self, shard):
+        room = ChatRoom.objects.create(name=f'room-{ChatRoom.objects.count()}', is_group_chat=True)
+        room.users.add(self.user)
+        RoomShard.objects.filter(room=room).delete()
+        if shard != 'default':
+            RoomShard.objects.create(room=room, shard=shard)
+        sharding.directory.forget(room.pk)
+        return room
+
+    def stored_on(self, message_id):
+        return [shard for shard in settings.MESSAGE_SHARDS if ChatMessage.objects.using(shard).filter(id=message_id).exists()]
+
+    def test_create_and_filter_follow_the_room_hint(self):
+        for shard in ('default', 'shard1'):
+            room = self.make_room(shard)
+            by_instance = ChatMessage.objects.create(room=room, user=self.user, message='hi')
+            by_id = ChatMessage.objects.create(room_id=room.id, user=self.user, message='there')
+
+            self.assertEqual(self.stored_on(by_instance.id), [shard])
+            self.assertEqual(self.stored_on(by_id.id), [shard])
+            self.assertEqual(
+                sorted(ChatMessage.objects.filter(room=room).values_list('id', flat=True)),
+                sorted([by_instance.id, by_id.id]),
+            )
+            self.assertEqual(ChatMessage.objects.filter(room_id=room.id).count(), 2)
+            self.assertEqual(list(room.messages.values_list('message', flat=True).order_by('id')), ['hi', 'there'])
+
+    def test_find_locates_a_message_by_id_on_any_shard(self):
+        message = ChatMessage.objects.create(room=self.make_room('shard1'), user=self.user, message='hi')
+        self.assertEqual(sharding.find(ChatMessage.objects.filter(id=message.id)).message, 'hi')
+        self.assertIsNone(sharding.find(ChatMessage.objects.filter(id=message.id + 1)))
+
+    def test_writes_to_a_moving_room_raise_room_moving(self):
+        room = self.make_room('shard1')
+        message = ChatMessage.objects.create(room=room, user=self.user, message='hi')
+        RoomShard.objects.filter(room=room).update(moving=True)
+        sharding.directory.forget(room.pk)
+
+        with self.assertRaises(sharding.RoomMoving):
+            ChatMessage.objects.create(room=room, user=self.user, message='blocked')
+        with self.assertRaises(sharding.RoomMoving):
+            message.message = 'edited'
+            message.save(update_fields=['message'])
+        # Reads keep working while the room is fenced.
+        self.assertEqual(list(ChatMessage.objects.filter(room=room).values_list('message', flat=True)), ['hi'])
+
+    @override_settings(SHARD_DIRECTORY_TTL=60)
+    def test_move_room_keeps_every_message_and_id(self):
+        room = self.make_room('default')
+        messages = [ChatMessage.objects.create(room=room, user=self.user, message=f'm{i}') for i in range(7)]
+        messages[2].message = 'edited'
+        messages[2].save(update_fields=['message'])
+        messages[4].is_deleted = True
+        messages[4].save(update_fields=['is_deleted'])
+        before = {message.id: (message.message, message.is_deleted) for message in messages}
+        self.assertEqual(sharding.shard_for_room(room.id), 'default')
+
+        with mock.patch('user.sharding.time.sleep'):
+            moved = sharding.move_room(room.id, 'shard1', batch_size=3)
+
+        self.assertEqual(moved, len(messages))
+        after = dict(
+            (message_id, (text, deleted)) for message_id, text, deleted in
+            ChatMessage.objects.using('shard1').filter(room=room).values_list('id', 'message', 'is_deleted')
+        )
+        self.assertEqual(after, before)
+        self.assertFalse(ChatMessage.objects.using('default').filter(room_id=room.id).exists())
+        self.assertEqual(RoomShard.objects.values_list('shard', 'moving').get(room=room), ('shard1', False))
+        # The move drops the cached directory entry despite the long TTL.
+        self.assertEqual(sharding.shard_for_room(room.id, write=True), 'shard1')
+        self.assertEqual(ChatMessage.objects.filter(room=room).count(), len(messages))
+
+    def test_fan_in_merges_shards_in_order(self):
+        rooms = [self.make_room('default'), self.make_room('shard1')]
+        ids = [ChatMessage.objects.create(room=rooms[i % 2], user=self.user, message=str(i)).id for i in range(6)]
+
+        rows = sharding.fan_in(
+            ChatMessage.objects.all(), [room.id for room in rooms],
+            build=lambda queryset: queryset.order_by('-id')[:4],
+            key=lambda message: message.id, reverse=True, limit=4,
+        )
+        self.assertEqual([message.id for message in rows], sorted(ids, reverse=True)[:4])
+        self.assertEqual({message._state.db for message in rows}, {'default', 'shard1'})
+
+    def test_ids_increase_and_fit_in_53_bits(self):
+        allocator = sharding._IdAllocator()
+        # More ids than one millisecond's sequence holds, with the clock stopped.
+        with mock.patch('user.sharding.time.time', return_value=1750000000.0):
+            ids = [allocator.next() for _ in range(3 << sharding.SEQUENCE_BITS)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertLess(ids[-1], 2 ** 53)
+
+
+class RecordingLayer:
+    """Channel layer stand-in that records group_send calls, or fails them."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sent = []
+
+    async def group_send(self, group, message):
+        if self.fail:
+            raise ConnectionError("channel layer down")
+        self.sent.append((group, message))
+
+
+class OutboxTests(TestCase):
+    def send_batch(self, layer):
+        with mock.patch('user.outbox.get_channel_layer', return_value=layer):
+            return outbox.relay._send_batch()
+
+    def test_nothing_is_sent_before_commit(self):
+        layer = RecordingLayer()
+        with mock.patch.object(outbox.relay, 'wake') as wake:
+            with self.captureOnCommitCallbacks() as callbacks:
+                outbox.publish('chat_1', {'type': 'chat_message', 'message': 'hi'})
+                wake.assert_not_called()
+            self.assertEqual(len(callbacks), 1)
+            callbacks[0]()
+            wake.assert_called_once()
+        self.assertEqual(layer.sent, [])
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+    def test_rollback_drops_the_event(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                outbox.publish('chat_1', {'type': 'chat_message', 'message': 'hi'})
+                raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual(self.send_batch(RecordingLayer()), 0)
+
+    def test_events_are_sent_in_id_order_per_group(self):
+        for n in range(3):
+            outbox.publish('chat_1', {'type': 'chat_message', 'n': n})
+        outbox.publish('chat_2', {'type': 'read_receipt', 'n': 9})
+        layer = RecordingLayer()
+
+        self.assertEqual(self.send_batch(layer), 4)
+        self.assertEqual(dict(layer.sent), {
+            'chat_1': {'type': 'outbox_batch', 'events': [{'type': 'chat_message', 'n': n} for n in range(3)]},
+            'chat_2': {'type': 'read_receipt', 'n': 9},
+        })
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    @override_settings(OUTBOX_BATCH_SIZE=2)
+    def test_batches_continue_in_id_order(self):
+        for n in range(5):
+            outbox.publish('chat_1', {'type': 'chat_message', 'n': n})
+        layer = RecordingLayer()
+        while self.send_batch(layer):
+            pass
+        sent = [message.get('events', [message]) for _, message in layer.sent]
+        self.assertEqual([event['n'] for events in sent for event in events], list(range(5)))
+
+    def test_failed_send_keeps_the_rows_for_the_next_pass(self):
+        outbox.publish('chat_1', {'type': 'chat_message', 'n': 1})
+        with self.assertRaises(ConnectionError):
+            self.send_batch(RecordingLayer(fail=True))
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+        layer = RecordingLayer()
+        self.assertEqual(self.send_batch(layer), 1)
+        self.assertEqual(layer.sent, [('chat_1', {'type': 'chat_message', 'n': 1})])
+        self.assertFalse(OutboxEvent.objects.exists())
+
+
+@override_settings(RATE_LIMITS={}, SYNC_THREAD_POOL_SIZE=0, REVOCATION_SYNC_INTERVAL=float('inf'))
+class RevocationTests(TestCase):
+    def setUp(self):
+        # A fresh filter per test, as if this were a newly started worker.
+        patcher = mock.patch.object(revocation, 'revocations', revocation._Revocations())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = make_user('alice')
+        self.refresh = RefreshToken.for_user(self.user)
+        self.access = self.refresh.access_token
+        self.auth = f'Bearer {self.access}'
+
+    def revoke(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            revocation.revoke(self.access, self.user)
+
+    def test_logout_revokes_the_access_token_on_sync_views(self):
+        self.assertEqual(self.client.get('/users/user-detail/', HTTP_AUTHORIZATION=self.auth).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                '/users/logout/', {'refresh': str(self.refresh)}, HTTP_AUTHORIZATION=self.auth,
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 205)
+        self.assertEqual(self.client.get('/users/user-detail/', HTTP_AUTHORIZATION=self.auth).status_code, 401)
+
+    async def test_revoked_token_is_rejected_on_async_views(self):
+        client, headers = AsyncClient(), {'Authorization': self.auth}
+        self.assertEqual((await client.get('/users/chatrooms/', headers=headers)).status_code, 200)
+        await revocation.database_sync_to_async(self.revoke)()
+        self.assertEqual((await client.get('/users/chatrooms/', headers=headers)).status_code, 401)
+
+    def test_sync_picks_up_revocations_from_other_workers(self):
+        jti = self.access['jti']
+        self.assertFalse(revocation.is_revoked(self.access))
+        # Another worker's revoke() writes the row but cannot touch this filter.
+        RevokedAccessToken.objects.create(jti=jti, user=self.user, expires_at=timezone.now() + timedelta(minutes=5))
+        self.assertFalse(revocation.is_revoked(self.access))
+
+        revocation.revocations.sync(force=True)
+        self.assertTrue(revocation.is_revoked(self.access))
+
+    @override_settings(REVOCATION_FILTER_CAPACITY=2)
+    def test_rebuild_sizes_the_filter_for_the_live_rows(self):
+        expires_at = timezone.now() + timedelta(minutes=5)
+        RevokedAccessToken.objects.bulk_create(
+            [RevokedAccessToken(jti=f'jti-{n}', expires_at=expires_at) for n in range(5)]
+        )
+        with self.assertLogs('user.revocation', 'WARNING'):
+            revocation.revocations.sync(force=True)
+        bloom = revocation.revocations._filter
+        self.assertEqual((bloom.count, bloom.capacity), (5, 10))
+        # The next sync reads new rows instead of rebuilding a full filter.
+        with mock.patch.object(revocation.revocations, '_rebuild') as rebuild:
+            revocation.revocations.sync(force=True)
+        rebuild.assert_not_called()
+
+    def test_compact_deletes_expired_rows(self):
+        now = timezone.now()
+        RevokedAccessToken.objects.bulk_create([
+            RevokedAccessToken(jti='expired', expires_at=now - timedelta(seconds=1)),
+            RevokedAccessToken(jti='live', expires_at=now + timedelta(minutes=5)),
+        ])
+        self.refresh.blacklist()
+        OutstandingToken.objects.update(expires_at=now - timedelta(seconds=1))
+
+        self.assertEqual(revocation.compact(batch_size=1), {'revoked': 1, 'outstanding': 1, 'blacklisted': 1})
+        self.assertEqual(list(RevokedAccessToken.objects.values_list('jti', flat=True)), ['live'])
+        self.assertFalse(OutstandingToken.objects.exists())
+
+
+class Clock:
+    """Stands in for time.time() so rate-limit tests control the refill."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.clock = Clock(1000.0)
+        self.store = ratelimit.MemoryStore()
+        for patcher in (mock.patch('user.ratelimit.time.time', self.clock),
+                        mock.patch.object(ratelimit, '_store', self.store)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_token_bucket_allows_a_burst_then_refills(self):
+        take = lambda: ratelimit.token_bucket(self.store, 'rl:test', 6, 60, 3)
+        self.assertEqual([take() for _ in range(3)], [(True, 0)] * 3)
+        allowed, retry_after = take()
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 10)
+
+        self.clock.now += 10
+        self.assertEqual(take(), (True, 0))
+        self.assertFalse(take()[0])
+        # Refill stops at the burst size however long the bucket sat idle.
+        self.clock.now += 3600
+        self.assertEqual([take()[0] for _ in range(4)], [True, True, True, False])
+
+    def test_sliding_window_weights_the_previous_window(self):
+        take = lambda: ratelimit.sliding_window(self.store, 'rl:test', 2, 10)
+        self.clock.now = 1005.0
+        self.assertEqual([take(), take()], [(True, 0), (True, 0)])
+        allowed, retry_after = take()
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 5)
+
+        # Right after the boundary the previous window still counts in full.
+        self.clock.now = 1010.0
+        self.assertFalse(take()[0])
+        # A quarter of the way in, it counts for 1.5 of the 2 allowed.
+        self.clock.now = 1012.5
+        self.assertEqual(take(), (True, 0))
+        allowed, retry_after = take()
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 2.5)
+        self.clock.now += retry_after + 0.1
+        self.assertEqual(take(), (True, 0))
+
+    @override_settings(RATE_LIMITS={'login': {'rate': '2/min', 'burst': 2}, 'search': {'rate': '2/min', 'burst': 1}})
+    def test_throttled_views_return_429_with_retry_after(self):
+        user = make_user('alice')
+        auth = f'Bearer {RefreshToken.for_user(user).access_token}'
+        requests = {
+            'login': lambda: self.client.post('/users/login/', {'email': 'alice@example.com', 'password': 'wrong'}),
+            'search': lambda: self.client.get('/users/user-search/bob/', HTTP_AUTHORIZATION=auth),
+        }
+        for scope, request in requests.items():
+            with self.subTest(scope):
+                burst = settings.RATE_LIMITS[scope]['burst']
+                self.assertNotIn(429, [request().status_code for _ in range(burst)])
+                response = request()
+                self.assertEqual(response.status_code, 429)
+                self.assertEqual(response['Retry-After'], '30')
+
+    @override_settings(RATE_LIMITS={'chat_user': {'rate': '1/min', 'burst': 1}})
+    async def test_chat_frames_over_the_limit_get_an_error_frame(self):
+        user = await User.objects.acreate(
+            username='alice', email='alice@example.com', first_name='alice', last_name='Test',
+        )
+        room = await ChatRoom.objects.acreate(name='room', is_group_chat=True)
+        ratelimit.check('chat_user', f'user:{user.id}')
+
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{room.id}/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({'message': 'hi'})
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual((frame['action'], frame['retry_after']), ('error', 60))
+        self.assertFalse(await ChatMessage.objects.filter(room_id=room.id).aexists())
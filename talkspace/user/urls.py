@@ -6,23 +6,37 @@ from .views import (
     ChatMessageListCreateView, PendingFriendRequestsView, OfferView, 
     AnswerView, GetAnswerView, GetOfferView, IceCandidateView, 
     SetAnswerView, SetOfferView, UserDetailAPIView, ShareFilesInRoomAPIView,
-    ViewChatMessageAPIView, ForgotPasswordView, ResetPasswordView
+    ViewChatMessageAPIView, ForgotPasswordView, ResetPasswordView,
+    AttachedFileDownloadView, MarkMessagesReadView, ChatRoomReadReceiptsView,
+    BulkDeleteMessagesView, BulkEditMessagesView, PurgeUserMessagesView,
+    MetricsView, MessageSearchView, UserProvisionView, ContactMatchView,
+    BulkFriendRequestView, FriendSuggestionsView
 )
 
 urlpatterns = [
     path('register/', UserRegistrationView.as_view(), name='user_register'),
+    path('provision/', UserProvisionView.as_view(), name='user_provision'),
     path('login/', UserLoginView.as_view(), name='user_login'),
     path('users-list/', UserListView.as_view(), name='user_list'),
     path("user-detail/", UserDetailAPIView.as_view(), name="user-detail"),
     path('user-search/<str:query>/', UserSearchView.as_view(), name='user-search'),
     path('send-friend-request/', SendFriendRequestView.as_view(), name='send-friend-request'),
+    path('send-friend-requests/bulk/', BulkFriendRequestView.as_view(), name='send-friend-requests-bulk'),
+    path('contacts/match/', ContactMatchView.as_view(), name='contacts-match'),
     path('respond-to-friend-request/<int:request_id>/', RespondToFriendRequestView.as_view(), name='respond-to-friend-request'),
+    path('friend-suggestions/', FriendSuggestionsView.as_view(), name='friend-suggestions'),
     path('pending-requests/', PendingFriendRequestsView.as_view(), name='pending_requests'),
     path('friend-list/', FriendsListView.as_view(), name='friend-list'),
     path('logout/', UserLogoutView.as_view(), name='user-logout'),
     path('chatrooms/', ChatRoomListCreateView.as_view(), name='chatroom-list-create'),
     path('chatrooms/<int:pk>/', ChatRoomDetailView.as_view(), name='chatroom-detail'),
+    path('chatrooms/<int:pk>/receipts/', ChatRoomReadReceiptsView.as_view(), name='chatroom-receipts'),
     path('messages/', ChatMessageListCreateView.as_view(), name='chatmessage-list-create'),
+    path('messages/search/', MessageSearchView.as_view(), name='chatmessage-search'),
+    path('messages/read/', MarkMessagesReadView.as_view(), name='chatmessage-read'),
+    path('messages/bulk-delete/', BulkDeleteMessagesView.as_view(), name='chatmessage-bulk-delete'),
+    path('messages/bulk-edit/', BulkEditMessagesView.as_view(), name='chatmessage-bulk-edit'),
+    path('messages/purge/', PurgeUserMessagesView.as_view(), name='chatmessage-purge'),
     path('offer/', OfferView.as_view(), name='offer'),
     path('offer/<str:peer_id>/', GetOfferView.as_view(), name='get_offer'),
     path('offer/<str:peer_id>/set/', SetOfferView.as_view(), name='set_offer'),
@@ -33,6 +47,8 @@ urlpatterns = [
     path('ice_candidate/<str:peer_id>/', IceCandidateView.as_view(), name='get_ice_candidates'),
     path('share-files-in-room/', ShareFilesInRoomAPIView.as_view(), name='share-files-in-room'),
     path('chat/<uuid:token>/', ViewChatMessageAPIView.as_view(), name='view_chat_message'),  # From previous response
+    path('files/<int:file_id>/download/', AttachedFileDownloadView.as_view(), name='attachment-download'),
     path('forgot-password/', ForgotPasswordView.as_view(), name='forgot-password'),
     path('reset-password/', ResetPasswordView.as_view(), name='reset-password'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
@@ -1,6 +1,15 @@
+from functools import lru_cache
 from django.core.mail import EmailMultiAlternatives
 from django.conf import settings
-from django.template.loader import render_to_string
+from django.template.loader import get_template
+from . import mailer
+
+
+@lru_cache(maxsize=None)
+def _get_email_template(name):
+    """Load and compile an email template once per process."""
+    return get_template(name)
+
 
 def send_password_reset_email(user, reset_link):
     subject = "Reset Your Password"
@@ -21,8 +30,8 @@ Click the link below to reset your password:
 If you didn't request a password reset, you can safely ignore this email.
 """
 
-    html_content = render_to_string('emails/reset_password_email.html', context)
+    html_content = _get_email_template('emails/reset_password_email.html').render(context)
 
     msg = EmailMultiAlternatives(subject, text_content, from_email, [to_email])
     msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    mailer.enqueue(msg)
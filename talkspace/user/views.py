@@ -1,12 +1,32 @@
+from contextlib import ExitStack
+from functools import partial
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from asgiref.sync import sync_to_async
+from .asyncapi import AsyncAPIView
 from .serializers import UserRegistrationSerializer , UserLoginSerializer,  UserListSerializer, FriendRequestSerializer,FriendSerializer, UserSerializer, ForgotPasswordSerializer, ResetPasswordSerializer
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from .serializers import BulkFriendRequestSerializer, ContactMatchSerializer, ContactUserSerializer
+from .serializers import BulkEditMessagesSerializer, BulkMessageIdsSerializer, MarkReadSerializer, PurgeUserMessagesSerializer
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
+from rest_framework.parsers import MultiPartParser
 from django.db.models import Q
 from rest_framework_simplejwt.tokens import RefreshToken
-from django.db.models import Count
+from django.db.models import Count, Case, When, Value
+from django.conf import settings
 from .models import User,FriendRequest
+from .media import avatar_url, attachment_data, process_attached_file, process_profile_picture
+from .sendfile import sendfile_response
+from .tasks import enqueue
+from .ratelimit import ContactMatchRateThrottle, LoginRateThrottle, PasswordResetRateThrottle, SearchRateThrottle
+from .cache import message_cache
+from .routers import reads_from_replica
+from . import metrics, revocation, sharding, suggestions
+from .metrics import database_sync_to_async
+from django.http import Http404, HttpResponse
+from .archive import amessage_page, full_history
+from .provisioning import FORMATS as PROVISION_FORMATS, guess_format, provision
+from .contacts import friendship_status, match_contacts, send_friend_requests
 
 class UserRegistrationView(APIView):
     permission_classes = [AllowAny]
@@ -14,16 +34,47 @@ class UserRegistrationView(APIView):
         serializer = UserRegistrationSerializer(data=request.data)
         if serializer.is_valid():
             user = serializer.save()
+            if user.profile_picture:
+                enqueue(process_profile_picture, user.id)
             return Response({"message": "User registered successfully!"}, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
-class UserLoginView(APIView):
-    permission_classes = [AllowAny]
+class UserProvisionView(APIView):
+    """
+    Staff-only bulk import: a CSV or NDJSON `file` (format from `input_format`
+    or the file extension). Returns the created count and the skipped rows.
+    For very large files prefer the `provision_users` command.
+    """
+    permission_classes = [IsAdminUser]
+    parser_classes = [MultiPartParser]
+
     def post(self, request):
+        upload = request.FILES.get('file')
+        if not upload:
+            return Response({"error": "A file is required."}, status=status.HTTP_400_BAD_REQUEST)
+        input_format = request.data.get('input_format') or guess_format(upload.name)
+        if input_format not in PROVISION_FORMATS:
+            return Response(
+                {"error": f"input_format must be one of: {', '.join(PROVISION_FORMATS)}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        report = provision(upload, input_format)
+        return Response(report, status=status.HTTP_200_OK)
+
+class UserLoginView(AsyncAPIView):
+    """
+    Async so that waiting on the password hashing pool holds neither the
+    event loop nor the sync thread other views run in.
+    """
+    permission_classes = [AllowAny]
+    throttle_classes = [LoginRateThrottle]
+
+    async def post(self, request):
         serializer = UserLoginSerializer(data=request.data)
         if serializer.is_valid():
-            user = serializer.validated_data
-            tokens = serializer.get_tokens_for_user(user)
+            user = await serializer.aauthenticate()
+            # Issuing a refresh token records it in the blacklist app's table.
+            tokens = await database_sync_to_async(serializer.get_tokens_for_user)(user)
             return Response({"message": "Login successful", "tokens": tokens, "user_id": user.id}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 class UserDetailAPIView(APIView):
@@ -38,11 +89,14 @@ class UserDetailAPIView(APIView):
         return Response(serializer.data)
 
     def put(self, request):
-        print("Request data:", request.data)
-        print("Request files:", request.FILES)
         serializer = UserSerializer(request.user, data=request.data, partial=True)
         if serializer.is_valid():
-            serializer.save()
+            picture_changed = 'profile_picture' in serializer.validated_data
+            user = serializer.save()
+            if picture_changed and user.profile_picture:
+                enqueue(process_profile_picture, user.id)
+            # Cached messages embed the author's name and avatar URL.
+            message_cache.forget_user(user.id)
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -55,6 +109,7 @@ class UserDetailAPIView(APIView):
 
 class UserListView(APIView):
     permission_classes = [IsAuthenticated]
+    @reads_from_replica
     def get(self, request):
         users = User.objects.all()
         serializer = UserListSerializer(users, many=True)
@@ -62,6 +117,7 @@ class UserListView(APIView):
 
 class ForgotPasswordView(APIView):
     permission_classes = [AllowAny]
+    throttle_classes = [PasswordResetRateThrottle]
 
     def post(self, request):
         serializer = ForgotPasswordSerializer(data=request.data)
@@ -81,20 +137,51 @@ class ResetPasswordView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class UserSearchView(APIView):
+    """
+    Other users whose username, first or last name contains the query, paged
+    by id_page(). `?mutual_friends=1` adds each one's mutual friend count.
+    """
     permission_classes = [IsAuthenticated]
+    throttle_classes = [SearchRateThrottle]
 
+    @reads_from_replica
     def get(self, request, query):
-        users = list(User.objects.filter(
+        users = User.objects.filter(
             Q(username__icontains=query) |
             Q(first_name__icontains=query) |
             Q(last_name__icontains=query)
-        ))  # Convert QuerySet to list to avoid AttributeError
+        ).exclude(id=request.user.id)
+        try:
+            users, next_before = id_page(request, users)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        if not users:
+        if not users and 'before' not in request.query_params:
             return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
 
         serializer = UserListSerializer(users, many=True)  # Ensure many=True
-        return Response({"users": serializer.data}, status=status.HTTP_200_OK)
+        results = serializer.data
+        if request.query_params.get('mutual_friends') in ('1', 'true'):
+            counts = suggestions.mutual_counts(request.user.id, [user.id for user in users])
+            for user, data in zip(users, results):
+                data['mutual_friends'] = counts[user.id]
+        return Response({"users": results, "next_before": next_before}, status=status.HTTP_200_OK)
+
+
+class FriendSuggestionsView(APIView):
+    """People the user may know, ranked by mutual friends (`?limit=`, default 20)."""
+    permission_classes = [IsAuthenticated]
+
+    @reads_from_replica
+    def get(self, request):
+        limit = min(get_limit(request) or 20, settings.FRIEND_SUGGESTION_LIMIT)
+        rows = suggestions.suggestions_for(request.user, limit)
+        return Response({
+            "suggestions": [
+                {"user": ContactUserSerializer(row.candidate).data, "mutual_friends": row.mutual_friends}
+                for row in rows
+            ]
+        })
 
 
 class SendFriendRequestView(APIView):
@@ -114,11 +201,62 @@ class SendFriendRequestView(APIView):
             )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class BulkFriendRequestView(APIView):
+    """Send friend requests to many users (e.g. contact matches) in one insert."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = BulkFriendRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        created, skipped = send_friend_requests(request.user, serializer.validated_data['user_ids'])
+        return Response(
+            {
+                "message": f"{len(created)} friend requests sent.",
+                "friend_requests": FriendRequestSerializer(created, many=True).data,
+                "skipped": [{"user_id": user_id, "error": error} for user_id, error in skipped],
+            },
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
+        )
+
+class ContactMatchView(APIView):
+    """
+    Match address-book phone numbers and emails (plain or hashed) against
+    registered users. Each match carries the contact it was found by and the
+    current friendship status, if any.
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [ContactMatchRateThrottle]
+
+    @reads_from_replica
+    def post(self, request):
+        serializer = ContactMatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        matches = match_contacts(request.user, **serializer.validated_data)
+        statuses = friendship_status(request.user, [user.id for _, user in matches])
+        return Response({
+            "matches": [
+                {
+                    "contact": contact,
+                    "user": ContactUserSerializer(user).data,
+                    "friendship": statuses.get(user.id),
+                }
+                for contact, user in matches
+            ]
+        })
+
 class PendingFriendRequestsView(APIView):
+    """Friend requests waiting for the user, newest first, paged by id_page()."""
     permission_classes = [IsAuthenticated]
 
+    @reads_from_replica
     def get(self, request):
-        requests = FriendRequest.objects.filter(receiver=request.user, status='pending')
+        requests = FriendRequest.objects.filter(receiver=request.user, status='pending').select_related('sender')
+        try:
+            requests, next_before = id_page(request, requests)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         serialized_requests = [
             {
                 "id": req.id,
@@ -126,7 +264,7 @@ class PendingFriendRequestsView(APIView):
             }
             for req in requests
         ]
-        return Response({"requests": serialized_requests})
+        return Response({"requests": serialized_requests, "next_before": next_before})
 
 class RespondToFriendRequestView(APIView):
     permission_classes = [IsAuthenticated]
@@ -139,19 +277,32 @@ class RespondToFriendRequestView(APIView):
 
         action = request.data.get('action')
         if action == 'accept':
+            newly_accepted = friend_request.status != 'accepted'
             friend_request.status = 'accepted'
             friend_request.save()
+            if newly_accepted:
+                enqueue(suggestions.friendship_added, friend_request.sender_id, friend_request.receiver_id)
             return Response({"message": "Friend request accepted!"}, status=status.HTTP_200_OK)
         elif action == 'reject':
+            was_accepted = friend_request.status == 'accepted'
             friend_request.status = 'rejected'
             friend_request.save()
+            if was_accepted:
+                enqueue(suggestions.friendship_removed, friend_request.sender_id, friend_request.receiver_id)
             return Response({"message": "Friend request rejected."}, status=status.HTTP_200_OK)
         else:
             return Response({"error": "Invalid action."}, status=status.HTTP_400_BAD_REQUEST)
     
 class FriendsListView(APIView):
+    """
+    The user's friends, most recent friendship first. `?search=` matches the
+    friend's username, first or last name; `?limit=N&before=<id>` pages
+    (default DEFAULT_PAGE_SIZE), with `next_before` continuing from the last
+    friend returned.
+    """
     permission_classes = [IsAuthenticated]
 
+    @reads_from_replica
     def get(self, request):
         user = request.user
         search_query = request.query_params.get("search", "").strip()
@@ -163,18 +314,31 @@ class FriendsListView(APIView):
         ).select_related("sender", "receiver")
 
         if search_query:
-            # Build a query to filter friend requests by user's attributes.
+            # Match on the friend's side of each friendship, whichever side that is.
+            # The substring match cannot use an index; it only scans the rows
+            # the (sender, status) / (receiver, status) indexes already narrowed
+            # to this user's friendships.
+            def friend_matches(side):
+                return (
+                    Q(**{f"{side}__username__icontains": search_query}) |
+                    Q(**{f"{side}__first_name__icontains": search_query}) |
+                    Q(**{f"{side}__last_name__icontains": search_query})
+                )
             friends_qs = friends_qs.filter(
-                Q(sender__first_name__icontains=search_query) |
-                Q(receiver__username__icontains=search_query) |
-                Q(receiver__first_name__icontains=search_query)
+                (Q(sender=user) & friend_matches("receiver")) |
+                (Q(receiver=user) & friend_matches("sender"))
             )
 
+        try:
+            friendships, next_before = id_page(request, friends_qs)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         # Extract the friend object: If the sender is the current user, take the receiver; otherwise, sender.
-        friends = [f.sender if f.sender != user else f.receiver for f in friends_qs]
+        friends = [f.sender if f.sender_id != user.id else f.receiver for f in friendships]
 
         serializer = FriendSerializer(friends, many=True)
-        return Response({"friends": serializer.data}, status=200)
+        return Response({"friends": serializer.data, "next_before": next_before}, status=200)
 
 class UserLogoutView(APIView):
     permission_classes = [IsAuthenticated]
@@ -184,22 +348,62 @@ class UserLogoutView(APIView):
             refresh_token = request.data["refresh"]
             token = RefreshToken(refresh_token)
             token.blacklist()
+            # The access token would otherwise stay valid until it expires.
+            revocation.revoke(request.auth, request.user)
             return Response({"message": "Logout successful!"}, status=status.HTTP_205_RESET_CONTENT)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
 
-from .models import ChatRoom, ChatMessage
+from .models import ChatRoom, ChatMessage, AttachedFile, RoomReadMarker
 from .serializers import ChatRoomSerializer, ChatMessageSerializer
-from django.shortcuts import get_object_or_404
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+from django.shortcuts import aget_object_or_404, get_object_or_404
 from django.db import transaction
-class ChatRoomListCreateView(APIView):
+from .outbox import publish
+
+
+DEFAULT_PAGE_SIZE = 50
+
+
+def get_limit(request):
+    """Parse the optional `limit` query parameter (newest N messages)."""
+    limit = request.query_params.get('limit')
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        return 0
+    return limit if limit > 0 else 0
+
+
+def id_page(request, queryset):
+    """
+    Keyset page of `queryset`, newest id first: `?limit=N` returns N rows
+    (default DEFAULT_PAGE_SIZE) and `&before=<id>` continues below that id.
+    Returns (rows, next_before), the latter None on the last page. Raises
+    ValueError for malformed parameters.
+    """
+    limit = get_limit(request)
+    if limit == 0:
+        raise ValueError("limit must be a positive integer.")
+    before = request.query_params.get('before')
+    if before is not None and not before.isdigit():
+        raise ValueError("before must be an id.")
+    queryset = queryset.order_by('-id')
+    if before:
+        queryset = queryset.filter(id__lt=int(before))
+    limit = limit or DEFAULT_PAGE_SIZE
+    rows = list(queryset[:limit + 1])
+    return rows[:limit], rows[limit - 1].id if len(rows) > limit else None
+
+
+class ChatRoomListCreateView(AsyncAPIView):
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, *args, **kwargs):
+    @reads_from_replica
+    async def get(self, request, *args, **kwargs):
         """Retrieve chat rooms for the authenticated user with other users."""
         chatrooms = ChatRoom.objects.filter(
             is_deleted=False,
@@ -207,9 +411,9 @@ class ChatRoomListCreateView(APIView):
         ).prefetch_related("users")  # Prefetch users to optimize queries
 
         chatroom_data = []
-        for chatroom in chatrooms:
+        async for chatroom in chatrooms:
             # Get other users in the chat excluding the authenticated user
-            other_users = chatroom.users.exclude(id=request.user.id)
+            other_users = [user for user in chatroom.users.all() if user.id != request.user.id]
             other_users_data = UserListSerializer(other_users, many=True).data  # Serialize other users
             
             chatroom_info = ChatRoomSerializer(chatroom).data
@@ -219,7 +423,10 @@ class ChatRoomListCreateView(APIView):
 
         return Response(chatroom_data, status=status.HTTP_200_OK)
 
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, *args, **kwargs):
+        return await database_sync_to_async(self.create_room)(request)
+
+    def create_room(self, request):
         """Create or get a chat room (DM or group based on number of users)."""
         other_user_ids = request.data.get("user_ids", [])
         group_name = request.data.get("name", "").strip()
@@ -279,28 +486,48 @@ class ChatRoomListCreateView(APIView):
         serializer = ChatRoomSerializer(chatroom)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-class ChatRoomDetailView(APIView):
+class ChatRoomDetailView(AsyncAPIView):
     permission_classes = [IsAuthenticated]
 
     def get_object(self, pk):
         return get_object_or_404(ChatRoom, pk=pk, is_deleted=False, users=self.request.user)
 
-    def get(self, request, pk, *args, **kwargs):
-        """Retrieve chat room details with messages and exclude the requesting user."""
-        chatroom = self.get_object(pk)
-        messages = ChatMessage.objects.filter(room=chatroom).order_by('timestamp')
-        other_users = chatroom.users.exclude(id=request.user.id)
+    @reads_from_replica
+    async def get(self, request, pk, *args, **kwargs):
+        """
+        Retrieve chat room details with messages and exclude the requesting user.
+        With `?limit=N` only the newest N non-deleted messages are returned,
+        served from the hot-room cache when possible. Archived messages are
+        included transparently.
+        """
+        limit = get_limit(request)
+        if limit == 0:
+            return Response({"error": "limit must be a positive integer."}, status=status.HTTP_400_BAD_REQUEST)
+
+        chatroom = await aget_object_or_404(
+            ChatRoom.objects.prefetch_related('users'), pk=pk, is_deleted=False, users=request.user
+        )
+        if limit:
+            messages = await amessage_page(chatroom.id, limit)
+        else:
+            messages = await database_sync_to_async(full_history)(chatroom.id, include_deleted=True)
+        other_users = [user for user in chatroom.users.all() if user.id != request.user.id]
         other_users_serializer = UserListSerializer(other_users, many=True)
         chatroom_serializer = ChatRoomSerializer(chatroom)
-        message_serializer = ChatMessageSerializer(messages, many=True)
 
         return Response({
             "chat_room": chatroom_serializer.data,
             "other_users": other_users_serializer.data,  # Filtered users list
-            "messages": message_serializer.data
+            "messages": messages
         }, status=status.HTTP_200_OK)
 
-    def put(self, request, pk, *args, **kwargs):
+    async def put(self, request, pk, *args, **kwargs):
+        return await database_sync_to_async(self.update_room)(request, pk)
+
+    async def delete(self, request, pk, *args, **kwargs):
+        return await database_sync_to_async(self.delete_room)(request, pk)
+
+    def update_room(self, request, pk):
         """Update chat room details."""
         chatroom = self.get_object(pk)
         serializer = ChatRoomSerializer(chatroom, data=request.data, partial=True)
@@ -309,21 +536,31 @@ class ChatRoomDetailView(APIView):
             return Response(serializer.data, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    def delete(self, request, pk, *args, **kwargs):
+    def delete_room(self, request, pk):
         """Soft delete a chat room."""
         chatroom = self.get_object(pk)
         chatroom.is_deleted = True
         chatroom.save()
+        message_cache.invalidate(chatroom.id)
         return Response(
             {"detail": "Chat room deleted successfully."},
             status=status.HTTP_204_NO_CONTENT
         )
-import datetime
-class ChatMessageListCreateView(APIView):
+class ChatMessageListCreateView(AsyncAPIView):
+    """
+    Each write and its broadcast go through the outbox in one transaction, as
+    for every other room event, so they reach the room in commit order. The
+    transactions are sync, so the writes run on the sync thread pool.
+    """
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, *args, **kwargs):
-        """Retrieve messages for a specific room."""
+    @reads_from_replica
+    async def get(self, request, *args, **kwargs):
+        """
+        Retrieve messages for a specific room, across hot and archived storage.
+        `?limit=N` returns the newest N; add `&before=<message_id>` to page
+        further back.
+        """
         room_id = request.query_params.get('room_id')
         if not room_id:
             return Response(
@@ -331,13 +568,23 @@ class ChatMessageListCreateView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        room = get_object_or_404(ChatRoom, id=room_id, is_deleted=False, users=request.user)
+        limit = get_limit(request)
+        if limit == 0:
+            return Response({"error": "limit must be a positive integer."}, status=status.HTTP_400_BAD_REQUEST)
+
+        before = request.query_params.get('before')
+        if before is not None and not before.isdigit():
+            return Response({"error": "before must be a message id."}, status=status.HTTP_400_BAD_REQUEST)
+
+        room = await aget_object_or_404(ChatRoom, id=room_id, is_deleted=False, users=request.user)
+        if limit or before:
+            messages = await amessage_page(room.id, limit or DEFAULT_PAGE_SIZE, int(before) if before else None)
+            return Response(messages, status=status.HTTP_200_OK)
+
         # Only fetch non-deleted messages
-        messages = ChatMessage.objects.filter(room=room, is_deleted=False).order_by('timestamp')
-        serializer = ChatMessageSerializer(messages, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(await database_sync_to_async(full_history)(room.id), status=status.HTTP_200_OK)
 
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, *args, **kwargs):
         room_id = request.data.get('room_id')
         if not room_id:
             return Response(
@@ -345,40 +592,27 @@ class ChatMessageListCreateView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        room = get_object_or_404(ChatRoom, id=room_id, is_deleted=False)
-        if request.user not in room.users.all():
+        room = await aget_object_or_404(ChatRoom, id=room_id, is_deleted=False)
+        if not await room.users.filter(id=request.user.id).aexists():
             return Response(
                 {"error": "User is not part of this chat room."},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        # Modify request.data to include room and user
-        data = request.data.copy()
-        data['room'] = room_id
-        data['user'] = request.user.id
-
-        serializer = ChatMessageSerializer(data=data)
+        # Room and user come from the request context, so only the text is
+        # validated (the related fields would need sync lookups).
+        serializer = ChatMessageSerializer(data={'message': request.data.get('message', '')}, partial=True)
         if serializer.is_valid():
-            message = serializer.save(user=request.user, room=room)
-            profile_picture_url = self.get_profile_picture_url(request.user)
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                f"chat_{room_id}",
-                {
-                    "type": "chat_message",
-                    "message": message.message,
-                    "user": request.user.username,
-                    "first_name": request.user.first_name,  # Added
-                    "last_name": request.user.last_name,
-                    "user": request.user.id,
-                    "profile_picture": profile_picture_url,
-                    "timestamp": str(message.timestamp)
-                }
+            message = await database_sync_to_async(self.create_message)(
+                room, request.user, serializer.validated_data['message']
             )
-            
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            data = ChatMessageSerializer(message).data
+            message_cache.append(room.id, data)
+
+            return Response(data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-    def put(self, request, *args, **kwargs):
+
+    async def put(self, request, *args, **kwargs):
         """Edit only the message content of an existing message."""
         message_id = request.data.get('message_id')
         new_message_text = request.data.get('message')
@@ -388,16 +622,17 @@ class ChatMessageListCreateView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        message = get_object_or_404(ChatMessage, id=message_id, is_deleted=False)
-        if message.user != request.user:
+        message = await sharding.afind(
+            ChatMessage.objects.prefetch_related('user').filter(id=message_id, is_deleted=False)
+        )
+        if message is None:
+            raise Http404
+        if message.user_id != request.user.id:
             return Response(
                 {"error": "You can only edit your own messages."},
                 status=status.HTTP_403_FORBIDDEN
             )
         message.message = new_message_text
-        message.save(update_fields=['message'])
-        serializer = ChatMessageSerializer(message)
-        channel_layer = get_channel_layer()
         event = {
             "type": "chat_message",
             "message": message.message,  # Only send the updated message content
@@ -409,14 +644,13 @@ class ChatMessageListCreateView(APIView):
             "id": message.id,
             "action": "edit"
         }
-        async_to_sync(channel_layer.group_send)(
-            f"chat_{message.room.id}",
-            event
-        )
-        
+        await database_sync_to_async(self.save_message)(message, ['message'], event)
+        serializer = ChatMessageSerializer(message)
+        message_cache.update(message.room_id, message.id, serializer.data)
+
         return Response(serializer.data, status=status.HTTP_200_OK)
 
-    def delete(self, request, *args, **kwargs):
+    async def delete(self, request, *args, **kwargs):
         """Soft delete an existing message."""
         message_id = request.data.get('message_id')
         
@@ -426,20 +660,17 @@ class ChatMessageListCreateView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        message = get_object_or_404(ChatMessage, id=message_id, is_deleted=False)
+        message = await sharding.afind(ChatMessage.objects.filter(id=message_id, is_deleted=False))
+        if message is None:
+            raise Http404
         
         # Check if the user is the message author
-        if message.user != request.user:
+        if message.user_id != request.user.id:
             return Response(
                 {"error": "You can only delete your own messages."},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        # Soft delete the message
-        message.is_deleted = True
-        message.save(update_fields=['is_deleted'])
-        
-        channel_layer = get_channel_layer()
         event = {
             "type": "chat_message",
             "message": message.message,
@@ -451,20 +682,268 @@ class ChatMessageListCreateView(APIView):
             "id": message.id,
             "action": "delete"
         }
-        async_to_sync(channel_layer.group_send)(
-            f"chat_{message.room.id}",
-            event
-        )
-        
+        # Soft delete the message
+        message.is_deleted = True
+        await database_sync_to_async(self.save_message)(message, ['is_deleted'], event)
+        message_cache.remove(message.room_id, [message.id])
+
         return Response({"message": "Message deleted successfully."}, status=status.HTTP_200_OK)
 
+    def create_message(self, room, user, text):
+        """Store a new message and queue its broadcast in one transaction."""
+        with transaction.atomic(), transaction.atomic(using=sharding.shard_for_room(room, write=True)):
+            message = ChatMessage.objects.create(room=room, user=user, message=text)
+            publish(f"chat_{room.id}", {
+                "type": "chat_message",
+                "message": message.message,
+                "first_name": user.first_name,  # Added
+                "last_name": user.last_name,
+                "user": user.id,
+                "profile_picture": self.get_profile_picture_url(user),
+                "timestamp": str(message.timestamp)
+            })
+        return message
+
+    def save_message(self, message, update_fields, event):
+        """Save `update_fields` of a message on its shard and queue `event` in the same transaction."""
+        with transaction.atomic(), transaction.atomic(using=message._state.db):
+            message.save(update_fields=update_fields)
+            publish(f"chat_{message.room_id}", event)
+
     def get_profile_picture_url(self, user):
         """Get the URL of the user's profile picture if it exists."""
-        if hasattr(user, 'profile_picture') and user.profile_picture:
-            url = f"{user.profile_picture.url}?v={int(datetime.datetime.now().timestamp())}"
-            return url
-        return None
-    
+        return avatar_url(user)
+
+
+class MessageSearchView(APIView):
+    """
+    Search the text of messages in every room the user belongs to, newest
+    first. `?q=` is required; `?limit=N` caps the results (default
+    DEFAULT_PAGE_SIZE). Each shard holding some of the rooms is queried for
+    its newest matches and the results are merged.
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [SearchRateThrottle]
+
+    @reads_from_replica
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"error": "q is required."}, status=status.HTTP_400_BAD_REQUEST)
+        limit = get_limit(request)
+        if limit == 0:
+            return Response({"error": "limit must be a positive integer."}, status=status.HTTP_400_BAD_REQUEST)
+        limit = limit or DEFAULT_PAGE_SIZE
+
+        room_ids = list(
+            ChatRoom.objects.filter(users=request.user, is_deleted=False).values_list('id', flat=True)
+        )
+        messages = sharding.fan_in(
+            ChatMessage.objects.filter(message__icontains=query, is_deleted=False),
+            room_ids,
+            build=lambda shard_messages: list(shard_messages.prefetch_related('user').order_by('-id')[:limit]),
+            key=lambda message: message.id,
+            reverse=True,
+            limit=limit,
+        )
+        return Response(ChatMessageSerializer(messages, many=True).data, status=status.HTTP_200_OK)
+
+
+class MarkMessagesReadView(APIView):
+    """Advance the caller's read marker in a room to the given message."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = MarkReadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        room_id = serializer.validated_data['room_id']
+        message_id = serializer.validated_data['message_id']
+
+        room = get_object_or_404(ChatRoom, id=room_id, is_deleted=False, users=request.user)
+        message = get_object_or_404(ChatMessage, id=message_id, room=room)
+
+        with transaction.atomic():
+            advanced = RoomReadMarker.advance(request.user.id, room.id, message.id)
+            if advanced:
+                publish(
+                    f"chat_{room.id}",
+                    {
+                        "type": "read_receipt",
+                        "user": request.user.id,
+                        "message_id": message.id,
+                    }
+                )
+        return Response({"message_id": message.id, "advanced": advanced}, status=status.HTTP_200_OK)
+
+
+class ChatRoomReadReceiptsView(APIView):
+    """
+    Read markers of everyone in a room. With `?message_id=<id>` only the
+    members who have read up to that message are returned.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk, *args, **kwargs):
+        room = get_object_or_404(ChatRoom, pk=pk, is_deleted=False, users=request.user)
+        markers = RoomReadMarker.objects.filter(room=room)
+
+        message_id = request.query_params.get('message_id')
+        if message_id:
+            if not message_id.isdigit():
+                return Response({"error": "message_id must be a message id."}, status=status.HTTP_400_BAD_REQUEST)
+            markers = markers.filter(last_read_message_id__gte=int(message_id))
+
+        receipts = [
+            {
+                "user": marker["user_id"],
+                "username": marker["user__username"],
+                "last_read_message_id": marker["last_read_message_id"],
+                "read_at": marker["updated_at"],
+            }
+            for marker in markers.values('user_id', 'user__username', 'last_read_message_id', 'updated_at')
+        ]
+        return Response({"receipts": receipts}, status=status.HTTP_200_OK)
+
+
+class BulkMessageMixin:
+    """
+    Shared plumbing for bulk message operations. Members act on their own
+    messages; staff (moderators) may act on anyone's messages in rooms they
+    belong to. Each affected room gets one broadcast, whatever the count.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get_permitted_messages(self, request, message_ids):
+        """[(id, room_id)] of the requested messages the user may modify, in one query per shard."""
+        messages = ChatMessage.objects.filter(id__in=message_ids, is_deleted=False)
+        if not request.user.is_staff:
+            messages = messages.filter(user=request.user)
+        if not sharding.enabled():
+            return list(messages.filter(room__is_deleted=False, room__users=request.user).values_list('id', 'room_id'))
+
+        # Shards cannot join against rooms, so check membership on default.
+        found = [row for shard_messages in sharding.all_shards(messages) for row in shard_messages.values_list('id', 'room_id')]
+        rooms = set(
+            ChatRoom.objects.filter(
+                id__in={room_id for _, room_id in found}, is_deleted=False, users=request.user
+            ).values_list('id', flat=True)
+        )
+        return [(message_id, room_id) for message_id, room_id in found if room_id in rooms]
+
+    def ids_by_shard(self, permitted):
+        """{shard: [id, ...]} for permitted (id, room_id) pairs."""
+        shard_of = {
+            room_id: shard
+            for shard, room_ids in sharding.shards_for_rooms({room_id for _, room_id in permitted}, write=True).items()
+            for room_id in room_ids
+        }
+        grouped = {}
+        for message_id, room_id in permitted:
+            grouped.setdefault(shard_of[room_id], []).append(message_id)
+        return grouped
+
+    def atomic(self, shards):
+        """
+        A transaction on default (for the outbox) with one nested on each of
+        `shards`, so a failed shard write rolls back the others and the
+        broadcasts.
+        """
+        stack = ExitStack()
+        stack.enter_context(transaction.atomic())
+        for shard in shards:
+            stack.enter_context(transaction.atomic(using=shard))
+        return stack
+
+    def broadcast(self, room_id, event):
+        publish(f"chat_{room_id}", {"type": "chat_message_bulk", **event})
+
+
+class BulkDeleteMessagesView(BulkMessageMixin, APIView):
+    """Soft delete a list of messages with a single UPDATE."""
+
+    def post(self, request, *args, **kwargs):
+        serializer = BulkMessageIdsSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        message_ids = serializer.validated_data['message_ids']
+
+        permitted = self.get_permitted_messages(request, message_ids)
+        ids = [message_id for message_id, _ in permitted]
+        by_room = {}
+        for message_id, room_id in permitted:
+            by_room.setdefault(room_id, []).append(message_id)
+        by_shard = self.ids_by_shard(permitted)
+        with self.atomic(by_shard):
+            for shard, shard_ids in by_shard.items():
+                ChatMessage.objects.filter(id__in=shard_ids).using(shard).update(is_deleted=True)
+            for room_id, room_ids in by_room.items():
+                self.broadcast(room_id, {"action": "bulk_delete", "ids": room_ids})
+                transaction.on_commit(partial(message_cache.remove, room_id, room_ids))
+
+        skipped = sorted(set(message_ids) - set(ids))
+        return Response({"deleted": ids, "skipped": skipped}, status=status.HTTP_200_OK)
+
+
+class BulkEditMessagesView(BulkMessageMixin, APIView):
+    """Edit the text of several messages with a single UPDATE ... CASE."""
+
+    def post(self, request, *args, **kwargs):
+        serializer = BulkEditMessagesSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        new_text = {edit['id']: edit['message'] for edit in serializer.validated_data['edits']}
+
+        permitted = self.get_permitted_messages(request, list(new_text))
+        ids = [message_id for message_id, _ in permitted]
+        by_room = {}
+        for message_id, room_id in permitted:
+            by_room.setdefault(room_id, []).append({"id": message_id, "message": new_text[message_id]})
+        by_shard = self.ids_by_shard(permitted)
+        with self.atomic(by_shard):
+            for shard, shard_ids in by_shard.items():
+                ChatMessage.objects.filter(id__in=shard_ids).using(shard).update(
+                    message=Case(*[When(id=message_id, then=Value(new_text[message_id])) for message_id in shard_ids])
+                )
+            for room_id, messages in by_room.items():
+                self.broadcast(room_id, {"action": "bulk_edit", "messages": messages})
+                transaction.on_commit(partial(message_cache.invalidate, room_id))
+
+        skipped = sorted(set(new_text) - set(ids))
+        return Response({"edited": ids, "skipped": skipped}, status=status.HTTP_200_OK)
+
+
+class PurgeUserMessagesView(BulkMessageMixin, APIView):
+    """Soft delete everything one user wrote in a room with a single UPDATE."""
+
+    def post(self, request, *args, **kwargs):
+        serializer = PurgeUserMessagesSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        room_id = serializer.validated_data['room_id']
+        user_id = serializer.validated_data['user_id']
+        if not request.user.is_staff and user_id != request.user.id:
+            return Response(
+                {"error": "You can only purge your own messages."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        # Rooms live on default while the messages may be on a shard, so
+        # membership is checked before the UPDATE rather than joined into it.
+        if not ChatRoom.objects.filter(id=room_id, is_deleted=False, users=request.user).exists():
+            return Response({"deleted": 0}, status=status.HTTP_200_OK)
+        with self.atomic([sharding.shard_for_room(room_id, write=True)]):
+            deleted = ChatMessage.objects.filter(
+                room_id=room_id,
+                user_id=user_id,
+                is_deleted=False,
+            ).update(is_deleted=True)
+            if deleted:
+                self.broadcast(room_id, {"action": "purge", "user": user_id})
+                transaction.on_commit(partial(message_cache.invalidate, room_id))
+        return Response({"deleted": deleted}, status=status.HTTP_200_OK)
+
+
 PEER_CONNECTIONS = {}
 ICE_CANDIDATES = {}
 
@@ -481,16 +960,12 @@ class OfferView(APIView):
             'caller': caller
         }
         ICE_CANDIDATES[receiver] = []
-        print("Offer created. Current PEER_CONNECTIONS:", PEER_CONNECTIONS)  # Debug log
         return Response({'status': 'offer received'}, status=status.HTTP_201_CREATED)
 
 class AnswerView(APIView):
     def post(self, request):
         answer_sdp = request.data.get('sdp')
         caller_peer = request.data.get('caller_peer_id')
-        print("Answer SDP:", answer_sdp)
-        print("Caller Peer:", caller_peer)
-        print("Current PEER_CONNECTIONS:", PEER_CONNECTIONS) 
         if not caller_peer:
             return Response({'error': 'caller_peer_id is required'}, status=status.HTTP_400_BAD_REQUEST)
         if caller_peer in PEER_CONNECTIONS:
@@ -526,7 +1001,6 @@ class SetAnswerView(APIView):
 class GetAnswerView(APIView):
     def get(self, request, peer_id):
         answer = PEER_CONNECTIONS.get(peer_id, {}).get('answer')
-        print("Current PEER_CONNECTIONS:", PEER_CONNECTIONS)
         if answer:
             return Response({'sdp': answer}, status=status.HTTP_200_OK)
         return Response({'error': 'answer not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -542,18 +1016,18 @@ class IceCandidateView(APIView):
 
     def get(self, request, peer_id):
         candidates = ICE_CANDIDATES.get(peer_id, [])
-        print("Current ICE Candidates:", ICE_CANDIDATES)
         return Response({'candidates': candidates}, status=status.HTTP_200_OK)
 
 
-class ShareFilesInRoomAPIView(APIView):
+class ShareFilesInRoomAPIView(AsyncAPIView):
     permission_classes = [IsAuthenticated]
 
-    def post(self, request, *args, **kwargs):
-        if 'files' not in request.FILES:
+    async def post(self, request, *args, **kwargs):
+        # Parsing may spool large uploads to disk, so keep it off the event loop.
+        uploaded_files = await sync_to_async(self.get_uploaded_files, thread_sensitive=False)(request)
+        if uploaded_files is None:
             return Response({"error": "No files provided. Use 'files' as the key."}, status=400)
 
-        uploaded_files = request.FILES.getlist('files')
         if len(uploaded_files) == 0:
             return Response({"error": "Please upload at least 1 file."}, status=400)
         if len(uploaded_files) > 10:
@@ -562,12 +1036,11 @@ class ShareFilesInRoomAPIView(APIView):
         room_id = request.data.get('room_id')
         if not room_id:
             return Response({"error": "Room ID is required."}, status=400)
-        try:
-            room = ChatRoom.objects.get(id=room_id)
-        except ChatRoom.DoesNotExist:
+        room = await ChatRoom.objects.filter(id=room_id).afirst()
+        if room is None:
             return Response({"error": "Chat room not found."}, status=404)
 
-        if request.user not in room.users.all():
+        if not await room.users.filter(id=request.user.id).aexists():
             return Response({"error": "You are not a member of this room."}, status=403)
 
         for file in uploaded_files:
@@ -581,42 +1054,10 @@ class ShareFilesInRoomAPIView(APIView):
 
         # Use provided message, default to "Shared some files" only if empty
         message_text = request.data.get('message', '').strip() or 'Shared some files'
-        chat_message = ChatMessage.objects.create(
-            room=room,
-            user=request.user,
-            message=message_text
+        chat_message, saved_files, total_size = await database_sync_to_async(self.save_files)(
+            request.user, room, message_text, uploaded_files
         )
-
-        saved_files = []
-        total_size = 0
-        for file in uploaded_files:
-            total_size += file.size
-            attached_file = AttachedFile(
-                chat_message=chat_message,
-                file=file,
-                name=file.name,
-                size=file.size,
-                content_type=file.content_type
-            )
-            attached_file.save()
-            saved_files.append({
-                "name": attached_file.name,
-                "size": attached_file.size,
-                "url": attached_file.file.url
-            })
-
-        channel_layer = get_channel_layer()
-        event = {
-            "type": "chat_message",
-            "message": message_text,
-            "first_name": request.user.first_name,
-            "last_name": request.user.last_name,
-            "user": request.user.id,
-            "timestamp": str(chat_message.timestamp),
-            "files": saved_files
-        }
-
-        async_to_sync(channel_layer.group_send)(f"chat_{room_id}", event)
+        message_cache.append(room.id, ChatMessageSerializer(chat_message).data)
 
         return Response(
             {
@@ -628,27 +1069,120 @@ class ShareFilesInRoomAPIView(APIView):
             },
             status=201
         )
+
+    def get_uploaded_files(self, request):
+        if 'files' not in request.FILES:
+            return None
+        return request.FILES.getlist('files')
+
+    def save_files(self, user, room, message_text, uploaded_files):
+        """
+        Store the message and its files, and queue the broadcast. The shard
+        transaction commits just before the one on default holding the
+        outbox event.
+        """
+        with transaction.atomic(), transaction.atomic(using=sharding.shard_for_room(room, write=True)):
+            chat_message = ChatMessage.objects.create(
+                room=room,
+                user=user,
+                message=message_text
+            )
+
+            saved_files = []
+            total_size = 0
+            for file in uploaded_files:
+                total_size += file.size
+                attached_file = AttachedFile(
+                    chat_message=chat_message,
+                    file=file,
+                    name=file.name,
+                    size=file.size,
+                    content_type=file.content_type
+                )
+                attached_file.save()
+                enqueue(process_attached_file, attached_file.id)
+                saved_files.append(attachment_data(attached_file))
+
+            publish(f"chat_{room.id}", {
+                "type": "chat_message",
+                "message": message_text,
+                "first_name": user.first_name,
+                "last_name": user.last_name,
+                "user": user.id,
+                "timestamp": str(chat_message.timestamp),
+                "files": saved_files
+            })
+        return chat_message, saved_files, total_size
+
+
 class ViewChatMessageAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, token, *args, **kwargs):
-        chat_message = get_object_or_404(ChatMessage, share_token=token)
+        chat_message = sharding.find(
+            ChatMessage.objects.prefetch_related('room', 'user').filter(share_token=token, is_deleted=False)
+        )
+        if chat_message is None:
+            raise Http404
 
-        if request.user not in chat_message.room.members.all():
+        if not chat_message.room.users.filter(id=request.user.id).exists():
             return Response({"error": "You are not a member of this room."}, status=403)
 
-        files = [
-            {
-                "name": f.name,
-                "size": f.size,
-                "url": f.file.url
-            } for f in chat_message.files.all()
-        ]
+        files = [attachment_data(f) for f in chat_message.files.all()]
 
         return Response({
-            "sender": chat_message.sender.username,
+            "sender": chat_message.user.username,
             "room": chat_message.room.name,
             "message": chat_message.message,
             "files": files,
             "timestamp": chat_message.timestamp
-        })
\ No newline at end of file
+        })
+
+
+class AttachedFileDownloadView(APIView):
+    """
+    Authenticated download of a chat attachment. The file is loaded with its
+    message from the room's shard and membership is checked on default; the
+    bytes themselves are served by the front-end server when
+    SENDFILE_BACKEND is configured.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, file_id, *args, **kwargs):
+        attached = sharding.find(
+            AttachedFile.objects.select_related('chat_message').filter(id=file_id, chat_message__is_deleted=False)
+        )
+        if attached is None or not ChatRoom.objects.filter(
+            id=attached.chat_message.room_id, is_deleted=False, users=request.user
+        ).exists():
+            raise Http404
+        return sendfile_response(
+            request,
+            attached.file,
+            filename=attached.name,
+            content_type=attached.content_type,
+            last_modified=attached.chat_message.timestamp,
+        )
+
+
+class MetricsView(APIView):
+    """
+    Prometheus metrics for this process. When METRICS_TOKEN is set it must be
+    sent as `Authorization: Bearer <METRICS_TOKEN>`; without one, only staff
+    users may read them.
+    """
+    permission_classes = [AllowAny]
+
+    def perform_authentication(self, request):
+        # The metrics token is not a JWT, so users are only authenticated
+        # when there is no token to check instead.
+        if not settings.METRICS_TOKEN:
+            super().perform_authentication(request)
+
+    def get(self, request, *args, **kwargs):
+        if settings.METRICS_TOKEN:
+            if request.headers.get('Authorization') != f"Bearer {settings.METRICS_TOKEN}":
+                return Response({"error": "Invalid metrics token."}, status=status.HTTP_403_FORBIDDEN)
+        elif not request.user.is_staff:
+            return Response({"error": "Metrics require METRICS_TOKEN or a staff user."}, status=status.HTTP_403_FORBIDDEN)
+        return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)